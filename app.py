@@ -2,33 +2,1063 @@
 Мобильные сотрудники - Web приложение для управления сотрудниками компании
 Расширенная версия с аутентификацией и функционалом для сотрудников
 Запуск: python app.py
+Под gunicorn: gunicorn 'app:create_app()' (с --preload инициализация выполняется один раз до fork)
 Открыть в браузере: http://localhost:5000
 """
 
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session
+from flask import (Flask, render_template, request, redirect, url_for, flash, jsonify, session, g,
+                   stream_with_context, get_flashed_messages, send_from_directory, abort,
+                   has_request_context)
+from markupsafe import Markup
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import safe_join
+from collections import OrderedDict
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import bisect
+import contextlib
+import contextvars
+import heapq
+import re
 import sqlite3
 import hashlib
+import hmac
 import os
+import json
+import math
 import datetime
+import time
+import zlib
+import csv
+import io
+import uuid
+import threading
+import mimetypes
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# numpy загружается при первом расчете аналитики (load_numpy), чтобы не замедлять запуск воркеров
+np = None
 
 app = Flask(__name__)
 app.secret_key = 'mobile-employees-secret-key-2024-advanced'
 app.config['SESSION_TYPE'] = 'filesystem'
+app.config['TRAIL_TOLERANCE_M'] = 5.0  # Допуск упрощения треков (Дуглас-Пекер), метры
+app.config['HEATMAP_ZOOMS'] = range(3, 16)  # Уровни масштаба пирамиды тепловой карты
+app.config['HEATMAP_GRID'] = 32  # Ячеек по стороне тайла
+app.config['HEATMAP_MAX_DWELL_S'] = 300  # Максимальное время, засчитываемое точке до следующей отметки, секунды
+app.config['JOB_WORKERS'] = 2  # Потоков фоновых заданий на процесс
+app.config['JOB_MAX_QUEUED'] = 20  # Максимум заданий в очереди
+app.config['JOB_RESULT_TTL_S'] = 3600  # Время хранения результатов, секунды
+app.config['JOB_STALE_S'] = 900  # Задание без прогресса дольше этого считается прерванным
+app.config['PASSWORD_SCRYPT_N'] = 2 ** 14  # Стоимость KDF (scrypt): CPU/память
+app.config['PASSWORD_SCRYPT_R'] = 8
+app.config['PASSWORD_SCRYPT_P'] = 1
+app.config['PASSWORD_WORKERS'] = 4  # Потоков проверки паролей на процесс
+app.config['PASSWORD_MAX_PENDING'] = 64  # Максимум проверок в работе и очереди
+app.config['PASSWORD_TIMEOUT_S'] = 10  # Максимальное ожидание результата проверки
+app.config['RATE_LIMIT_ENABLED'] = True
+app.config['RATE_LIMIT_DB'] = 'ratelimit.db'  # Общее хранилище корзин токенов для всех воркеров
+app.config['LOAD_SHED_LATENCY_MS'] = 500  # Порог средней задержки для отбрасывания фоновых опросов
+app.config['LOAD_SHED_RETRY_AFTER_S'] = 5
+app.config['LOAD_SHED_DECAY_S'] = 10  # Постоянная затухания средней задержки без новых запросов, секунды
+# Число доверенных прокси перед приложением: адрес клиента берется из X-Forwarded-For (ProxyFix в create_app)
+app.config['PROXY_FIX_HOPS'] = int(os.environ.get('PROXY_FIX_HOPS', '0'))
+app.config['DIRECTORY_CHECK_INTERVAL_S'] = 0.5  # Как часто справочник сверяет версию данных
+app.config['DATA_CHANGES_KEEP'] = 10000  # Сколько последних записей журнала изменений хранить
+app.config['FRAGMENT_CACHE_ENABLED'] = True
+app.config['FRAGMENT_CACHE_MAX_BYTES'] = 8 * 1024 * 1024  # Объем кеша отрисованных фрагментов
+app.config['STREAM_CHUNK_ROWS'] = 500  # Строк за одно чтение курсора при потоковой отрисовке
+app.config['STREAM_BUFFER_ITEMS'] = 100  # Фрагментов шаблона в одной порции ответа
+app.config['STREAM_CACHE_MAX_ROWS'] = 500  # Списки длиннее не кешируются, а отдаются потоком
+app.config['COMPRESS_MIN_SIZE'] = 500  # Ответы меньше этого размера не сжимаются
+app.config['COMPRESS_LEVEL'] = 6  # Уровень gzip
+app.config['COMPRESS_BROTLI_QUALITY'] = 9  # Качество brotli (0-11) для обычных и потоковых ответов
+app.config['COMPRESS_MIMETYPES'] = {'text/html', 'text/css', 'text/plain', 'text/csv',
+                                    'application/json', 'application/javascript', 'image/svg+xml'}
+app.config['STATIC_MAX_AGE_S'] = 365 * 24 * 3600  # Кеширование статики с хешем в имени
+app.config['STATIC_MAX_MEMORY_BYTES'] = 1024 * 1024  # Файлы больше отдаются без предсжатия
+app.config['TASK_OVERDUE_ENABLED'] = True
+app.config['TASK_OVERDUE_BATCH'] = 500  # Задач за одну транзакцию эскалации
+app.config['TASK_OVERDUE_MAX_SLEEP_S'] = 60  # Максимальный сон планировщика (сроки из других процессов)
+app.config['TASK_BATCH_MAX'] = 1000  # Максимум задач в одном пакетном запросе
+app.config['ARCHIVE_DIR'] = 'archive'  # Помесячные архивы рядом с основной базой
+app.config['ARCHIVE_AFTER_DAYS'] = 365  # Строки старше переносятся в архив
+app.config['ARCHIVE_ATTACH_MAX'] = 8  # Архивов, подключаемых к одному соединению (лимит SQLite - 10)
+app.config['DATABASE'] = 'employees.db'  # База компании по умолчанию
+app.config['STORAGE_ENGINE'] = os.environ.get('STORAGE_ENGINE', 'sqlite')  # 'sqlite' - файлы, 'memory' - память процесса
+app.config['TIMESERIES_DEFAULT_POINTS'] = 200  # Точек в ответе, если клиент не указал
+app.config['TIMESERIES_MAX_POINTS'] = 2000
+app.config['TIMESERIES_MAX_BUCKETS'] = 20000  # Предел числа корзин до прореживания
+app.config['TENANTS_ENABLED'] = False  # Отдельная база на каждую компанию
+app.config['TENANT_DEFAULT'] = 'default'  # Компания, которой принадлежит DATABASE; ее администраторы видят все компании
+app.config['TENANT_DIR'] = 'tenants'  # Каталог баз компаний: tenants/<компания>.db
+app.config['TENANT_HOST_SUFFIX'] = None  # Например '.example.com': компания берется из поддомена
+app.config['TENANT_CACHE_SIZE'] = 64  # Открытых баз компаний на процесс
+app.config['STARTUP_BUDGET_MS'] = 500  # Инициализация дольше этого выводит предупреждение
+
+# ========== ГЕОМЕТРИЯ ==========
+
+EARTH_RADIUS_M = 6371000.0
+METERS_PER_DEGREE_LAT = 111320.0
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Расстояние между двумя точками в метрах"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+def point_in_polygon(lat, lon, polygon):
+    """Проверка попадания точки в полигон (метод трассировки луча)"""
+    inside = False
+    j = len(polygon) - 1
+    for i in range(len(polygon)):
+        lat_i, lon_i = polygon[i]
+        lat_j, lon_j = polygon[j]
+        if (lon_i > lon) != (lon_j > lon):
+            cross_lat = (lat_j - lat_i) * (lon - lon_i) / (lon_j - lon_i) + lat_i
+            if lat < cross_lat:
+                inside = not inside
+        j = i
+    return inside
+
+def geofence_bbox(kind, center_lat=None, center_lon=None, radius_m=None, polygon=None):
+    """Ограничивающий прямоугольник геозоны: (min_lat, max_lat, min_lon, max_lon)"""
+    if kind == 'circle':
+        dlat = radius_m / METERS_PER_DEGREE_LAT
+        dlon = radius_m / (METERS_PER_DEGREE_LAT * max(math.cos(math.radians(center_lat)), 1e-6))
+        return (center_lat - dlat, center_lat + dlat, center_lon - dlon, center_lon + dlon)
+    lats = [p[0] for p in polygon]
+    lons = [p[1] for p in polygon]
+    return (min(lats), max(lats), min(lons), max(lons))
+
+# ========== ПАРОЛИ ==========
+
+class PasswordQueueFull(Exception):
+    """Пул проверки паролей перегружен: очередь заполнена или результат не получен вовремя"""
+
+class PasswordHasher:
+    """Хеширование паролей scrypt с солью в ограниченном пуле потоков и метриками"""
+    
+    def __init__(self):
+        self._executor = None
+        self._slots = None
+        self._lock = threading.Lock()
+        self._metrics = {
+            'hashed': 0,
+            'verified': 0,
+            'failed': 0,
+            'rehashed': 0,
+            'rejected': 0,
+            'timed_out': 0,
+            'pending': 0,
+            'total_wait_s': 0.0,
+            'total_work_s': 0.0,
+            'max_wait_s': 0.0
+        }
+    
+    def after_fork(self):
+        """Потоки пула не переживают fork: дочерний процесс создаст свой пул"""
+        self._executor = None
+        self._slots = None
+        self._lock = threading.Lock()
+        self._metrics['pending'] = 0
+    
+    def _ensure_pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=app.config['PASSWORD_WORKERS'],
+                                                    thread_name_prefix='password')
+                self._slots = threading.BoundedSemaphore(app.config['PASSWORD_MAX_PENDING'])
+    
+    def _run(self, fn, *args):
+        """Выполняет fn в пуле; при переполненной очереди или истечении PASSWORD_TIMEOUT_S - PasswordQueueFull
+        
+        Место в очереди освобождает сам рабочий поток, поэтому вычисление, результата
+        которого не дождались, продолжает занимать место до своего завершения.
+        """
+        self._ensure_pool()
+        slots = self._slots
+        if not slots.acquire(blocking=False):
+            with self._lock:
+                self._metrics['rejected'] += 1
+            raise PasswordQueueFull('Слишком много одновременных входов, повторите позже')
+        
+        submitted = time.monotonic()
+        
+        def timed():
+            started = time.monotonic()
+            try:
+                return fn(*args)
+            finally:
+                with self._lock:
+                    wait = started - submitted
+                    self._metrics['total_wait_s'] += wait
+                    self._metrics['max_wait_s'] = max(self._metrics['max_wait_s'], wait)
+                    self._metrics['total_work_s'] += time.monotonic() - started
+                    self._metrics['pending'] -= 1
+                slots.release()
+        
+        with self._lock:
+            self._metrics['pending'] += 1
+        try:
+            future = self._executor.submit(timed)
+        except Exception:
+            with self._lock:
+                self._metrics['pending'] -= 1
+            slots.release()
+            raise
+        try:
+            return future.result(timeout=app.config['PASSWORD_TIMEOUT_S'])
+        except FutureTimeoutError:
+            with self._lock:
+                self._metrics['timed_out'] += 1
+            raise PasswordQueueFull('Проверка пароля заняла слишком много времени, повторите позже')
+    
+    @staticmethod
+    def _scrypt(password, salt, n, r, p):
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r * p + 1024 * 1024)
+    
+    def _hash(self, password):
+        n, r, p = app.config['PASSWORD_SCRYPT_N'], app.config['PASSWORD_SCRYPT_R'], app.config['PASSWORD_SCRYPT_P']
+        salt = os.urandom(16)
+        return f'scrypt${n}${r}${p}${salt.hex()}${self._scrypt(password, salt, n, r, p).hex()}'
+    
+    def _verify(self, password, stored):
+        if stored.startswith('scrypt$'):
+            _, n, r, p, salt, expected = stored.split('$')
+            n, r, p = int(n), int(r), int(p)
+            actual = self._scrypt(password, bytes.fromhex(salt), n, r, p).hex()
+            needs_rehash = (n, r, p) != (app.config['PASSWORD_SCRYPT_N'],
+                                         app.config['PASSWORD_SCRYPT_R'],
+                                         app.config['PASSWORD_SCRYPT_P'])
+        else:
+            # Устаревший формат: sha256 без соли
+            actual = hashlib.sha256(password.encode()).hexdigest()
+            expected = stored
+            needs_rehash = True
+        return hmac.compare_digest(actual, expected), needs_rehash
+    
+    def hash(self, password):
+        result = self._run(self._hash, password)
+        with self._lock:
+            self._metrics['hashed'] += 1
+        return result
+    
+    def verify(self, password, stored):
+        """Возвращает (пароль верен, требуется перехеширование)"""
+        if not stored:
+            return False, False
+        ok, needs_rehash = self._run(self._verify, password, stored)
+        with self._lock:
+            self._metrics['verified' if ok else 'failed'] += 1
+        return ok, ok and needs_rehash
+    
+    def record_rehash(self):
+        with self._lock:
+            self._metrics['rehashed'] += 1
+    
+    def metrics(self):
+        with self._lock:
+            result = dict(self._metrics)
+        calls = result['hashed'] + result['verified'] + result['failed']
+        result['avg_wait_ms'] = round(result['total_wait_s'] / calls * 1000, 2) if calls else 0
+        result['avg_work_ms'] = round(result['total_work_s'] / calls * 1000, 2) if calls else 0
+        result['workers'] = app.config['PASSWORD_WORKERS']
+        result['max_pending'] = app.config['PASSWORD_MAX_PENDING']
+        return result
+
+passwords = PasswordHasher()
+
+# ========== ТРЕКИ ПЕРЕМЕЩЕНИЙ ==========
+
+TRAIL_COORD_SCALE = 100000  # 1e-5 градуса (~1 м)
+
+def douglas_peucker(points, tolerance_m):
+    """Упрощение трека [(lat, lon, ts), ...] алгоритмом Дугласа-Пекера"""
+    if len(points) < 3 or tolerance_m <= 0:
+        return list(points)
+    
+    # Локальная равнопромежуточная проекция в метры
+    kx = METERS_PER_DEGREE_LAT * math.cos(math.radians(points[0][0]))
+    xy = [(p[1] * kx, p[0] * METERS_PER_DEGREE_LAT) for p in points]
+    
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        x1, y1 = xy[first]
+        x2, y2 = xy[last]
+        dx, dy = x2 - x1, y2 - y1
+        seg_len = math.hypot(dx, dy)
+        max_dist, index = 0.0, 0
+        for i in range(first + 1, last):
+            px, py = xy[i]
+            if seg_len == 0:
+                dist = math.hypot(px - x1, py - y1)
+            else:
+                dist = abs(dy * px - dx * py + x2 * y1 - y2 * x1) / seg_len
+            if dist > max_dist:
+                max_dist, index = dist, i
+        if max_dist > tolerance_m:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    
+    return [p for p, k in zip(points, keep) if k]
+
+def _write_varint(buf, value):
+    value = (value << 1) ^ (value >> 63)  # zigzag для отрицательных дельт
+    while value > 0x7F:
+        buf.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+def _read_varints(data):
+    value, shift = 0, 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            yield (value >> 1) ^ -(value & 1)
+            value, shift = 0, 0
+
+def encode_trail(points):
+    """Дельта-кодирование трека в компактный блоб"""
+    buf = bytearray()
+    prev_lat = prev_lon = prev_ts = 0
+    for lat, lon, ts in points:
+        ilat = round(lat * TRAIL_COORD_SCALE)
+        ilon = round(lon * TRAIL_COORD_SCALE)
+        its = int(ts)
+        _write_varint(buf, ilat - prev_lat)
+        _write_varint(buf, ilon - prev_lon)
+        _write_varint(buf, its - prev_ts)
+        prev_lat, prev_lon, prev_ts = ilat, ilon, its
+    return zlib.compress(bytes(buf), 9)
+
+def decode_trail(blob):
+    """Декодирование блоба трека в список точек (lat, lon, ts)"""
+    values = list(_read_varints(zlib.decompress(blob)))
+    points = []
+    lat = lon = ts = 0
+    for i in range(0, len(values) - 2, 3):
+        lat += values[i]
+        lon += values[i + 1]
+        ts += values[i + 2]
+        points.append((lat / TRAIL_COORD_SCALE, lon / TRAIL_COORD_SCALE, ts))
+    return points
+
+def zoom_tolerance_m(zoom, latitude=0.0):
+    """Допуск упрощения для уровня масштаба карты (примерно один пиксель)"""
+    return 156543.03 * math.cos(math.radians(latitude)) / (2 ** zoom)
+
+def trail_day(ts):
+    """Сутки трека в местном времени, как у отчетов и сводок"""
+    return datetime.date.fromtimestamp(ts).isoformat()
+
+def trail_day_start(day):
+    """Метка времени местной полуночи для суток трека"""
+    return int(datetime.datetime.combine(datetime.date.fromisoformat(day), datetime.time()).timestamp())
+
+def heatmap_cells_for_point(lat, lon, zooms, grid):
+    """Тайлы и ячейки (Web Mercator), в которые попадает точка на каждом уровне масштаба"""
+    lat = max(min(lat, 85.0511), -85.0511)
+    fx = (lon + 180.0) / 360.0
+    fy = (1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0
+    cells = []
+    for zoom in zooms:
+        n = 1 << zoom
+        px = min(fx * n, n - 1e-9)
+        py = min(max(fy * n, 0.0), n - 1e-9)
+        tile_x, tile_y = int(px), int(py)
+        cell = int((py - tile_y) * grid) * grid + int((px - tile_x) * grid)
+        cells.append((zoom, tile_x, tile_y, cell))
+    return cells
+
+# ========== СПРАВОЧНИК СОТРУДНИКОВ ==========
+
+SEARCH_TOKEN_RE = re.compile(r'\w+')
+PHONE_QUERY_RE = re.compile(r'^[\d\s+()\-]*\d[\d\s+()\-]*$')
+
+def search_normalize(text):
+    """Нормализация текста для поиска: нижний регистр, ё -> е"""
+    return (text or '').lower().replace('ё', 'е').strip()
+
+def normalize_phone(phone):
+    """Только цифры телефона; российский префикс 8 приводится к 7"""
+    digits = ''.join(ch for ch in (phone or '') if ch.isdigit())
+    if len(digits) == 11 and digits.startswith('8'):
+        digits = '7' + digits[1:]
+    return digits
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+# Вес совпадения по полям при ранжировании результатов поиска
+SEARCH_FIELD_WEIGHTS = {'name': 4, 'phone': 3, 'email': 2, 'position': 1, 'department': 1}
+
+EMPLOYEE_FIELDS = ('id', 'name', 'position', 'department', 'phone', 'email', 'location', 'status',
+                   'latitude', 'longitude', 'work_schedule', 'current_task', 'hourly_rate', 'created_at')
+
+class EmployeeRecord:
+    """Компактная запись сотрудника; поддерживает доступ как record.name и record['name']"""
+    __slots__ = EMPLOYEE_FIELDS
+    
+    def __init__(self, row):
+        for field in EMPLOYEE_FIELDS:
+            setattr(self, field, row[field])
+    
+    def __getitem__(self, key):
+        if key not in EMPLOYEE_FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+    
+    def get(self, key, default=None):
+        return getattr(self, key) if key in EMPLOYEE_FIELDS else default
+    
+    def keys(self):
+        return EMPLOYEE_FIELDS
+
+# Журналы изменений, по которым синхронизируется справочник
+DIRECTORY_SOURCES = ('employees', 'employee_locations')
+
+class EmployeeDirectory:
+    """Справочник сотрудников в памяти процесса с индексами по id, отделу, статусу и имени.
+    
+    Синхронизируется с таблицей employees по журналу data_changes: перечитываются
+    только изменившиеся строки, а изменения из других воркеров видны через версию данных.
+    """
+    
+    def __init__(self, database):
+        self.database = database
+        self._lock = threading.RLock()
+        self._version = None
+        self._checked_at = 0.0
+        self._records = {}
+        self._name_order = []
+        self._by_department = {}
+        self._by_status = {}
+        self._search_tokens = []
+        self._search_texts = {}
+        self._trigrams = {}
+    
+    def invalidate(self):
+        """Принудительная сверка версии при следующем чтении (после записи в этом процессе)"""
+        self._checked_at = 0.0
+    
+    def _sync(self):
+        now = time.monotonic()
+        if now - self._checked_at < app.config['DIRECTORY_CHECK_INTERVAL_S']:
+            return
+        with self._lock:
+            if now - self._checked_at < app.config['DIRECTORY_CHECK_INTERVAL_S']:
+                return
+            conn = self.database.get_connection()
+            try:
+                version = self.database.get_data_version(DIRECTORY_SOURCES, conn)
+                if version != self._version:
+                    oldest = conn.execute('SELECT MIN(id) FROM data_changes').fetchone()[0]
+                    if self._version is None or (oldest is not None and oldest > self._version + 1):
+                        self._reload(conn)
+                    else:
+                        changed = [row[0] for row in conn.execute('''
+                            SELECT DISTINCT row_id FROM data_changes
+                            WHERE name IN (?, ?) AND id > ? AND id <= ?
+                        ''', (*DIRECTORY_SOURCES, self._version, version))]
+                        self._apply(conn, changed)
+                    self._version = version
+            finally:
+                conn.close()
+            self._checked_at = now
+    
+    def _reload(self, conn):
+        rows = conn.execute(f'SELECT {", ".join(EMPLOYEE_FIELDS)} FROM employees').fetchall()
+        self._records = {}
+        self._name_order = []
+        self._by_department = {}
+        self._by_status = {}
+        self._search_tokens = []
+        self._search_texts = {}
+        self._trigrams = {}
+        for row in rows:
+            record = EmployeeRecord(row)
+            self._index(record)
+            self._name_order.append((record.name, record.id))
+            self._search_tokens.extend(self._tokens_for(record))
+        self._name_order.sort()
+        self._search_tokens.sort()
+    
+    def _apply(self, conn, employee_ids):
+        for employee_id in employee_ids:
+            self._unindex(employee_id)
+        for chunk_start in range(0, len(employee_ids), 500):
+            chunk = employee_ids[chunk_start:chunk_start + 500]
+            rows = conn.execute(f'''
+                SELECT {", ".join(EMPLOYEE_FIELDS)} FROM employees
+                WHERE id IN ({",".join("?" * len(chunk))})
+            ''', chunk).fetchall()
+            for row in rows:
+                record = EmployeeRecord(row)
+                self._index(record)
+                bisect.insort(self._name_order, (record.name, record.id))
+                for token in self._tokens_for(record):
+                    bisect.insort(self._search_tokens, token)
+    
+    def _index(self, record):
+        self._records[record.id] = record
+        self._by_department.setdefault(record.department, set()).add(record.id)
+        self._by_status.setdefault(record.status, set()).add(record.id)
+        
+        texts = self._texts_for(record)
+        self._search_texts[record.id] = texts
+        for gram in trigrams(' '.join(texts.values())):
+            self._trigrams.setdefault(gram, set()).add(record.id)
+    
+    def _unindex(self, employee_id):
+        record = self._records.pop(employee_id, None)
+        if record is None:
+            return
+        index = bisect.bisect_left(self._name_order, (record.name, record.id))
+        if index < len(self._name_order) and self._name_order[index] == (record.name, record.id):
+            del self._name_order[index]
+        self._by_department.get(record.department, set()).discard(employee_id)
+        self._by_status.get(record.status, set()).discard(employee_id)
+        
+        for token in self._tokens_for(record):
+            index = bisect.bisect_left(self._search_tokens, token)
+            if index < len(self._search_tokens) and self._search_tokens[index] == token:
+                del self._search_tokens[index]
+        texts = self._search_texts.pop(employee_id, {})
+        for gram in trigrams(' '.join(texts.values())):
+            ids = self._trigrams.get(gram)
+            if ids is not None:
+                ids.discard(employee_id)
+                if not ids:
+                    del self._trigrams[gram]
+    
+    @staticmethod
+    def _texts_for(record):
+        return {
+            'name': search_normalize(record.name),
+            'phone': normalize_phone(record.phone),
+            'email': search_normalize(record.email),
+            'position': search_normalize(record.position),
+            'department': search_normalize(record.department)
+        }
+    
+    def _tokens_for(self, record):
+        """Элементы префиксного индекса: (токен, id, поле)"""
+        tokens = set()
+        for field, text in self._texts_for(record).items():
+            if field == 'phone':
+                if text:
+                    tokens.add((text, record.id, field))
+                    # Поиск по номеру без кода страны
+                    tokens.add((text[-10:], record.id, field))
+                continue
+            if field == 'name' and text:
+                tokens.add((text, record.id, field))
+            for token in SEARCH_TOKEN_RE.findall(text):
+                tokens.add((token, record.id, field))
+        return tokens
+    
+    def _match_term(self, term):
+        """Оценки сотрудников, совпавших с одним словом запроса"""
+        scores = {}
+        
+        # Префиксные совпадения по токенам
+        index = bisect.bisect_left(self._search_tokens, (term,))
+        tokens = self._search_tokens
+        while index < len(tokens) and tokens[index][0].startswith(term):
+            token, employee_id, field = tokens[index]
+            score = SEARCH_FIELD_WEIGHTS[field] * (20 if token == term else 10)
+            scores[employee_id] = max(scores.get(employee_id, 0), score)
+            index += 1
+        
+        # Совпадения внутри слов по триграммам
+        if len(term) >= 3:
+            candidates = None
+            for gram in trigrams(term):
+                ids = self._trigrams.get(gram, set())
+                candidates = set(ids) if candidates is None else candidates & ids
+                if not candidates:
+                    break
+            for employee_id in candidates or ():
+                for field, text in self._search_texts[employee_id].items():
+                    if term in text:
+                        scores[employee_id] = max(scores.get(employee_id, 0), SEARCH_FIELD_WEIGHTS[field] * 3)
+        return scores
+    
+    # Индексы меняются на месте в _apply/_reload, поэтому читатели тоже берут _lock
+    
+    def all(self):
+        """Все сотрудники в порядке имени"""
+        self._sync()
+        with self._lock:
+            records = self._records
+            return [records[employee_id] for _, employee_id in self._name_order]
+    
+    def get(self, employee_id):
+        self._sync()
+        try:
+            employee_id = int(employee_id)
+        except (TypeError, ValueError):
+            return None
+        with self._lock:
+            return self._records.get(employee_id)
+    
+    def filter(self, department=None, status=None):
+        """Сотрудники отдела и/или статуса в порядке имени"""
+        self._sync()
+        with self._lock:
+            ids = None
+            if department is not None:
+                ids = set(self._by_department.get(department, ()))
+            if status is not None:
+                status_ids = self._by_status.get(status, set())
+                ids = set(status_ids) if ids is None else ids & status_ids
+            if ids is None:
+                return self.all()
+            records = self._records
+            return sorted((records[i] for i in ids), key=lambda r: (r.name, r.id))
+    
+    def search(self, query, department=None, status=None, limit=10):
+        """Поиск по имени, телефону, email, отделу и должности с ранжированием"""
+        self._sync()
+        with self._lock:
+            query = search_normalize(query)
+            if PHONE_QUERY_RE.match(query):
+                # Номер в любом формате, например +7 (999) 111-11-11 или 8 999 111
+                digits = normalize_phone(query)
+                terms = [[digits, '7' + digits[1:]] if digits.startswith('8') else [digits]]
+            else:
+                terms = [[term] for term in SEARCH_TOKEN_RE.findall(query)]
+            if not terms:
+                return []
+            
+            scores = None
+            for variants in terms:
+                term_scores = {}
+                for term in variants:
+                    for employee_id, score in self._match_term(term).items():
+                        term_scores[employee_id] = max(term_scores.get(employee_id, 0), score)
+                if scores is None:
+                    scores = term_scores
+                else:
+                    scores = {i: scores[i] + term_scores[i] for i in scores.keys() & term_scores.keys()}
+                if not scores:
+                    return []
+            
+            records = self._records
+            results = []
+            for employee_id, score in scores.items():
+                record = records.get(employee_id)
+                if record is None:
+                    continue
+                if department is not None and record.department != department:
+                    continue
+                if status is not None and record.status != status:
+                    continue
+                results.append((-score, record.name, employee_id))
+            results.sort()
+            return [records[employee_id] for _, _, employee_id in results[:limit]]
+    
+    def departments(self):
+        self._sync()
+        with self._lock:
+            return sorted(d for d, ids in self._by_department.items() if d and ids)
+    
+    def count(self, status=None):
+        self._sync()
+        with self._lock:
+            if status is None:
+                return len(self._records)
+            return len(self._by_status.get(status, ()))
+    
+    @property
+    def version(self):
+        self._sync()
+        with self._lock:
+            return self._version
+
+# Срок задачи: дата без времени означает конец дня. Выражение совпадает с индексом idx_tasks_open_deadline
+TASK_DEADLINE_SQL = "(CASE WHEN length(due_date) = 10 THEN due_date || ' 23:59:59' ELSE replace(due_date, 'T', ' ') END)"
+# completed_at хранится в UTC, а срок задается в местном времени: сравниваем в одних часах
+TASK_COMPLETED_LOCAL_SQL = "datetime(completed_at, 'localtime')"
+OPEN_TASK_SQL = "status != 'completed' AND overdue_at IS NULL AND due_date IS NOT NULL AND due_date != ''"
+TASK_STATUSES = ('pending', 'in_progress', 'completed')
+# Архивируемые таблицы: колонка даты, по которой строка попадает в месячный архив, и условие переноса
+ARCHIVE_TABLES = {
+    'work_reports': ('date', '1'),
+    'messages': ('created_at', 'is_read = 1'),
+    'tasks': ('completed_at', "status = 'completed'")
+}
+ARCHIVE_MONTH_RE = re.compile(r'^\d{4}-\d{2}$')
+# Итоги переносимых в архив строк по сотруднику: число строк, часы, выполненные задачи
+ARCHIVE_TOTALS_SQL = {
+    'work_reports': 'COUNT(*), COALESCE(SUM(hours_worked), 0), COALESCE(SUM(tasks_completed), 0)',
+    'tasks': 'COUNT(*), 0, 0'
+}
+TENANT_RE = re.compile(r'^[a-z0-9][a-z0-9_-]{0,62}$')
+# Версия схемы в PRAGMA user_version: увеличивать при любых изменениях init_db/update_table_structure
+SCHEMA_VERSION = 6
+TASK_PRIORITIES = ('low', 'medium', 'high')
+
+def validate_due_date(value):
+    """Срок задачи: пусто, дата YYYY-MM-DD или дата и время в формате ISO"""
+    if not value:
+        return None
+    value = str(value).strip()
+    if len(value) == 10:
+        datetime.date.fromisoformat(value)
+    else:
+        datetime.datetime.fromisoformat(value)
+    return value
+
+# ========== АНАЛИТИКА ==========
+
+ANALYTICS_PERCENTILES = (50, 90)
+ANALYTICS_PRIORITIES = ('low', 'medium', 'high')
+NO_DEPARTMENT = 'Без отдела'
+
+def load_numpy():
+    """Импортирует numpy при первом обращении; None, если пакет не установлен"""
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            return None
+        np = numpy
+    return np
+
+def analytics_round(value, digits=2):
+    value = float(value)
+    return None if math.isnan(value) or math.isinf(value) else round(value, digits)
+
+def group_percentiles(groups, values, n_groups, q):
+    """Процентиль q значений в каждой группе за одну сортировку (интерполяция как в np.percentile)"""
+    order = np.lexsort((values, groups))
+    sorted_values = values[order]
+    counts = np.bincount(groups, minlength=n_groups)
+    starts = np.cumsum(counts) - counts
+    result = np.full(n_groups, np.nan)
+    present = counts > 0
+    position = starts[present] + (counts[present] - 1) * q / 100
+    lower = np.floor(position).astype(np.int64)
+    upper = np.ceil(position).astype(np.int64)
+    result[present] = sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+    return result
+
+def distribution_summary(groups, values, labels):
+    """Число, среднее и процентили значений в целом и по группам"""
+    n = len(labels)
+    counts = np.bincount(groups, minlength=n)
+    sums = np.bincount(groups, weights=values, minlength=n)
+    percentiles = {q: group_percentiles(groups, values, n, q) for q in ANALYTICS_PERCENTILES}
+    overall = {'count': int(values.size)}
+    if values.size:
+        overall['mean'] = analytics_round(values.mean())
+        for q, value in zip(ANALYTICS_PERCENTILES, np.percentile(values, ANALYTICS_PERCENTILES)):
+            overall[f'p{q}'] = analytics_round(value)
+    by_group = {}
+    for i in np.flatnonzero(counts):
+        by_group[labels[i]] = {'count': int(counts[i]), 'mean': analytics_round(sums[i] / counts[i]),
+                               **{f'p{q}': analytics_round(percentiles[q][i]) for q in ANALYTICS_PERCENTILES}}
+    return {**overall, 'groups': by_group}
+
+def compute_workforce_analytics(reports, tasks, departments):
+    """Распределения и сравнения по колонкам отчетов и задач
+    
+    reports - массив (n, 4): сотрудник, день (дней от 1970-01-01), часы, выполнено задач;
+    tasks - массив (m, 3): сотрудник, индекс приоритета, часы от создания до завершения;
+    departments - отдел каждого сотрудника.
+    """
+    employee_ids = np.array(sorted(departments), dtype=np.int64)
+    labels = sorted({department or NO_DEPARTMENT for department in departments.values()} | {NO_DEPARTMENT})
+    employee_departments = np.array([labels.index(departments[e] or NO_DEPARTMENT) for e in employee_ids.tolist()],
+                                    dtype=np.int64)
+    
+    def department_of(employees):
+        if not employee_ids.size:
+            return np.full(employees.size, labels.index(NO_DEPARTMENT), dtype=np.int64)
+        index = np.clip(np.searchsorted(employee_ids, employees), 0, employee_ids.size - 1)
+        known = employee_ids[index] == employees
+        return np.where(known, employee_departments[index], labels.index(NO_DEPARTMENT))
+    
+    reports = reports[~np.isnan(reports).any(axis=1)]
+    employees = reports[:, 0].astype(np.int64)
+    days = reports[:, 1].astype(np.int64)
+    hours = reports[:, 2]
+    completed = reports[:, 3]
+    report_departments = department_of(employees)
+    
+    # Часы за день: несколько отчетов сотрудника за одну дату складываются
+    day_keys, day_index = np.unique(np.stack([employees, days], axis=1), axis=0, return_inverse=True)
+    day_hours = np.bincount(day_index.ravel(), weights=hours, minlength=len(day_keys))
+    hours_per_day = distribution_summary(department_of(day_keys[:, 0]) if len(day_keys) else
+                                         np.zeros(0, dtype=np.int64), day_hours, labels)
+    
+    # Время выполнения задач
+    tasks = tasks[~np.isnan(tasks).any(axis=1)]
+    tasks = tasks[tasks[:, 2] >= 0]
+    latency = tasks[:, 2]
+    completion_latency = distribution_summary(department_of(tasks[:, 0].astype(np.int64)), latency, labels)
+    completion_latency['priorities'] = distribution_summary(tasks[:, 1].astype(np.int64), latency,
+                                                            ANALYTICS_PRIORITIES)['groups']
+    
+    # Рейтинг отделов по эффективности (задачи на 100 часов, как в общей статистике)
+    department_hours = np.bincount(report_departments, weights=hours, minlength=len(labels))
+    department_tasks = np.bincount(report_departments, weights=completed, minlength=len(labels))
+    department_employees = np.bincount(department_of(np.unique(employees)), minlength=len(labels))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        efficiency = np.where(department_hours > 0, department_tasks / department_hours * 100, np.nan)
+    ranking = []
+    for rank, i in enumerate(np.argsort(-np.nan_to_num(efficiency, nan=-1.0), kind='stable'), start=1):
+        if department_hours[i] <= 0:
+            break
+        ranking.append({'rank': rank, 'department': labels[i], 'employees': int(department_employees[i]),
+                        'hours': analytics_round(department_hours[i]), 'tasks': int(department_tasks[i]),
+                        'efficiency': analytics_round(efficiency[i])})
+    
+    # Недели с понедельника: 1970-01-01 - четверг
+    weekly = []
+    if days.size:
+        weeks = (days + 3) // 7
+        first = weeks.min()
+        week_index = weeks - first
+        week_count = int(week_index.max()) + 1
+        week_hours = np.bincount(week_index, weights=hours, minlength=week_count)
+        week_tasks = np.bincount(week_index, weights=completed, minlength=week_count)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            week_efficiency = np.where(week_hours > 0, week_tasks / week_hours * 100, np.nan)
+            hours_change = np.full(week_count, np.nan)
+            tasks_change = np.full(week_count, np.nan)
+            hours_change[1:] = np.where(week_hours[:-1] > 0, (week_hours[1:] / week_hours[:-1] - 1) * 100, np.nan)
+            tasks_change[1:] = np.where(week_tasks[:-1] > 0, (week_tasks[1:] / week_tasks[:-1] - 1) * 100, np.nan)
+        week_starts = (np.arange(first, first + week_count) * 7 - 3).astype('datetime64[D]')
+        for i in range(week_count):
+            weekly.append({'week_start': str(week_starts[i]), 'hours': analytics_round(week_hours[i]),
+                           'tasks': int(week_tasks[i]), 'efficiency': analytics_round(week_efficiency[i]),
+                           'hours_change_pct': analytics_round(hours_change[i], 1),
+                           'tasks_change_pct': analytics_round(tasks_change[i], 1)})
+    
+    return {
+        'hours_per_day': hours_per_day,
+        'completion_latency_hours': completion_latency,
+        'departments': ranking,
+        'weekly': weekly
+    }
+
+# ========== ВРЕМЕННЫЕ РЯДЫ ==========
+
+TIMESERIES_METRICS = ('hours', 'reports', 'reported_tasks', 'completed_tasks')
+TIMESERIES_BUCKETS = {
+    'day': 'r.day',
+    'week': "date(r.day, '-6 days', 'weekday 1')",
+    'month': "date(r.day, 'start of month')"
+}
+
+def bucket_starts(bucket, date_from, date_to):
+    """Начала всех корзин периода, включая пустые"""
+    if bucket == 'month':
+        current = date_from.replace(day=1)
+    elif bucket == 'week':
+        current = date_from - datetime.timedelta(days=date_from.weekday())
+    else:
+        current = date_from
+    while current <= date_to:
+        yield current
+        if bucket == 'month':
+            current = (current + datetime.timedelta(days=32)).replace(day=1)
+        else:
+            current += datetime.timedelta(days=7 if bucket == 'week' else 1)
+
+def lttb(points, threshold):
+    """Прореживание ряда (x, y) до threshold точек с сохранением формы (Largest-Triangle-Three-Buckets)"""
+    n = len(points)
+    if threshold >= n or threshold < 3:
+        return points
+    sampled = [points[0]]
+    every = (n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        # Средняя точка следующей корзины - третья вершина треугольника
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        avg_x = sum(point[0] for point in points[next_start:next_end]) / (next_end - next_start)
+        avg_y = sum(point[1] for point in points[next_start:next_end]) / (next_end - next_start)
+        
+        ax, ay = points[a][0], points[a][1]
+        best, best_area = None, -1.0
+        for j in range(int(i * every) + 1, int((i + 1) * every) + 1):
+            area = abs((ax - avg_x) * (points[j][1] - ay) - (ax - points[j][0]) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        sampled.append(points[best])
+        a = best
+    sampled.append(points[-1])
+    return sampled
+
+# ========== ХРАНИЛИЩЕ ==========
+
+class SQLiteStorage:
+    """Хранилище в файле SQLite на диске"""
+    
+    _fallback_lock = threading.Lock()
+    
+    def __init__(self, path):
+        self.path = path
+    
+    def connect(self):
+        return sqlite3.connect(self.path)
+    
+    def exists(self):
+        return os.path.exists(self.path)
+    
+    def create(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+    
+    @contextlib.contextmanager
+    def lock(self):
+        """Исключительная блокировка базы между процессами (файл <база>.lock)
+        
+        Без fcntl (Windows) блокировка действует только внутри процесса.
+        """
+        if fcntl is None:
+            with self._fallback_lock:
+                yield
+            return
+        self.create()
+        with open(self.path + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+    
+    def related(self, name):
+        """Связанная база (например, архив месяца) в каталоге ARCHIVE_DIR рядом с основной"""
+        directory = os.path.join(os.path.dirname(self.path), app.config['ARCHIVE_DIR'])
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, f'{name}.db')
+    
+    @classmethod
+    def list_databases(cls, directory):
+        if not os.path.isdir(directory):
+            return []
+        return sorted(os.path.join(directory, filename) for filename in os.listdir(directory)
+                      if filename.endswith('.db'))
+    
+    @classmethod
+    def clear(cls):
+        pass
+
+class MemoryStorage:
+    """Хранилище в памяти процесса (VFS memdb) для тестов и нагрузочных прогонов
+    
+    Все соединения с одним путем видят одну базу; она живет, пока открыто
+    удерживающее соединение, то есть до clear() или завершения процесса.
+    """
+    
+    _keepers = {}
+    _lock = threading.Lock()
+    _init_lock = threading.Lock()
+    
+    def __init__(self, path):
+        self.path = path
+        # Абсолютный путь с двумя косыми чертами был бы принят за адрес хоста (file://tmp/...)
+        self.uri = f'file:/{path.lstrip("/")}?vfs=memdb'
+    
+    def connect(self):
+        self.create()
+        return sqlite3.connect(self.uri, uri=True)
+    
+    def exists(self):
+        return self.path in self._keepers
+    
+    def create(self):
+        with self._lock:
+            if self.path not in self._keepers:
+                self._keepers[self.path] = sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+    
+    def lock(self):
+        # База в памяти видна только своему процессу
+        return self._init_lock
+    
+    def related(self, name):
+        storage = MemoryStorage(os.path.join(os.path.dirname(self.path), app.config['ARCHIVE_DIR'], f'{name}.db'))
+        storage.create()
+        return storage.uri
+    
+    @classmethod
+    def list_databases(cls, directory):
+        return sorted(path for path in cls._keepers if os.path.dirname(path) == directory)
+    
+    @classmethod
+    def after_fork(cls):
+        cls._lock = threading.Lock()
+        cls._init_lock = threading.Lock()
+    
+    @classmethod
+    def clear(cls):
+        """Удаляет все базы в памяти"""
+        with cls._lock:
+            for conn in cls._keepers.values():
+                conn.close()
+            cls._keepers.clear()
+
+STORAGE_ENGINES = {
+    'sqlite': SQLiteStorage,
+    'memory': MemoryStorage
+}
+
+def make_storage(path):
+    return STORAGE_ENGINES[app.config['STORAGE_ENGINE']](path)
 
 # ========== БАЗА ДАННЫХ ==========
 
 class Database:
-    def __init__(self):
-        self.db_name = 'employees.db'
-        self.init_db()
+    def __init__(self, db_name='employees.db', seed=True):
+        self.db_name = db_name
+        self.storage = make_storage(db_name)
+        self.directory = EmployeeDirectory(self)
+        if self.get_schema_version() < SCHEMA_VERSION:
+            with self.storage.lock():
+                # Пока ждали блокировку, миграцию мог выполнить другой воркер
+                if self.get_schema_version() < SCHEMA_VERSION:
+                    self.init_db(seed)
+        # init_db выполняется только при миграции: наличие R*Tree определяем по схеме уже открытой базы
+        conn = self.get_connection()
+        self.has_rtree = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'geofence_index'").fetchone() is not None
+        conn.close()
+    
+    def get_schema_version(self):
+        conn = self.get_connection()
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        conn.close()
+        return version
     
     def get_connection(self):
-        conn = sqlite3.connect(self.db_name)
+        conn = self.storage.connect()
         conn.row_factory = sqlite3.Row
         return conn
     
-    def init_db(self):
+    def init_db(self, seed=True):
         conn = self.get_connection()
         c = conn.cursor()
         
@@ -79,6 +1109,7 @@ class Database:
                 due_date TIMESTAMP,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 completed_at TIMESTAMP,
+                overdue_at TIMESTAMP,
                 feedback TEXT,
                 rating INTEGER,
                 FOREIGN KEY (employee_id) REFERENCES employees (id) ON DELETE CASCADE,
@@ -109,18 +1140,327 @@ class Database:
                 subject TEXT,
                 content TEXT NOT NULL,
                 is_read INTEGER DEFAULT 0,
+                thread_id INTEGER,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (sender_id) REFERENCES users (id) ON DELETE CASCADE,
                 FOREIGN KEY (receiver_id) REFERENCES users (id) ON DELETE CASCADE
             )
         ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_messages_receiver_unread ON messages (receiver_id, is_read)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_messages_receiver ON messages (receiver_id, created_at)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages (sender_id, created_at)')
+        
+        # Диалоги: одна ветка на пару участников с денормализованной сводкой
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS message_threads (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_low INTEGER NOT NULL,
+                user_high INTEGER NOT NULL,
+                last_message_id INTEGER,
+                last_sender_id INTEGER,
+                last_subject TEXT,
+                last_preview TEXT,
+                last_message_at TIMESTAMP,
+                message_count INTEGER NOT NULL DEFAULT 0,
+                UNIQUE (user_low, user_high)
+            )
+        ''')
+        
+        # Участники диалогов: порядок в списке и непрочитанные по каждой ветке
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS thread_participants (
+                thread_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                other_user_id INTEGER NOT NULL,
+                unread INTEGER NOT NULL DEFAULT 0,
+                last_message_at TIMESTAMP,
+                PRIMARY KEY (thread_id, user_id),
+                FOREIGN KEY (thread_id) REFERENCES message_threads (id) ON DELETE CASCADE
+            )
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_thread_participants_user ON thread_participants (user_id, last_message_at)')
+        
+        # Счетчики непрочитанных сообщений, поддерживаемые при записи
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS unread_counters (
+                user_id INTEGER PRIMARY KEY,
+                unread INTEGER NOT NULL DEFAULT 0,
+                FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+            )
+        ''')
+        if c.execute('SELECT COUNT(*) FROM unread_counters').fetchone()[0] == 0:
+            c.execute('''
+                INSERT INTO unread_counters (user_id, unread)
+                SELECT receiver_id, COUNT(*) FROM messages WHERE is_read = 0 GROUP BY receiver_id
+            ''')
+        
+        # Таблица геозон (круги и полигоны)
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS geofences (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                kind TEXT NOT NULL DEFAULT 'circle',
+                center_lat REAL,
+                center_lon REAL,
+                radius_m REAL,
+                polygon TEXT,
+                min_lat REAL NOT NULL,
+                max_lat REAL NOT NULL,
+                min_lon REAL NOT NULL,
+                max_lon REAL NOT NULL,
+                enter_status TEXT,
+                exit_status TEXT,
+                task_id INTEGER,
+                enter_task_status TEXT,
+                is_active INTEGER DEFAULT 1,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (task_id) REFERENCES tasks (id) ON DELETE SET NULL
+            )
+        ''')
+        
+        # Пространственный индекс геозон (R*Tree), при его отсутствии - индекс по границам
+        try:
+            c.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS geofence_index
+                USING rtree(id, min_lat, max_lat, min_lon, max_lon)
+            ''')
+            self.has_rtree = True
+        except sqlite3.OperationalError:
+            c.execute('CREATE INDEX IF NOT EXISTS idx_geofences_bbox ON geofences (min_lat, max_lat, min_lon, max_lon)')
+            self.has_rtree = False
+        
+        # Текущее нахождение сотрудников внутри геозон
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS geofence_presence (
+                employee_id INTEGER NOT NULL,
+                geofence_id INTEGER NOT NULL,
+                entered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (employee_id, geofence_id)
+            )
+        ''')
+        
+        # События входа и выхода из геозон
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS geofence_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                geofence_id INTEGER NOT NULL,
+                employee_id INTEGER NOT NULL,
+                event_type TEXT NOT NULL,
+                latitude REAL,
+                longitude REAL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (geofence_id) REFERENCES geofences (id) ON DELETE CASCADE,
+                FOREIGN KEY (employee_id) REFERENCES employees (id) ON DELETE CASCADE
+            )
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_geofence_events_employee ON geofence_events (employee_id, created_at)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_geofence_events_geofence ON geofence_events (geofence_id, created_at)')
+        
+        # Буфер необработанных точек за текущие сутки (recorded_at - unix-время UTC)
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS location_points (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                employee_id INTEGER NOT NULL,
+                latitude REAL NOT NULL,
+                longitude REAL NOT NULL,
+                recorded_at INTEGER NOT NULL,
+                FOREIGN KEY (employee_id) REFERENCES employees (id) ON DELETE CASCADE
+            )
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_location_points_employee ON location_points (employee_id, recorded_at)')
+        
+        # Агрегаты тепловой карты: время пребывания по ячейкам тайлов всех уровней
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS heatmap_cells (
+                zoom INTEGER NOT NULL,
+                tile_x INTEGER NOT NULL,
+                tile_y INTEGER NOT NULL,
+                cell INTEGER NOT NULL,
+                weight REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (zoom, tile_x, tile_y, cell)
+            ) WITHOUT ROWID
+        ''')
+        
+        # Фоновые задания (отчеты, экспорт, массовые операции)
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued',
+                params TEXT,
+                progress REAL DEFAULT 0,
+                message TEXT,
+                result TEXT,
+                error TEXT,
+                cancel_requested INTEGER DEFAULT 0,
+                created_by INTEGER,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                started_at TIMESTAMP,
+                heartbeat_at TIMESTAMP,
+                finished_at TIMESTAMP,
+                expires_at TIMESTAMP,
+                FOREIGN KEY (created_by) REFERENCES users (id) ON DELETE SET NULL
+            )
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, heartbeat_at)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_jobs_expires ON jobs (expires_at)')
+        
+        # Журнал изменений данных: версия таблицы - id последней записи
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS data_changes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                row_id INTEGER,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_data_changes_name ON data_changes (name, id)')
+        
+        # Перечень помесячных архивных файлов и перенесенных в них таблиц
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS archive_files (
+                month TEXT NOT NULL,
+                table_name TEXT NOT NULL,
+                rows INTEGER NOT NULL DEFAULT 0,
+                archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (month, table_name)
+            )
+        ''')
+        
+        # Месяцы архива с сообщениями ветки и итоги архивированных строк по сотрудникам:
+        # ветки и общие счетчики не перебирают все архивы
+        rebuild_archive_indexes = not c.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'archived_totals'").fetchone()
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS thread_archive_months (
+                thread_id INTEGER NOT NULL,
+                month TEXT NOT NULL,
+                PRIMARY KEY (thread_id, month)
+            ) WITHOUT ROWID
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS archived_totals (
+                table_name TEXT NOT NULL,
+                employee_id INTEGER NOT NULL,
+                rows INTEGER NOT NULL DEFAULT 0,
+                hours REAL NOT NULL DEFAULT 0,
+                tasks_completed INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (table_name, employee_id)
+            ) WITHOUT ROWID
+        ''')
+        
+        # Итоги по сотруднику за день для графиков: пополняются при записи и не зависят от архивации
+        rebuild_rollups = not c.execute("SELECT 1 FROM sqlite_master WHERE name = 'daily_rollups'").fetchone()
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS daily_rollups (
+                day DATE NOT NULL,
+                employee_id INTEGER NOT NULL,
+                hours REAL NOT NULL DEFAULT 0,
+                reports INTEGER NOT NULL DEFAULT 0,
+                reported_tasks INTEGER NOT NULL DEFAULT 0,
+                completed_tasks INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, employee_id)
+            ) WITHOUT ROWID
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_daily_rollups_employee ON daily_rollups (employee_id, day)')
+        
+        # Смены статусов задач и накопительные показатели SLA
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS task_transitions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                task_id INTEGER NOT NULL,
+                employee_id INTEGER,
+                from_status TEXT,
+                to_status TEXT NOT NULL,
+                changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_task_transitions_task ON task_transitions (task_id, to_status)')
+        # Готовые данные панели сотрудника; триггеры удаляют запись при изменении
+        # его задач, отчетов или профиля, и при следующем чтении она строится заново
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS employee_dashboards (
+                employee_id INTEGER PRIMARY KEY,
+                payload TEXT NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        for table in ('tasks', 'work_reports'):
+            c.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_dashboard_insert AFTER INSERT ON {table}
+                BEGIN DELETE FROM employee_dashboards WHERE employee_id = NEW.employee_id; END
+            ''')
+            c.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_dashboard_update AFTER UPDATE ON {table}
+                BEGIN DELETE FROM employee_dashboards WHERE employee_id IN (OLD.employee_id, NEW.employee_id); END
+            ''')
+            c.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_dashboard_delete AFTER DELETE ON {table}
+                BEGIN DELETE FROM employee_dashboards WHERE employee_id = OLD.employee_id; END
+            ''')
+        # Координаты обновляются при каждой отметке, поэтому учитываются только поля панели
+        c.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_employees_dashboard_update AFTER UPDATE ON employees
+            WHEN OLD.name IS NOT NEW.name OR OLD.position IS NOT NEW.position
+              OR OLD.department IS NOT NEW.department OR OLD.location IS NOT NEW.location
+              OR OLD.status IS NOT NEW.status
+            BEGIN DELETE FROM employee_dashboards WHERE employee_id = NEW.id; END
+        ''')
+        c.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_employees_dashboard_delete AFTER DELETE ON employees
+            BEGIN DELETE FROM employee_dashboards WHERE employee_id = OLD.id; END
+        ''')
+        
+        rebuild_sla = not c.execute("SELECT 1 FROM sqlite_master WHERE name = 'sla_stats'").fetchone()
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS sla_stats (
+                dimension TEXT NOT NULL,
+                key TEXT NOT NULL,
+                started INTEGER NOT NULL DEFAULT 0,
+                start_s REAL NOT NULL DEFAULT 0,
+                start_max_s REAL NOT NULL DEFAULT 0,
+                completed INTEGER NOT NULL DEFAULT 0,
+                complete_s REAL NOT NULL DEFAULT 0,
+                complete_max_s REAL NOT NULL DEFAULT 0,
+                due INTEGER NOT NULL DEFAULT 0,
+                on_time INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (dimension, key)
+            ) WITHOUT ROWID
+        ''')
+        
+        # Сжатые треки: упрощенные и дельта-кодированные точки за сутки
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS location_trails (
+                employee_id INTEGER NOT NULL,
+                day DATE NOT NULL,
+                start_ts INTEGER NOT NULL,
+                end_ts INTEGER NOT NULL,
+                raw_count INTEGER NOT NULL,
+                point_count INTEGER NOT NULL,
+                data BLOB NOT NULL,
+                PRIMARY KEY (employee_id, day),
+                FOREIGN KEY (employee_id) REFERENCES employees (id) ON DELETE CASCADE
+            )
+        ''')
         
         # Проверяем существующие таблицы и добавляем отсутствующие колонки
+        # (отдельное соединение - предыдущие изменения должны быть зафиксированы)
+        conn.commit()
         self.update_table_structure()
         
+        c.execute('CREATE INDEX IF NOT EXISTS idx_messages_thread ON messages (thread_id, id)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_messages_sender_id ON messages (sender_id, id)')
+        # Частичный индекс: только открытые задачи со сроком, еще не отмеченные просроченными
+        c.execute(f'CREATE INDEX IF NOT EXISTS idx_tasks_open_deadline ON tasks ({TASK_DEADLINE_SQL}) WHERE {OPEN_TASK_SQL}')
+        if c.execute('SELECT 1 FROM messages WHERE thread_id IS NULL LIMIT 1').fetchone():
+            self.rebuild_message_threads(conn)
+        
         # Проверяем, есть ли администратор
+        # Результат читается всегда: незавершенный SELECT удерживал бы блокировку чтения,
+        # и пересчеты ниже (отдельные соединения) не смогли бы записать в новую базу без seed
         c.execute("SELECT COUNT(*) FROM users WHERE role = 'admin'")
-        if c.fetchone()[0] == 0:
+        has_admin = c.fetchone()[0] > 0
+        if seed and not has_admin:
             # Создаем администратора по умолчанию
             admin_password = self.hash_password('admin123')
             c.execute('''
@@ -193,6 +1533,15 @@ class Database:
                     VALUES (?, ?, ?, ?, ?)
                 ''', report)
         
+        conn.commit()
+        if rebuild_rollups:
+            self.rebuild_daily_rollups()
+        if rebuild_sla:
+            self.rebuild_sla_stats()
+        if rebuild_archive_indexes:
+            self.rebuild_archive_indexes()
+        
+        c.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
         conn.commit()
         conn.close()
     
@@ -218,16 +1567,82 @@ class Database:
             if 'current_task' not in columns:
                 c.execute("ALTER TABLE employees ADD COLUMN current_task TEXT")
                 print("✓ Добавлена колонка current_task в таблицу employees")
-                
-        except Exception as e:
-            print(f"Ошибка при обновлении структуры таблиц: {e}")
+            
+            c.execute("PRAGMA table_info(messages)")
+            columns = [col[1] for col in c.fetchall()]
+            
+            if 'thread_id' not in columns:
+                c.execute("ALTER TABLE messages ADD COLUMN thread_id INTEGER")
+                print("✓ Добавлена колонка thread_id в таблицу messages")
+            
+            c.execute("PRAGMA table_info(tasks)")
+            columns = [col[1] for col in c.fetchall()]
+            
+            if 'overdue_at' not in columns:
+                c.execute("ALTER TABLE tasks ADD COLUMN overdue_at TIMESTAMP")
+                print("✓ Добавлена колонка overdue_at в таблицу tasks")
+                
+        except Exception as e:
+            print(f"Ошибка при обновлении структуры таблиц: {e}")
         
         conn.commit()
         conn.close()
     
+    def log_data_change(self, conn, name, row_id=None):
+        """Записывает изменение в журнал в рамках текущей транзакции, увеличивая версию данных"""
+        change_id = conn.execute('INSERT INTO data_changes (name, row_id) VALUES (?, ?)',
+                                 (name, row_id)).lastrowid
+        keep = app.config['DATA_CHANGES_KEEP']
+        if change_id % 1000 == 0 and change_id > keep:
+            conn.execute('DELETE FROM data_changes WHERE id <= ?', (change_id - keep,))
+        return change_id
+    
+    def get_data_version(self, name, conn=None):
+        """Версия данных: id последней записи журнала для имени или кортежа имен"""
+        names = (name,) if isinstance(name, str) else tuple(name)
+        own = conn is None
+        if own:
+            conn = self.get_connection()
+        version = conn.execute(f'''
+            SELECT COALESCE(MAX(id), 0) FROM data_changes WHERE name IN ({",".join("?" * len(names))})
+        ''', names).fetchone()[0]
+        if own:
+            conn.close()
+        return version
+    
+    def get_data_versions(self, names):
+        """Версии нескольких наборов данных одним запросом"""
+        names = tuple(names)
+        conn = self.get_connection()
+        rows = conn.execute(f'''
+            SELECT name, MAX(id) FROM data_changes
+            WHERE name IN ({",".join("?" * len(names))}) GROUP BY name
+        ''', names).fetchall()
+        conn.close()
+        versions = dict.fromkeys(names, 0)
+        versions.update({row[0]: row[1] for row in rows})
+        return versions
+    
     def hash_password(self, password):
         """Хеширование пароля"""
-        return hashlib.sha256(password.encode()).hexdigest()
+        return passwords.hash(password)
+    
+    def verify_password(self, password, stored_hash, user_id=None):
+        """Проверка пароля; устаревшие хеши пользователя прозрачно обновляются"""
+        ok, needs_rehash = passwords.verify(password, stored_hash)
+        if ok and needs_rehash and user_id is not None:
+            try:
+                new_hash = self.hash_password(password)
+            except PasswordQueueFull:
+                # Перехеширование необязательно: выполнится при следующем входе
+                return ok
+            conn = self.get_connection()
+            conn.execute('UPDATE users SET password = ? WHERE id = ? AND password = ?',
+                         (new_hash, user_id, stored_hash))
+            conn.commit()
+            conn.close()
+            passwords.record_rehash()
+        return ok
     
     # ========== АУТЕНТИФИКАЦИЯ ==========
     
@@ -242,12 +1657,13 @@ class Database:
         ''', (username,)).fetchone()
         conn.close()
         
-        if user and user['password'] == self.hash_password(password):
+        if user and self.verify_password(password, user['password'], user['id']):
             return dict(user)
         return None
     
-    def register_user(self, username, password, email, role='employee', employee_id=None):
-        """Регистрация нового пользователя"""
+    def register_user(self, username, password, email, role='employee', employee_id=None, password_hash=None):
+        """Регистрация нового пользователя; password_hash - заранее вычисленный хеш пароля"""
+        password_hash = password_hash or self.hash_password(password)
         try:
             conn = self.get_connection()
             cursor = conn.cursor()
@@ -255,7 +1671,7 @@ class Database:
             cursor.execute('''
                 INSERT INTO users (username, password, email, role, employee_id)
                 VALUES (?, ?, ?, ?, ?)
-            ''', (username, self.hash_password(password), email, role, employee_id))
+            ''', (username, password_hash, email, role, employee_id))
             
             conn.commit()
             user_id = cursor.lastrowid
@@ -267,16 +1683,10 @@ class Database:
     # ========== СОТРУДНИКИ ==========
     
     def get_all_employees(self):
-        conn = self.get_connection()
-        employees = conn.execute('SELECT * FROM employees ORDER BY name').fetchall()
-        conn.close()
-        return employees
+        return self.directory.all()
     
     def get_employee_by_id(self, id):
-        conn = self.get_connection()
-        employee = conn.execute('SELECT * FROM employees WHERE id = ?', (id,)).fetchone()
-        conn.close()
-        return employee
+        return self.directory.get(id)
     
     def get_employee_by_user_id(self, user_id):
         conn = self.get_connection()
@@ -325,9 +1735,11 @@ class Database:
                 data.get('status', 'active')
             ))
         
-        conn.commit()
         employee_id = cursor.lastrowid
+        self.log_data_change(conn, 'employees', employee_id)
+        conn.commit()
         conn.close()
+        self.directory.invalidate()
         return employee_id
     
     def update_employee(self, id, data):
@@ -372,17 +1784,45 @@ class Database:
                 id
             ))
         
+        self.log_data_change(conn, 'employees', id)
         conn.commit()
         conn.close()
+        self.directory.invalidate()
     
     def delete_employee(self, id):
         conn = self.get_connection()
         conn.execute('DELETE FROM employees WHERE id = ?', (id,))
+        self.log_data_change(conn, 'employees', id)
         conn.commit()
         conn.close()
+        self.directory.invalidate()
+    
+    def iter_rows(self, query, params=(), chunk_size=None):
+        """Постраничное чтение результата запроса без загрузки всех строк в память"""
+        chunk_size = chunk_size or app.config['STREAM_CHUNK_ROWS']
+        conn = self.get_connection()
+        try:
+            cursor = conn.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            conn.close()
     
     # ========== ЗАДАЧИ ==========
     
+    def iter_tasks(self, employee_id=None):
+        query = '''
+            SELECT t.*, e.name as employee_name
+            FROM tasks t 
+            LEFT JOIN employees e ON t.employee_id = e.id 
+        '''
+        if employee_id:
+            return self.iter_rows(query + ' WHERE t.employee_id = ? ORDER BY t.due_date', (employee_id,))
+        return self.iter_rows(query + ' ORDER BY t.due_date')
+    
     def get_all_tasks(self, employee_id=None):
         conn = self.get_connection()
         if employee_id:
@@ -430,13 +1870,18 @@ class Database:
             'pending'
         ))
         
-        conn.commit()
         task_id = cursor.lastrowid
+        self.log_data_change(conn, 'tasks', task_id)
+        conn.commit()
         conn.close()
         return task_id
     
     def update_task_status(self, id, status, feedback=None):
+        if status not in TASK_STATUSES:
+            raise ValueError(f'Недопустимый статус: {status}')
         conn = self.get_connection()
+        completed_before = self._completed_task_days(conn, [id])
+        statuses_before = self._task_statuses(conn, [id])
         
         if status == 'completed':
             conn.execute('''
@@ -451,12 +1896,178 @@ class Database:
                 WHERE id = ?
             ''', (status, feedback, id))
         
+        self._update_completion_rollups(conn, completed_before, self._completed_task_days(conn, [id]))
+        self._record_task_transitions(conn, statuses_before)
+        self.log_data_change(conn, 'tasks', id)
+        conn.commit()
+        conn.close()
+    
+    def add_tasks(self, items, manager_id=None, atomic=True):
+        """Пакетное создание задач одной транзакцией
+        
+        Возвращает результат для каждого элемента: id созданной задачи или ошибку.
+        При atomic=True ошибка в любом элементе отменяет весь пакет.
+        """
+        conn = self.get_connection()
+        employee_ids = {str(item.get('employee_id')) for item in items}
+        known = {str(row[0]) for row in conn.execute(
+            f'SELECT id FROM employees WHERE id IN ({",".join("?" * len(employee_ids))})',
+            list(employee_ids)).fetchall()} if employee_ids else set()
+        
+        results, rows = [], []
+        for index, item in enumerate(items):
+            error = None
+            title = (item.get('title') or '').strip()
+            priority = item.get('priority') or 'medium'
+            due_date = None
+            if not title:
+                error = 'Не указано название задачи'
+            elif str(item.get('employee_id')) not in known:
+                error = f'Сотрудник {item.get("employee_id")} не найден'
+            elif priority not in TASK_PRIORITIES:
+                error = f'Недопустимый приоритет: {priority}'
+            else:
+                try:
+                    due_date = validate_due_date(item.get('due_date'))
+                except ValueError:
+                    error = f'Недопустимый срок: {item.get("due_date")}'
+            if error:
+                results.append({'index': index, 'success': False, 'error': error})
+            else:
+                results.append({'index': index, 'success': True})
+                rows.append((title, item.get('description', ''), int(item['employee_id']), manager_id,
+                             priority, due_date))
+        
+        if not rows or (atomic and len(rows) < len(items)):
+            conn.close()
+            return self._reject_batch(results) if rows else results
+        
+        cursor = conn.cursor()
+        cursor.executemany('''
+            INSERT INTO tasks (title, description, employee_id, manager_id, priority, due_date, status)
+            VALUES (?, ?, ?, ?, ?, ?, 'pending')
+        ''', rows)
+        # Вставки под блокировкой записи дают непрерывный диапазон id
+        task_id = cursor.execute('SELECT MAX(id) FROM tasks').fetchone()[0] - len(rows) + 1
+        for result in results:
+            if result['success']:
+                result['id'] = task_id
+                task_id += 1
+        self.log_data_change(conn, 'tasks')
+        conn.commit()
+        conn.close()
+        return results
+    
+    def update_tasks_status(self, items, atomic=True):
+        """Пакетная смена статусов задач одной транзакцией; элементы: {'id', 'status', 'feedback'}"""
+        conn = self.get_connection()
+        task_ids = {str(item.get('id')) for item in items}
+        known = {str(row[0]) for row in conn.execute(
+            f'SELECT id FROM tasks WHERE id IN ({",".join("?" * len(task_ids))})',
+            list(task_ids)).fetchall()} if task_ids else set()
+        
+        results, rows = [], []
+        for index, item in enumerate(items):
+            if str(item.get('id')) not in known:
+                results.append({'index': index, 'id': item.get('id'), 'success': False,
+                                'error': 'Задача не найдена'})
+            elif item.get('status') not in TASK_STATUSES:
+                results.append({'index': index, 'id': item.get('id'), 'success': False,
+                                'error': f'Недопустимый статус: {item.get("status")}'})
+            else:
+                results.append({'index': index, 'id': int(item['id']), 'success': True})
+                rows.append((item['status'], item.get('feedback'), int(item['id'])))
+        
+        if rows and not (atomic and len(rows) < len(items)):
+            ids = [row[2] for row in rows]
+            completed_before = self._completed_task_days(conn, ids)
+            statuses_before = self._task_statuses(conn, ids)
+            conn.executemany('''
+                UPDATE tasks SET
+                    status = ?1,
+                    completed_at = CASE WHEN ?1 = 'completed' THEN CURRENT_TIMESTAMP END,
+                    feedback = COALESCE(?2, feedback)
+                WHERE id = ?3
+            ''', rows)
+            self._update_completion_rollups(conn, completed_before, self._completed_task_days(conn, ids))
+            self._record_task_transitions(conn, statuses_before)
+            self.log_data_change(conn, 'tasks')
+            conn.commit()
+        elif rows:
+            self._reject_batch(results)
+        conn.close()
+        return results
+    
+    @staticmethod
+    def _reject_batch(results):
+        """Отмененный атомарный пакет: корректные элементы тоже не применены"""
+        for result in results:
+            if result['success']:
+                result.update(success=False, error='batch rejected')
+        return results
+    
+    def get_next_task_deadline(self):
+        """Ближайший срок среди открытых задач (одно чтение из частичного индекса)"""
+        conn = self.get_connection()
+        row = conn.execute(f'SELECT MIN({TASK_DEADLINE_SQL}) FROM tasks WHERE {OPEN_TASK_SQL}').fetchone()
+        conn.close()
+        return row[0]
+    
+    def escalate_overdue_tasks(self, now, limit):
+        """Отмечает просроченными до limit задач со сроком раньше now и уведомляет исполнителей
+        
+        Отметка и сообщения пишутся одной транзакцией; условие overdue_at IS NULL
+        не дает двум процессам эскалировать одну задачу дважды.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        tasks = cursor.execute(f'''
+            UPDATE tasks SET overdue_at = ?
+            WHERE id IN (
+                SELECT id FROM tasks
+                WHERE {OPEN_TASK_SQL} AND {TASK_DEADLINE_SQL} < ?
+                ORDER BY {TASK_DEADLINE_SQL} LIMIT ?
+            )
+            RETURNING id, title, employee_id, manager_id, due_date
+        ''', (now, now, limit)).fetchall()
+        if not tasks:
+            conn.commit()
+            conn.close()
+            return 0
+        
+        admin = cursor.execute("SELECT MIN(id) FROM users WHERE role = 'admin'").fetchone()[0]
+        employee_ids = sorted({task['employee_id'] for task in tasks})
+        users = dict(cursor.execute(f'''
+            SELECT employee_id, id FROM users WHERE employee_id IN ({",".join("?" * len(employee_ids))})
+        ''', employee_ids).fetchall())
+        
+        messages = []
+        for task in tasks:
+            receiver_id = users.get(task['employee_id'])
+            sender_id = task['manager_id'] or admin
+            if receiver_id and sender_id and receiver_id != sender_id:
+                messages.append((sender_id, receiver_id, f'Просрочена задача: {task["title"]}',
+                                 f'Срок выполнения задачи «{task["title"]}» истек {task["due_date"][:10]}. '
+                                 f'Сообщите о статусе выполнения.'))
+        if admin:
+            titles = '\n'.join(f'• {task["title"]} (срок {task["due_date"][:10]})' for task in tasks[:50])
+            more = f'\n...и еще {len(tasks) - 50}' if len(tasks) > 50 else ''
+            for (other_admin,) in cursor.execute("SELECT id FROM users WHERE role = 'admin' AND id != ?",
+                                                 (admin,)).fetchall():
+                messages.append((admin, other_admin, f'Просрочено задач: {len(tasks)}', titles + more))
+        self._insert_messages(cursor, messages)
+        
+        self.log_data_change(conn, 'tasks')
         conn.commit()
         conn.close()
+        return len(tasks)
     
     def delete_task(self, id):
         conn = self.get_connection()
+        completed_before = self._completed_task_days(conn, [id])
         conn.execute('DELETE FROM tasks WHERE id = ?', (id,))
+        self._update_completion_rollups(conn, completed_before, {})
+        self.log_data_change(conn, 'tasks', id)
         conn.commit()
         conn.close()
     
@@ -471,33 +2082,263 @@ class Database:
             VALUES (?, ?, ?, ?, ?)
         ''', (employee_id, date, hours_worked, tasks_completed, description))
         
-        conn.commit()
         report_id = cursor.lastrowid
+        cursor.execute('''
+            INSERT INTO daily_rollups (day, employee_id, hours, reports, reported_tasks)
+            VALUES (date(?), ?, ?, 1, ?)
+            ON CONFLICT (day, employee_id) DO UPDATE SET
+                hours = hours + excluded.hours,
+                reports = reports + 1,
+                reported_tasks = reported_tasks + excluded.reported_tasks
+        ''', (date, employee_id, hours_worked or 0, tasks_completed or 0))
+        self.log_data_change(conn, 'work_reports', report_id)
+        conn.commit()
         conn.close()
         return report_id
     
-    def get_work_reports(self, employee_id=None):
+    # ========== ДНЕВНЫЕ ИТОГИ ==========
+    
+    def _completed_task_days(self, conn, task_ids):
+        """{id задачи: (сотрудник, день завершения)} для завершенных задач из списка"""
+        if not task_ids:
+            return {}
+        return {row[0]: (row[1], row[2]) for row in conn.execute(f'''
+            SELECT id, employee_id, date(completed_at) FROM tasks
+            WHERE id IN ({",".join("?" * len(task_ids))}) AND status = 'completed' AND completed_at IS NOT NULL
+        ''', list(task_ids)).fetchall()}
+    
+    def _update_completion_rollups(self, conn, before, after):
+        """Переносит отметки завершения в дневных итогах по состояниям задач до и после записи"""
+        deltas = {}
+        for task_id, key in before.items():
+            if after.get(task_id) != key:
+                deltas[key] = deltas.get(key, 0) - 1
+        for task_id, key in after.items():
+            if before.get(task_id) != key:
+                deltas[key] = deltas.get(key, 0) + 1
+        conn.executemany('''
+            INSERT INTO daily_rollups (day, employee_id, completed_tasks) VALUES (?, ?, ?)
+            ON CONFLICT (day, employee_id) DO UPDATE SET completed_tasks = completed_tasks + excluded.completed_tasks
+        ''', [(day, employee_id, delta) for (employee_id, day), delta in deltas.items() if delta])
+    
+    def rebuild_daily_rollups(self):
+        """Пересчитывает дневные итоги по отчетам и завершенным задачам, включая архивы"""
+        totals = {}
+        for employee_id, day, hours, reports, reported_tasks in self.iter_with_archives('work_reports', '''
+            SELECT employee_id, date(date), SUM(hours_worked), COUNT(*), SUM(tasks_completed)
+            FROM {source} wr
+            WHERE date(date) IS NOT NULL
+            GROUP BY employee_id, date(date)
+        ''', (), '0000-01'):
+            item = totals.setdefault((day, employee_id), [0, 0, 0, 0])
+            item[0] += hours or 0
+            item[1] += reports
+            item[2] += reported_tasks or 0
+        for employee_id, day, completed in self.iter_with_archives('tasks', '''
+            SELECT employee_id, date(completed_at), COUNT(*)
+            FROM {source} t
+            WHERE status = 'completed' AND date(completed_at) IS NOT NULL
+            GROUP BY employee_id, date(completed_at)
+        ''', (), '0000-01'):
+            totals.setdefault((day, employee_id), [0, 0, 0, 0])[3] += completed
+        
+        conn = self.get_connection()
+        conn.execute('DELETE FROM daily_rollups')
+        conn.executemany('''
+            INSERT INTO daily_rollups (day, employee_id, hours, reports, reported_tasks, completed_tasks)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', [(day, employee_id, *values) for (day, employee_id), values in totals.items()])
+        conn.commit()
+        conn.close()
+        return len(totals)
+    
+    # ========== SLA ЗАДАЧ ==========
+    
+    def _task_statuses(self, conn, task_ids):
+        if not task_ids:
+            return {}
+        return dict(conn.execute(f'SELECT id, status FROM tasks WHERE id IN ({",".join("?" * len(task_ids))})',
+                                 list(task_ids)).fetchall())
+    
+    def _record_task_transitions(self, conn, statuses_before):
+        """Записывает смены статусов и обновляет показатели SLA по первому началу и первому завершению"""
+        ids = list(statuses_before)
+        if not ids:
+            return
+        placeholders = ','.join('?' * len(ids))
+        tasks = conn.execute(f'''
+            SELECT t.id, t.employee_id, t.status, t.priority, e.department,
+                   (julianday(CURRENT_TIMESTAMP) - julianday(t.created_at)) * 86400 AS age_s,
+                   CASE WHEN t.due_date IS NOT NULL AND t.due_date != '' THEN {TASK_DEADLINE_SQL} END AS deadline,
+                   {TASK_COMPLETED_LOCAL_SQL} AS completed_local
+            FROM tasks t LEFT JOIN employees e ON e.id = t.employee_id
+            WHERE t.id IN ({placeholders})
+        ''', ids).fetchall()
+        changed = [task for task in tasks if task['status'] != statuses_before[task['id']]]
+        if not changed:
+            return
+        seen = {tuple(row) for row in conn.execute(f'''
+            SELECT DISTINCT task_id, to_status FROM task_transitions
+            WHERE task_id IN ({placeholders}) AND to_status IN ('in_progress', 'completed')
+        ''', ids)}
+        conn.executemany('''
+            INSERT INTO task_transitions (task_id, employee_id, from_status, to_status) VALUES (?, ?, ?, ?)
+        ''', [(task['id'], task['employee_id'], statuses_before[task['id']], task['status']) for task in changed])
+        
+        stats = []
+        for task in changed:
+            if task['status'] not in ('in_progress', 'completed') or (task['id'], task['status']) in seen:
+                continue
+            age = max(task['age_s'] or 0, 0)
+            if task['status'] == 'in_progress':
+                delta = (1, age, 0, 0, 0, 0)
+            else:
+                on_time = 1 if task['deadline'] and task['completed_local'] <= task['deadline'] else 0
+                delta = (0, 0, 1, age, 1 if task['deadline'] else 0, on_time)
+            stats.extend(self._sla_rows(task, delta))
+        self._add_sla_stats(conn, stats)
+    
+    def _sla_rows(self, task, delta):
+        return [(dimension, key, *delta) for dimension, key in (
+            ('all', ''),
+            ('employee', str(task['employee_id'])),
+            ('department', task['department'] or NO_DEPARTMENT),
+            ('priority', task['priority'] or 'medium')
+        )]
+    
+    def _add_sla_stats(self, conn, rows):
+        conn.executemany('''
+            INSERT INTO sla_stats (dimension, key, started, start_s, start_max_s,
+                                   completed, complete_s, complete_max_s, due, on_time)
+            VALUES (?1, ?2, ?3, ?4, ?4, ?5, ?6, ?6, ?7, ?8)
+            ON CONFLICT (dimension, key) DO UPDATE SET
+                started = started + excluded.started,
+                start_s = start_s + excluded.start_s,
+                start_max_s = MAX(start_max_s, excluded.start_max_s),
+                completed = completed + excluded.completed,
+                complete_s = complete_s + excluded.complete_s,
+                complete_max_s = MAX(complete_max_s, excluded.complete_max_s),
+                due = due + excluded.due,
+                on_time = on_time + excluded.on_time
+        ''', rows)
+    
+    def rebuild_sla_stats(self):
+        """Пересчитывает показатели SLA: завершения - по задачам (включая архивы), начала - по журналу смен"""
+        rows = []
+        for task in self.iter_with_archives('tasks', f'''
+            SELECT t.id, t.employee_id, t.priority, e.department,
+                   (julianday(t.completed_at) - julianday(t.created_at)) * 86400 AS age_s,
+                   CASE WHEN t.due_date IS NOT NULL AND t.due_date != '' THEN {TASK_DEADLINE_SQL} END AS deadline,
+                   {TASK_COMPLETED_LOCAL_SQL} AS completed_local
+            FROM {{source}} t LEFT JOIN employees e ON e.id = t.employee_id
+            WHERE t.status = 'completed' AND t.completed_at IS NOT NULL
+        ''', (), '0000-01'):
+            on_time = 1 if task['deadline'] and task['completed_local'] <= task['deadline'] else 0
+            rows.extend(self._sla_rows(task, (0, 0, 1, max(task['age_s'] or 0, 0),
+                                              1 if task['deadline'] else 0, on_time)))
+        
+        conn = self.get_connection()
+        for task in conn.execute('''
+            SELECT tr.task_id, t.employee_id, t.priority, e.department,
+                   (julianday(MIN(tr.changed_at)) - julianday(t.created_at)) * 86400 AS age_s
+            FROM task_transitions tr
+            JOIN tasks t ON t.id = tr.task_id
+            LEFT JOIN employees e ON e.id = t.employee_id
+            WHERE tr.to_status = 'in_progress'
+            GROUP BY tr.task_id
+        ''').fetchall():
+            rows.extend(self._sla_rows(task, (1, max(task['age_s'] or 0, 0), 0, 0, 0, 0)))
+        conn.execute('DELETE FROM sla_stats')
+        self._add_sla_stats(conn, rows)
+        conn.commit()
+        conn.close()
+    
+    def get_sla_stats(self, dimension):
+        conn = self.get_connection()
+        rows = conn.execute('SELECT * FROM sla_stats WHERE dimension = ? ORDER BY key', (dimension,)).fetchall()
+        conn.close()
+        return rows
+    
+    def get_task_transitions(self, task_id):
         conn = self.get_connection()
+        transitions = conn.execute('''
+            SELECT * FROM task_transitions WHERE task_id = ? ORDER BY id
+        ''', (task_id,)).fetchall()
+        conn.close()
+        return transitions
+    
+    def get_rollup_series(self, metric, bucket, date_from, date_to, employee_id=None, department=None):
+        """Сумма метрики по корзинам (день, неделя с понедельника, месяц) из дневных итогов"""
+        bucket_sql = TIMESERIES_BUCKETS[bucket]
+        conditions, params = ['r.day >= ?', 'r.day <= ?'], [date_from, date_to]
+        join = ''
         if employee_id:
-            reports = conn.execute('''
-                SELECT wr.*, e.name as employee_name 
-                FROM work_reports wr
-                JOIN employees e ON wr.employee_id = e.id
-                WHERE wr.employee_id = ?
-                ORDER BY wr.date DESC
-            ''', (employee_id,)).fetchall()
-        else:
-            reports = conn.execute('''
-                SELECT wr.*, e.name as employee_name 
-                FROM work_reports wr
-                JOIN employees e ON wr.employee_id = e.id
-                ORDER BY wr.date DESC
-            ''').fetchall()
+            conditions.append('r.employee_id = ?')
+            params.append(employee_id)
+        if department:
+            join = 'JOIN employees e ON e.id = r.employee_id'
+            conditions.append('e.department = ?')
+            params.append(department)
+        conn = self.get_connection()
+        rows = conn.execute(f'''
+            SELECT {bucket_sql} AS bucket, SUM(r.{metric})
+            FROM daily_rollups r {join}
+            WHERE {' AND '.join(conditions)}
+            GROUP BY bucket
+        ''', params).fetchall()
         conn.close()
-        return reports
+        return {row[0]: row[1] for row in rows}
+    
+    def _work_reports_filter(self, employee_id=None, date_from=None, date_to=None):
+        conditions, params = ['1'], []
+        if employee_id:
+            conditions.append('wr.employee_id = ?')
+            params.append(employee_id)
+        if date_from:
+            conditions.append('wr.date >= ?')
+            params.append(date_from)
+        if date_to:
+            conditions.append('wr.date <= ?')
+            params.append(date_to)
+        return ' AND '.join(conditions), params
     
-    def register_user_with_employee(self, username, password, email, role='employee', employee_id=None):
+    def iter_work_reports(self, employee_id=None, date_from=None, date_to=None):
+        """Отчеты от новых к старым; с date_from в выборку входят и архивы периода"""
+        where, params = self._work_reports_filter(employee_id, date_from, date_to)
+        return self.iter_with_archives('work_reports', f'''
+            SELECT wr.*, e.name as employee_name 
+            FROM {{source}} wr
+            JOIN employees e ON wr.employee_id = e.id
+            WHERE {where}
+            ORDER BY wr.date DESC, wr.id DESC
+        ''', params, date_from, date_to, key=lambda row: (row['date'], row['id']), reverse=True)
+    
+    def get_work_reports_summary(self, date_from=None, date_to=None):
+        where, params = self._work_reports_filter(None, date_from, date_to)
+        summary = {'total_reports': 0, 'total_hours': 0, 'total_tasks': 0, 'employees': 0}
+        employees = set()
+        # Группировка по сотруднику позволяет сложить итоги нескольких групп архивов
+        for row in self.iter_with_archives('work_reports', f'''
+            SELECT wr.employee_id, COUNT(*), COALESCE(SUM(wr.hours_worked), 0), COALESCE(SUM(wr.tasks_completed), 0)
+            FROM {{source}} wr
+            JOIN employees e ON wr.employee_id = e.id
+            WHERE {where}
+            GROUP BY wr.employee_id
+        ''', params, date_from, date_to):
+            employees.add(row[0])
+            summary['total_reports'] += row[1]
+            summary['total_hours'] += row[2]
+            summary['total_tasks'] += row[3]
+        summary['employees'] = len(employees)
+        return summary
+    
+    def get_work_reports(self, employee_id=None, date_from=None, date_to=None):
+        return list(self.iter_work_reports(employee_id, date_from, date_to))
+    
+    def register_user_with_employee(self, username, password, email, role='employee', employee_id=None,
+                                    password_hash=None):
         """Регистрация пользователя с проверкой"""
+        password_hash = password_hash or self.hash_password(password)
         try:
             conn = self.get_connection()
             cursor = conn.cursor()
@@ -505,7 +2346,7 @@ class Database:
             cursor.execute('''
                 INSERT INTO users (username, password, email, role, employee_id)
                 VALUES (?, ?, ?, ?, ?)
-            ''', (username, self.hash_password(password), email, role, employee_id))
+            ''', (username, password_hash, email, role, employee_id))
             
             conn.commit()
             user_id = cursor.lastrowid
@@ -540,16 +2381,85 @@ class Database:
     def send_message(self, sender_id, receiver_id, subject, content):
         conn = self.get_connection()
         cursor = conn.cursor()
+        message_id = self._insert_messages(cursor, [(sender_id, int(receiver_id), subject, content)])
+        conn.commit()
+        conn.close()
+        return message_id
+    
+    def _insert_messages(self, cursor, messages):
+        """Вставляет сообщения (отправитель, получатель, тема, текст) с ветками и счетчиками
         
-        cursor.execute('''
-            INSERT INTO messages (sender_id, receiver_id, subject, content)
-            VALUES (?, ?, ?, ?)
-        ''', (sender_id, receiver_id, subject, content))
+        Возвращает id последнего сообщения.
+        """
+        if not messages:
+            return None
+        cursor.executemany('''
+            INSERT OR IGNORE INTO message_threads (user_low, user_high) VALUES (?, ?)
+        ''', sorted({(min(sender_id, receiver_id), max(sender_id, receiver_id))
+                     for sender_id, receiver_id, _, _ in messages}))
+        cursor.executemany('''
+            INSERT INTO messages (sender_id, receiver_id, subject, content, thread_id)
+            VALUES (?1, ?2, ?3, ?4, (SELECT id FROM message_threads
+                                      WHERE user_low = MIN(?1, ?2) AND user_high = MAX(?1, ?2)))
+        ''', messages)
+        # Вставки под блокировкой записи дают непрерывный диапазон id
+        last_id = cursor.execute('SELECT MAX(id) FROM messages').fetchone()[0]
+        unread = {}
+        for _, receiver_id, _, _ in messages:
+            unread[receiver_id] = unread.get(receiver_id, 0) + 1
+        cursor.executemany('''
+            INSERT INTO unread_counters (user_id, unread) VALUES (?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET unread = unread + excluded.unread
+        ''', list(unread.items()))
+        self._update_thread_summaries(cursor, last_id - len(messages) + 1, last_id)
+        return last_id
+    
+    def send_broadcast(self, sender_id, subject, content, department=None, role=None, user_ids=None):
+        """Рассылка одного сообщения отделу, роли или списку пользователей одним запросом"""
+        conditions = ['u.id != ?']
+        params = [sender_id]
+        if department:
+            conditions.append('e.department = ?')
+            params.append(department)
+        if role:
+            conditions.append('u.role = ?')
+            params.append(role)
+        if user_ids:
+            conditions.append(f'u.id IN ({",".join("?" * len(user_ids))})')
+            params.extend(int(uid) for uid in user_ids)
+        if len(conditions) == 1:
+            raise ValueError('Не указаны получатели рассылки')
+        recipients = f'''
+            SELECT u.id FROM users u
+            LEFT JOIN employees e ON u.employee_id = e.id
+            WHERE {' AND '.join(conditions)}
+        '''
+        
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            INSERT OR IGNORE INTO message_threads (user_low, user_high)
+            SELECT MIN(?, id), MAX(?, id) FROM ({recipients})
+        ''', (sender_id, sender_id, *params))
+        cursor.execute(f'''
+            INSERT INTO messages (sender_id, receiver_id, subject, content, thread_id)
+            SELECT ?, r.id, ?, ?, t.id FROM ({recipients}) r
+            JOIN message_threads t ON t.user_low = MIN(?, r.id) AND t.user_high = MAX(?, r.id)
+        ''', (sender_id, subject, content, *params, sender_id, sender_id))
+        sent = cursor.rowcount
+        last_id = cursor.lastrowid
+        cursor.execute(f'''
+            INSERT INTO unread_counters (user_id, unread)
+            SELECT id, 1 FROM ({recipients}) WHERE true
+            ON CONFLICT (user_id) DO UPDATE SET unread = unread + 1
+        ''', params)
+        if sent:
+            # Вставка одним оператором под блокировкой записи дает непрерывный диапазон id
+            self._update_thread_summaries(cursor, last_id - sent + 1, last_id)
         
         conn.commit()
-        message_id = cursor.lastrowid
         conn.close()
-        return message_id
+        return sent
     
     def get_messages(self, user_id, inbox=True):
         conn = self.get_connection()
@@ -572,12 +2482,403 @@ class Database:
         conn.close()
         return messages
     
-    def mark_message_as_read(self, message_id):
+    def get_sent_messages(self, user_id, before_id=None, limit=50):
+        """Страница отправленных сообщений, от новых к старым (курсор по id)"""
+        conn = self.get_connection()
+        messages = conn.execute('''
+            SELECT m.*, u2.username as receiver_name
+            FROM messages m
+            JOIN users u2 ON m.receiver_id = u2.id
+            WHERE m.sender_id = ? AND m.id < ?
+            ORDER BY m.id DESC
+            LIMIT ?
+        ''', (user_id, before_id or 2 ** 63 - 1, limit)).fetchall()
+        conn.close()
+        return messages
+    
+    def get_unread_count(self, user_id):
+        conn = self.get_connection()
+        row = conn.execute('SELECT unread FROM unread_counters WHERE user_id = ?', (user_id,)).fetchone()
+        conn.close()
+        return row['unread'] if row else 0
+    
+    def mark_message_as_read(self, message_id, user_id=None):
+        """Отметка сообщения прочитанным; возвращает True, если статус изменился"""
+        conn = self.get_connection()
+        if user_id is None:
+            row = conn.execute('SELECT receiver_id FROM messages WHERE id = ?', (message_id,)).fetchone()
+            user_id = row['receiver_id'] if row else None
+        changed = self._mark_read(conn, user_id, [message_id]) if user_id is not None else 0
+        conn.commit()
+        conn.close()
+        return changed > 0
+    
+    def mark_messages_as_read(self, user_id, message_ids=None):
+        """Массовая отметка входящих прочитанными (все, если список не задан)"""
+        conn = self.get_connection()
+        changed = self._mark_read(conn, user_id, message_ids)
+        conn.commit()
+        conn.close()
+        return changed
+    
+    def _mark_read(self, conn, user_id, message_ids=None, thread_id=None):
+        condition = 'receiver_id = ? AND is_read = 0'
+        params = [user_id]
+        if message_ids is not None:
+            if not message_ids:
+                return 0
+            condition += f' AND id IN ({",".join("?" * len(message_ids))})'
+            params.extend(int(mid) for mid in message_ids)
+        if thread_id is not None:
+            condition += ' AND thread_id = ?'
+            params.append(thread_id)
+        
+        per_thread = conn.execute(f'''
+            SELECT thread_id, COUNT(*) FROM messages WHERE {condition} GROUP BY thread_id
+        ''', params).fetchall()
+        changed = conn.execute(f'UPDATE messages SET is_read = 1 WHERE {condition}', params).rowcount
+        if changed:
+            conn.execute('UPDATE unread_counters SET unread = MAX(unread - ?, 0) WHERE user_id = ?',
+                         (changed, user_id))
+            conn.executemany('''
+                UPDATE thread_participants SET unread = MAX(unread - ?, 0)
+                WHERE thread_id = ? AND user_id = ?
+            ''', [(count, tid, user_id) for tid, count in per_thread if tid is not None])
+        return changed
+    
+    # ========== ДИАЛОГИ ==========
+    
+    def _update_thread_summaries(self, cursor, first_id, last_id):
+        """Обновляет сводки веток и участников для сообщений с id в диапазоне"""
+        new_messages = f'SELECT * FROM messages WHERE id BETWEEN {int(first_id)} AND {int(last_id)}'
+        cursor.execute(f'''
+            UPDATE message_threads SET
+                message_count = message_count + (
+                    SELECT COUNT(*) FROM ({new_messages}) m WHERE m.thread_id = message_threads.id),
+                last_message_id = (
+                    SELECT MAX(id) FROM ({new_messages}) m WHERE m.thread_id = message_threads.id)
+            WHERE id IN (SELECT thread_id FROM ({new_messages}))
+        ''')
+        cursor.execute(f'''
+            UPDATE message_threads SET
+                last_sender_id = (SELECT sender_id FROM messages WHERE id = last_message_id),
+                last_subject = (SELECT subject FROM messages WHERE id = last_message_id),
+                last_preview = (SELECT SUBSTR(content, 1, 100) FROM messages WHERE id = last_message_id),
+                last_message_at = (SELECT created_at FROM messages WHERE id = last_message_id)
+            WHERE id IN (SELECT thread_id FROM ({new_messages}))
+        ''')
+        cursor.execute(f'''
+            INSERT INTO thread_participants (thread_id, user_id, other_user_id, unread, last_message_at)
+            SELECT thread_id, sender_id, receiver_id, 0, created_at FROM ({new_messages}) WHERE true
+            ON CONFLICT (thread_id, user_id) DO UPDATE SET last_message_at = excluded.last_message_at
+        ''')
+        cursor.execute(f'''
+            INSERT INTO thread_participants (thread_id, user_id, other_user_id, unread, last_message_at)
+            SELECT thread_id, receiver_id, sender_id, COUNT(*), MAX(created_at)
+            FROM ({new_messages}) WHERE true GROUP BY thread_id, receiver_id
+            ON CONFLICT (thread_id, user_id) DO UPDATE SET
+                unread = unread + excluded.unread,
+                last_message_at = excluded.last_message_at
+        ''')
+    
+    def rebuild_message_threads(self, conn):
+        """Распределяет сообщения без ветки по диалогам и пересчитывает сводки"""
+        conn.execute('''
+            INSERT OR IGNORE INTO message_threads (user_low, user_high)
+            SELECT DISTINCT MIN(sender_id, receiver_id), MAX(sender_id, receiver_id) FROM messages
+        ''')
+        conn.execute('''
+            UPDATE messages SET thread_id = (
+                SELECT id FROM message_threads
+                WHERE user_low = MIN(messages.sender_id, messages.receiver_id)
+                  AND user_high = MAX(messages.sender_id, messages.receiver_id))
+            WHERE thread_id IS NULL
+        ''')
+        conn.execute('''
+            UPDATE message_threads SET
+                message_count = (SELECT COUNT(*) FROM messages WHERE thread_id = message_threads.id),
+                last_message_id = (SELECT MAX(id) FROM messages WHERE thread_id = message_threads.id)
+        ''')
+        conn.execute('''
+            UPDATE message_threads SET
+                last_sender_id = (SELECT sender_id FROM messages WHERE id = last_message_id),
+                last_subject = (SELECT subject FROM messages WHERE id = last_message_id),
+                last_preview = (SELECT SUBSTR(content, 1, 100) FROM messages WHERE id = last_message_id),
+                last_message_at = (SELECT created_at FROM messages WHERE id = last_message_id)
+        ''')
+        conn.execute('DELETE FROM thread_participants')
+        conn.execute('''
+            INSERT INTO thread_participants (thread_id, user_id, other_user_id, unread, last_message_at)
+            SELECT t.id, t.user_low, t.user_high,
+                   (SELECT COUNT(*) FROM messages m
+                    WHERE m.thread_id = t.id AND m.receiver_id = t.user_low AND m.is_read = 0),
+                   t.last_message_at
+            FROM message_threads t
+            UNION ALL
+            SELECT t.id, t.user_high, t.user_low,
+                   (SELECT COUNT(*) FROM messages m
+                    WHERE m.thread_id = t.id AND m.receiver_id = t.user_high AND m.is_read = 0),
+                   t.last_message_at
+            FROM message_threads t WHERE t.user_high != t.user_low
+        ''')
+    
+    def get_threads(self, user_id, limit=20, offset=0):
+        """Список диалогов пользователя с превью последнего сообщения"""
+        conn = self.get_connection()
+        threads = conn.execute('''
+            SELECT t.*, tp.unread, tp.other_user_id, u.username as other_name
+            FROM thread_participants tp
+            JOIN message_threads t ON t.id = tp.thread_id
+            LEFT JOIN users u ON u.id = tp.other_user_id
+            WHERE tp.user_id = ?
+            ORDER BY tp.last_message_at DESC, tp.thread_id DESC
+            LIMIT ? OFFSET ?
+        ''', (user_id, limit, offset)).fetchall()
+        conn.close()
+        return threads
+    
+    def get_thread(self, thread_id, user_id):
+        """Ветка диалога, если пользователь является ее участником"""
+        conn = self.get_connection()
+        thread = conn.execute('''
+            SELECT t.*, tp.unread, tp.other_user_id, u.username as other_name
+            FROM thread_participants tp
+            JOIN message_threads t ON t.id = tp.thread_id
+            LEFT JOIN users u ON u.id = tp.other_user_id
+            WHERE tp.thread_id = ? AND tp.user_id = ?
+        ''', (thread_id, user_id)).fetchone()
+        conn.close()
+        return thread
+    
+    def get_thread_messages(self, thread_id, before_id=None, limit=50):
+        """Страница сообщений ветки, от новых к старым (курсор по id); продолжается в архивах"""
+        query = '''
+            SELECT m.*, u.username as sender_name
+            FROM {source} m
+            JOIN users u ON m.sender_id = u.id
+            WHERE m.thread_id = ? AND m.id < ?
+            ORDER BY m.id DESC
+            LIMIT ?
+        '''
+        before_id = before_id or 2 ** 63 - 1
+        conn = self.get_connection()
+        messages = conn.execute(query.format(source='messages'), (thread_id, before_id, limit)).fetchall()
+        conn.close()
+        
+        months = self.get_thread_archive_months(thread_id) if len(messages) < limit else []
+        for month in months:
+            if messages:
+                before_id = messages[-1]['id']
+            messages += self._iter_archive_query('messages', query, (thread_id, before_id, limit - len(messages)),
+                                                 [month], include_main=False)
+            if len(messages) >= limit:
+                break
+        return messages
+    
+    def mark_thread_as_read(self, thread_id, user_id):
+        conn = self.get_connection()
+        changed = self._mark_read(conn, user_id, thread_id=thread_id)
+        conn.commit()
+        conn.close()
+        return changed
+    
+    # ========== АРХИВ ==========
+    
+    def archive_path(self, month):
+        """Архив месяца: archive/employees_2024-01.db рядом с основной базой"""
+        stem = os.path.splitext(os.path.basename(self.db_name))[0]
+        return self.storage.related(f'{stem}_{month}')
+    
+    def get_archive_files(self):
+        conn = self.get_connection()
+        files = conn.execute('SELECT * FROM archive_files ORDER BY month DESC, table_name').fetchall()
+        conn.close()
+        return files
+    
+    def get_archive_months(self, table, date_from=None, date_to=None):
+        """Месяцы с архивом таблицы в периоде, от новых к старым
+        
+        Без date_from архивы не подключаются: запросы без периода читают только
+        оперативные данные за последние ARCHIVE_AFTER_DAYS дней.
+        """
+        if not date_from:
+            return []
+        conn = self.get_connection()
+        months = [row[0] for row in conn.execute('''
+            SELECT month FROM archive_files
+            WHERE table_name = ? AND month >= ? AND month <= ?
+            ORDER BY month DESC
+        ''', (table, str(date_from)[:7], str(date_to or '9999-12')[:7])).fetchall()]
+        conn.close()
+        return months
+    
+    def get_thread_archive_months(self, thread_id):
+        """Месяцы архива, в которых есть сообщения ветки, от новых к старым"""
+        conn = self.get_connection()
+        months = [row[0] for row in conn.execute('''
+            SELECT month FROM thread_archive_months WHERE thread_id = ? ORDER BY month DESC
+        ''', (thread_id,))]
+        conn.close()
+        return months
+    
+    def _add_archived_totals(self, conn, table, rows):
+        conn.executemany('''
+            INSERT INTO archived_totals (table_name, employee_id, rows, hours, tasks_completed)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (table_name, employee_id) DO UPDATE SET
+                rows = rows + excluded.rows,
+                hours = hours + excluded.hours,
+                tasks_completed = tasks_completed + excluded.tasks_completed
+        ''', [(table, *row) for row in rows])
+    
+    def rebuild_archive_indexes(self):
+        """Пересчитывает месяцы веток и итоги по сотрудникам по уже существующим архивам"""
         conn = self.get_connection()
-        conn.execute('UPDATE messages SET is_read = 1 WHERE id = ?', (message_id,))
+        conn.execute('DELETE FROM thread_archive_months')
+        conn.execute('DELETE FROM archived_totals')
+        months = conn.execute('SELECT month, table_name FROM archive_files').fetchall()
+        for month, table in months:
+            if table == 'messages':
+                conn.executemany('INSERT OR IGNORE INTO thread_archive_months (thread_id, month) VALUES (?, ?)',
+                                 [(row[0], month) for row in self._iter_archive_query(table, '''
+                                     SELECT DISTINCT thread_id FROM {source} m WHERE thread_id IS NOT NULL
+                                 ''', (), [month], include_main=False)])
+            elif table in ARCHIVE_TOTALS_SQL:
+                self._add_archived_totals(conn, table, [tuple(row) for row in self._iter_archive_query(table, f'''
+                    SELECT employee_id, {ARCHIVE_TOTALS_SQL[table]} FROM {{source}} a GROUP BY employee_id
+                ''', (), [month], include_main=False)])
         conn.commit()
         conn.close()
     
+    def get_archived_totals(self, conn, employee_id=None):
+        """Итоги архивированных строк: {таблица: (строк, часов, выполнено задач)}"""
+        condition, params = ('WHERE employee_id = ?', (employee_id,)) if employee_id is not None else ('', ())
+        totals = {table: (0, 0, 0) for table in ARCHIVE_TOTALS_SQL}
+        for row in conn.execute(f'''
+            SELECT table_name, SUM(rows), SUM(hours), SUM(tasks_completed) FROM archived_totals
+            {condition} GROUP BY table_name
+        ''', params):
+            totals[row[0]] = (row[1], row[2], row[3])
+        return totals
+    
+    def _attach_archives(self, conn, table, months, include_main=True):
+        """Подключает архивы месяцев и возвращает подзапрос UNION ALL по таблице
+        
+        Колонки, добавленные после создания архива, читаются из него как NULL.
+        """
+        columns = [col[1] for col in conn.execute(f'PRAGMA main.table_info({table})').fetchall()]
+        parts = [f'SELECT {", ".join(columns)} FROM main.{table}'] if include_main else []
+        for month in months:
+            alias = 'archive_' + month.replace('-', '_')
+            conn.execute(f'ATTACH DATABASE ? AS {alias}', (self.archive_path(month),))
+            existing = {col[1] for col in conn.execute(f'PRAGMA {alias}.table_info({table})').fetchall()}
+            if existing:
+                selected = ', '.join(col if col in existing else f'NULL AS {col}' for col in columns)
+                parts.append(f'SELECT {selected} FROM {alias}.{table}')
+        if not parts:
+            parts.append(f'SELECT {", ".join(columns)} FROM main.{table} WHERE 0')
+        return '(' + ' UNION ALL '.join(parts) + ')'
+    
+    def _iter_archive_query(self, table, query, params, months, include_main=True):
+        conn = self.get_connection()
+        try:
+            source = self._attach_archives(conn, table, months, include_main)
+            cursor = conn.execute(query.format(source=source), params)
+            while True:
+                rows = cursor.fetchmany(app.config['STREAM_CHUNK_ROWS'])
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            conn.close()
+    
+    def iter_with_archives(self, table, query, params=(), date_from=None, date_to=None, key=None, reverse=False):
+        """Выполняет query, где {source} - таблица вместе с архивами периода
+        
+        Если архивов больше ARCHIVE_ATTACH_MAX, запрос выполняется по группам архивов,
+        а упорядоченные по key результаты групп сливаются.
+        """
+        months = self.get_archive_months(table, date_from, date_to)
+        size = app.config['ARCHIVE_ATTACH_MAX']
+        groups = [months[i:i + size] for i in range(0, len(months), size)] or [[]]
+        streams = [self._iter_archive_query(table, query, params, group, include_main=(i == 0))
+                   for i, group in enumerate(groups)]
+        if len(streams) == 1:
+            return streams[0]
+        if key is None:
+            return (row for stream in streams for row in stream)
+        return heapq.merge(*streams, key=key, reverse=reverse)
+    
+    def _ensure_archive_table(self, conn, table, column):
+        """Создает таблицу в подключенном архиве archive_target или добавляет новые колонки"""
+        info = conn.execute(f'PRAGMA main.table_info({table})').fetchall()
+        existing = {col[1] for col in conn.execute(f'PRAGMA archive_target.table_info({table})').fetchall()}
+        if not existing:
+            definitions = ', '.join(f'{col[1]} {col[2]}' + (' PRIMARY KEY' if col[5] else '') for col in info)
+            conn.execute(f'CREATE TABLE archive_target.{table} ({definitions})')
+            conn.execute(f'CREATE INDEX archive_target.idx_{table}_{column} ON {table} ({column})')
+        for col in info:
+            if existing and col[1] not in existing:
+                conn.execute(f'ALTER TABLE archive_target.{table} ADD COLUMN {col[1]} {col[2]}')
+        return ', '.join(col[1] for col in info)
+    
+    def archive_old_data(self, before=None, progress=None):
+        """Переносит строки старше before в помесячные архивы; возвращает число строк по таблицам
+        
+        Каждый месяц переносится одной транзакцией по основной базе и файлу архива.
+        """
+        before = before or (datetime.date.today() - datetime.timedelta(days=app.config['ARCHIVE_AFTER_DAYS'])).isoformat()
+        moved = {table: 0 for table in ARCHIVE_TABLES}
+        
+        conn = self.get_connection()
+        try:
+            for n, (table, (column, condition)) in enumerate(ARCHIVE_TABLES.items()):
+                where = f'{column} < ? AND {condition}'
+                months = [row[0] for row in conn.execute(
+                    f'SELECT DISTINCT substr({column}, 1, 7) FROM {table} WHERE {where}', (before,)).fetchall()]
+                for month in months:
+                    if not ARCHIVE_MONTH_RE.match(month or ''):
+                        continue
+                    month_where = f'{where} AND substr({column}, 1, 7) = ?'
+                    conn.execute('ATTACH DATABASE ? AS archive_target', (self.archive_path(month),))
+                    try:
+                        columns = self._ensure_archive_table(conn, table, column)
+                        conn.execute(f'''
+                            INSERT OR REPLACE INTO archive_target.{table} ({columns})
+                            SELECT {columns} FROM main.{table} WHERE {month_where}
+                        ''', (before, month))
+                        if table == 'messages':
+                            conn.execute(f'''
+                                INSERT OR IGNORE INTO thread_archive_months (thread_id, month)
+                                SELECT DISTINCT thread_id, ? FROM main.messages
+                                WHERE {month_where} AND thread_id IS NOT NULL
+                            ''', (month, before, month))
+                        elif table in ARCHIVE_TOTALS_SQL:
+                            self._add_archived_totals(conn, table, [tuple(row) for row in conn.execute(f'''
+                                SELECT employee_id, {ARCHIVE_TOTALS_SQL[table]} FROM main.{table}
+                                WHERE {month_where} GROUP BY employee_id
+                            ''', (before, month))])
+                        count = conn.execute(f'DELETE FROM main.{table} WHERE {month_where}',
+                                             (before, month)).rowcount
+                        conn.execute('''
+                            INSERT INTO archive_files (month, table_name, rows) VALUES (?, ?, ?)
+                            ON CONFLICT (month, table_name) DO UPDATE SET
+                                rows = rows + excluded.rows, archived_at = CURRENT_TIMESTAMP
+                        ''', (month, table, count))
+                        self.log_data_change(conn, table)
+                        conn.commit()
+                    except Exception:
+                        conn.rollback()
+                        raise
+                    finally:
+                        conn.execute('DETACH DATABASE archive_target')
+                    moved[table] += count
+                if progress:
+                    progress(n + 1, len(ARCHIVE_TABLES))
+        finally:
+            conn.close()
+        return moved
+    
     # ========== СТАТИСТИКА ==========
     
     def get_stats(self):
@@ -593,9 +2894,19 @@ class Database:
             'total_reports': conn.execute("SELECT COUNT(*) FROM work_reports").fetchone()[0]
         }
         
-        # Расчет эффективности
-        total_hours = conn.execute("SELECT SUM(hours_worked) FROM work_reports").fetchone()[0] or 0
-        total_tasks_completed = conn.execute("SELECT SUM(tasks_completed) FROM work_reports").fetchone()[0] or 0
+        # Перенесенные в архив задачи (только завершенные) и отчеты входят в общие итоги
+        archived = self.get_archived_totals(conn)
+        stats['total_tasks'] += archived['tasks'][0]
+        stats['tasks_completed'] += archived['tasks'][0]
+        stats['total_reports'] += archived['work_reports'][0]
+        
+        # Расчет эффективности; составляющие возвращаются, чтобы эффективность можно было пересчитать по сумме
+        total_hours = (conn.execute("SELECT SUM(hours_worked) FROM work_reports").fetchone()[0] or 0) + \
+            archived['work_reports'][1]
+        total_tasks_completed = (conn.execute("SELECT SUM(tasks_completed) FROM work_reports").fetchone()[0] or 0) + \
+            archived['work_reports'][2]
+        stats['total_hours'] = total_hours
+        stats['total_tasks_completed'] = total_tasks_completed
         
         if total_hours > 0:
             stats['efficiency'] = round((total_tasks_completed / total_hours) * 100, 2)
@@ -605,71 +2916,1443 @@ class Database:
         conn.close()
         return stats
     
+    def get_analytics_columns(self, date_from, date_to):
+        """Колонки для аналитики одним проходом: отчеты за период и завершенные за период задачи"""
+        reports = np.array([tuple(row) for row in self.iter_with_archives('work_reports', '''
+            SELECT wr.employee_id, CAST(julianday(wr.date) - 2440587.5 AS INTEGER),
+                   COALESCE(wr.hours_worked, 0), COALESCE(wr.tasks_completed, 0)
+            FROM {source} wr
+            WHERE wr.date >= ? AND wr.date <= ?
+        ''', (date_from, date_to), date_from, date_to)], dtype=float).reshape(-1, 4)
+        priorities = ' '.join(f"WHEN '{name}' THEN {i}" for i, name in enumerate(ANALYTICS_PRIORITIES))
+        tasks = np.array([tuple(row) for row in self.iter_with_archives('tasks', f'''
+            SELECT t.employee_id, CASE t.priority {priorities} ELSE 1 END,
+                   (julianday(t.completed_at) - julianday(t.created_at)) * 24
+            FROM {{source}} t
+            WHERE t.status = 'completed' AND t.completed_at >= ? AND t.completed_at < date(?, '+1 day')
+        ''', (date_from, date_to), date_from, date_to)], dtype=float).reshape(-1, 3)
+        departments = {emp.id: emp.department for emp in self.directory.all()}
+        return reports, tasks, departments
+    
     def get_employee_stats(self, employee_id):
         conn = self.get_connection()
+        stats = self._employee_stats(conn, employee_id)
+        conn.close()
+        return stats
+    
+    def _employee_stats(self, conn, employee_id):
+        """Итоги сотрудника за все время, включая перенесенные в архив задачи и отчеты"""
+        tasks = conn.execute('''
+            SELECT COUNT(*), COALESCE(SUM(status = 'pending'), 0), COALESCE(SUM(status = 'completed'), 0)
+            FROM tasks WHERE employee_id = ?
+        ''', (employee_id,)).fetchone()
+        reports = conn.execute('''
+            SELECT COUNT(*), COALESCE(SUM(hours_worked), 0), COALESCE(SUM(tasks_completed), 0)
+            FROM work_reports WHERE employee_id = ?
+        ''', (employee_id,)).fetchone()
+        archived = self.get_archived_totals(conn, employee_id)
+        total_reports = reports[0] + archived['work_reports'][0]
+        return {
+            'total_tasks': tasks[0] + archived['tasks'][0],
+            'tasks_pending': tasks[1],
+            'tasks_completed': tasks[2] + archived['tasks'][0],
+            'total_reports': total_reports,
+            'total_hours': reports[1] + archived['work_reports'][1],
+            'avg_tasks_per_day': (reports[2] + archived['work_reports'][2]) / total_reports if total_reports else 0
+        }
+    
+    # ========== ПАНЕЛЬ СОТРУДНИКА ==========
+    
+    def _build_employee_dashboard(self, conn, employee_id):
+        employee = conn.execute('''
+            SELECT id, name, position, department, location, status FROM employees WHERE id = ?
+        ''', (employee_id,)).fetchone()
+        if not employee:
+            return None
+        return {
+            'employee': dict(employee),
+            'stats': self._employee_stats(conn, employee_id),
+            'tasks': [dict(row) for row in conn.execute('''
+                SELECT id, title, status, due_date FROM tasks
+                WHERE employee_id = ? ORDER BY due_date LIMIT 5
+            ''', (employee_id,))],
+            'recent_reports': [dict(row) for row in conn.execute('''
+                SELECT id, date, hours_worked, tasks_completed, description FROM work_reports
+                WHERE employee_id = ? ORDER BY date DESC, id DESC LIMIT 3
+            ''', (employee_id,))]
+        }
+    
+    def refresh_employee_dashboard(self, employee_id, conn=None):
+        """Строит и сохраняет панель сотрудника
+        
+        Чтение и запись идут в одной транзакции записи, чтобы параллельное изменение,
+        удалившее запись триггером, не было перекрыто устаревшими данными.
+        """
+        own = conn is None
+        if own:
+            conn = self.get_connection()
+        conn.execute('BEGIN IMMEDIATE')
+        payload = self._build_employee_dashboard(conn, employee_id)
+        if payload is not None:
+            conn.execute('''
+                INSERT OR REPLACE INTO employee_dashboards (employee_id, payload) VALUES (?, ?)
+            ''', (employee_id, json.dumps(payload, ensure_ascii=False)))
+        conn.commit()
+        if own:
+            conn.close()
+        return payload
+    
+    def get_employee_dashboard(self, user_id):
+        """Панель сотрудника по пользователю одним чтением по ключу; None, если профиля нет"""
+        conn = self.get_connection()
+        row = conn.execute('''
+            SELECT u.employee_id, d.payload FROM users u
+            LEFT JOIN employee_dashboards d ON d.employee_id = u.employee_id
+            WHERE u.id = ?
+        ''', (user_id,)).fetchone()
+        if not row or row['employee_id'] is None:
+            payload = None
+        elif row['payload'] is not None:
+            payload = json.loads(row['payload'])
+        else:
+            payload = self.refresh_employee_dashboard(row['employee_id'], conn)
+        conn.close()
+        return payload
+    
+    def refresh_employee_dashboards(self, progress=None):
+        """Заранее строит недостающие панели сотрудников с учетными записями"""
+        conn = self.get_connection()
+        employee_ids = [row[0] for row in conn.execute('''
+            SELECT DISTINCT u.employee_id FROM users u
+            JOIN employees e ON e.id = u.employee_id
+            LEFT JOIN employee_dashboards d ON d.employee_id = u.employee_id
+            WHERE u.employee_id IS NOT NULL AND d.employee_id IS NULL
+        ''')]
+        for i, employee_id in enumerate(employee_ids):
+            if progress:
+                progress(i, len(employee_ids))
+            self.refresh_employee_dashboard(employee_id, conn)
+        conn.close()
+        return len(employee_ids)
+    
+    # ========== ГЕОЗОНЫ ==========
+    
+    def add_geofence(self, data):
+        """Создание геозоны (круг или полигон)"""
+        kind = data.get('kind', 'circle')
+        if kind == 'circle':
+            center_lat = float(data['center_lat'])
+            center_lon = float(data['center_lon'])
+            radius_m = float(data['radius_m'])
+            if radius_m <= 0:
+                raise ValueError('Радиус геозоны должен быть положительным')
+            polygon = None
+            bbox = geofence_bbox(kind, center_lat, center_lon, radius_m)
+        elif kind == 'polygon':
+            polygon = [[float(lat), float(lon)] for lat, lon in data['polygon']]
+            if len(polygon) < 3:
+                raise ValueError('Полигон должен содержать не менее трех точек')
+            center_lat = center_lon = radius_m = None
+            bbox = geofence_bbox(kind, polygon=polygon)
+        else:
+            raise ValueError(f'Неизвестный тип геозоны: {kind}')
+        
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO geofences (name, kind, center_lat, center_lon, radius_m, polygon,
+                                   min_lat, max_lat, min_lon, max_lon,
+                                   enter_status, exit_status, task_id, enter_task_status)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            data['name'],
+            kind,
+            center_lat,
+            center_lon,
+            radius_m,
+            json.dumps(polygon) if polygon else None,
+            *bbox,
+            data.get('enter_status'),
+            data.get('exit_status'),
+            data.get('task_id'),
+            data.get('enter_task_status')
+        ))
+        geofence_id = cursor.lastrowid
+        if self.has_rtree:
+            cursor.execute('''
+                INSERT INTO geofence_index (id, min_lat, max_lat, min_lon, max_lon)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (geofence_id, *bbox))
+        
+        conn.commit()
+        conn.close()
+        return geofence_id
+    
+    def get_geofences(self):
+        conn = self.get_connection()
+        geofences = conn.execute('SELECT * FROM geofences ORDER BY name').fetchall()
+        conn.close()
+        return geofences
+    
+    def delete_geofence(self, id):
+        conn = self.get_connection()
+        conn.execute('DELETE FROM geofences WHERE id = ?', (id,))
+        conn.execute('DELETE FROM geofence_presence WHERE geofence_id = ?', (id,))
+        if self.has_rtree:
+            conn.execute('DELETE FROM geofence_index WHERE id = ?', (id,))
+        conn.commit()
+        conn.close()
+    
+    def get_geofence_events(self, employee_id=None, geofence_id=None, limit=100):
+        conn = self.get_connection()
+        query = '''
+            SELECT ge.*, g.name as geofence_name, e.name as employee_name
+            FROM geofence_events ge
+            JOIN geofences g ON ge.geofence_id = g.id
+            LEFT JOIN employees e ON ge.employee_id = e.id
+            WHERE 1 = 1
+        '''
+        params = []
+        if employee_id:
+            query += ' AND ge.employee_id = ?'
+            params.append(employee_id)
+        if geofence_id:
+            query += ' AND ge.geofence_id = ?'
+            params.append(geofence_id)
+        query += ' ORDER BY ge.created_at DESC, ge.id DESC LIMIT ?'
+        params.append(limit)
+        events = conn.execute(query, params).fetchall()
+        conn.close()
+        return events
+    
+    def update_location(self, employee_id, latitude, longitude, location='', recorded_at=None):
+        """Обновление местоположения сотрудника с проверкой геозон и записью трека"""
+        conn = self.get_connection()
+        try:
+            conn.execute('''
+                UPDATE employees 
+                SET latitude = ?, longitude = ?, location = ?
+                WHERE id = ?
+            ''', (latitude, longitude, location, employee_id))
+            
+            events = []
+            if latitude is not None and longitude is not None:
+                recorded_at = int(recorded_at or time.time())
+                events = self._evaluate_geofences(conn, employee_id, float(latitude), float(longitude))
+                self._add_heatmap_point(conn, employee_id, float(latitude), float(longitude), recorded_at)
+                self._record_trail_point(conn, employee_id, float(latitude), float(longitude), recorded_at)
+            
+            self.log_data_change(conn, 'employee_locations', employee_id)
+            conn.commit()
+        finally:
+            # Незафиксированная транзакция откатывается при закрытии
+            conn.close()
+        self.directory.invalidate()
+        return events
+    
+    def _evaluate_geofences(self, conn, employee_id, lat, lon):
+        """Инкрементальная проверка геозон для новой точки: фиксирует входы и выходы"""
+        # Предварительный отбор кандидатов по ограничивающим прямоугольникам
+        if self.has_rtree:
+            candidates = conn.execute('''
+                SELECT g.* FROM geofence_index gi
+                JOIN geofences g ON g.id = gi.id
+                WHERE gi.min_lat <= ? AND gi.max_lat >= ? AND gi.min_lon <= ? AND gi.max_lon >= ?
+                  AND g.is_active = 1
+            ''', (lat, lat, lon, lon)).fetchall()
+        else:
+            candidates = conn.execute('''
+                SELECT * FROM geofences
+                WHERE min_lat <= ? AND max_lat >= ? AND min_lon <= ? AND max_lon >= ?
+                  AND is_active = 1
+            ''', (lat, lat, lon, lon)).fetchall()
+        
+        inside = {}
+        for fence in candidates:
+            if fence['kind'] == 'circle':
+                hit = haversine_m(lat, lon, fence['center_lat'], fence['center_lon']) <= fence['radius_m']
+            else:
+                hit = point_in_polygon(lat, lon, json.loads(fence['polygon']))
+            if hit:
+                inside[fence['id']] = fence
+        
+        previous = {row[0] for row in conn.execute(
+            'SELECT geofence_id FROM geofence_presence WHERE employee_id = ?', (employee_id,))}
+        
+        entered = [fid for fid in inside if fid not in previous]
+        exited = [fid for fid in previous if fid not in inside]
+        if not entered and not exited:
+            return []
+        
+        events = []
+        for fid in entered:
+            conn.execute('INSERT INTO geofence_presence (employee_id, geofence_id) VALUES (?, ?)',
+                         (employee_id, fid))
+            events.append((fid, employee_id, 'enter', lat, lon))
+        for fid in exited:
+            conn.execute('DELETE FROM geofence_presence WHERE employee_id = ? AND geofence_id = ?',
+                         (employee_id, fid))
+            events.append((fid, employee_id, 'exit', lat, lon))
+        conn.executemany('''
+            INSERT INTO geofence_events (geofence_id, employee_id, event_type, latitude, longitude)
+            VALUES (?, ?, ?, ?, ?)
+        ''', events)
+        
+        # Автоматическое обновление статусов
+        if exited:
+            placeholders = ','.join('?' * len(exited))
+            for fence in conn.execute(f'SELECT * FROM geofences WHERE id IN ({placeholders})', exited):
+                if fence['exit_status']:
+                    conn.execute('UPDATE employees SET status = ? WHERE id = ?',
+                                 (fence['exit_status'], employee_id))
+                    self.log_data_change(conn, 'employees', employee_id)
+        for fid in entered:
+            fence = inside[fid]
+            if fence['enter_status']:
+                conn.execute('UPDATE employees SET status = ? WHERE id = ?',
+                             (fence['enter_status'], employee_id))
+                self.log_data_change(conn, 'employees', employee_id)
+            if fence['task_id'] and fence['enter_task_status']:
+                completed_at = 'CURRENT_TIMESTAMP' if fence['enter_task_status'] == 'completed' else 'NULL'
+                completed_before = self._completed_task_days(conn, [fence['task_id']])
+                statuses_before = self._task_statuses(conn, [fence['task_id']])
+                conn.execute(f'''
+                    UPDATE tasks SET status = ?, completed_at = {completed_at}
+                    WHERE id = ? AND employee_id = ? AND status != 'completed'
+                ''', (fence['enter_task_status'], fence['task_id'], employee_id))
+                self._update_completion_rollups(conn, completed_before,
+                                                self._completed_task_days(conn, [fence['task_id']]))
+                self._record_task_transitions(conn, statuses_before)
+                self.log_data_change(conn, 'tasks', fence['task_id'])
+        
+        return [{'geofence_id': e[0], 'event': e[2]} for e in events]
+    
+    # ========== ТЕПЛОВАЯ КАРТА ==========
+    
+    def _add_heatmap_point(self, conn, employee_id, lat, lon, recorded_at):
+        """Добавляет во все уровни пирамиды тайлов время пребывания в предыдущей точке
+        
+        Время до новой отметки сотрудник провел там, где был замечен перед ней, поэтому
+        вес получают ячейки предыдущей точки; новая точка учтется со следующей отметкой.
+        Запоздавшие точки (не новее последней) вес не добавляют.
+        """
+        previous = conn.execute('''
+            SELECT latitude, longitude, recorded_at FROM location_points
+            WHERE employee_id = ? ORDER BY recorded_at DESC LIMIT 1
+        ''', (employee_id,)).fetchone()
+        if previous is None or recorded_at <= previous['recorded_at']:
+            return
+        weight = min(recorded_at - previous['recorded_at'], app.config['HEATMAP_MAX_DWELL_S'])
+        
+        cells = heatmap_cells_for_point(previous['latitude'], previous['longitude'],
+                                        app.config['HEATMAP_ZOOMS'], app.config['HEATMAP_GRID'])
+        conn.executemany('''
+            INSERT INTO heatmap_cells (zoom, tile_x, tile_y, cell, weight)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (zoom, tile_x, tile_y, cell) DO UPDATE SET weight = weight + excluded.weight
+        ''', [(*cell, weight) for cell in cells])
+    
+    def get_heatmap_tile(self, zoom, tile_x, tile_y):
+        """Компактное содержимое тайла: [ячейка, вес, ячейка, вес, ...]"""
+        conn = self.get_connection()
+        rows = conn.execute('''
+            SELECT cell, weight FROM heatmap_cells
+            WHERE zoom = ? AND tile_x = ? AND tile_y = ?
+            ORDER BY cell
+        ''', (zoom, tile_x, tile_y)).fetchall()
+        conn.close()
+        
+        cells = []
+        max_weight = 0
+        for cell, weight in rows:
+            cells.append(cell)
+            cells.append(int(round(weight)))
+            max_weight = max(max_weight, weight)
+        return {
+            'z': zoom,
+            'x': tile_x,
+            'y': tile_y,
+            'grid': app.config['HEATMAP_GRID'],
+            'max': int(round(max_weight)),
+            'cells': cells
+        }
+    
+    # ========== ТРЕКИ ==========
+    
+    def _record_trail_point(self, conn, employee_id, lat, lon, recorded_at):
+        """Добавляет точку в буфер; завершенные сутки сжимаются в треки"""
+        oldest = conn.execute('SELECT MIN(recorded_at) FROM location_points WHERE employee_id = ?',
+                              (employee_id,)).fetchone()[0]
+        today = trail_day(recorded_at)
+        if oldest is not None and trail_day(oldest) < today:
+            self._compact_trail(conn, employee_id, trail_day_start(today))
+        
+        conn.execute('''
+            INSERT INTO location_points (employee_id, latitude, longitude, recorded_at)
+            VALUES (?, ?, ?, ?)
+        ''', (employee_id, lat, lon, recorded_at))
+    
+    def _compact_trail(self, conn, employee_id, before_ts):
+        """Упрощает и упаковывает буферизованные точки до before_ts в суточные блобы"""
+        rows = conn.execute('''
+            SELECT latitude, longitude, recorded_at FROM location_points
+            WHERE employee_id = ? AND recorded_at < ?
+            ORDER BY recorded_at
+        ''', (employee_id, before_ts)).fetchall()
+        
+        by_day = {}
+        for row in rows:
+            by_day.setdefault(trail_day(row[2]), []).append(tuple(row))
+        
+        tolerance = app.config['TRAIL_TOLERANCE_M']
+        for day, points in by_day.items():
+            raw_count = len(points)
+            existing = conn.execute('''
+                SELECT raw_count, data FROM location_trails WHERE employee_id = ? AND day = ?
+            ''', (employee_id, day)).fetchone()
+            if existing:
+                # Запоздавшие точки объединяются с уже сжатым треком
+                raw_count += existing['raw_count']
+                points = sorted(decode_trail(existing['data']) + points, key=lambda p: p[2])
+            
+            simplified = douglas_peucker(points, tolerance)
+            conn.execute('''
+                INSERT OR REPLACE INTO location_trails
+                    (employee_id, day, start_ts, end_ts, raw_count, point_count, data)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (employee_id, day, simplified[0][2], simplified[-1][2], raw_count,
+                  len(simplified), encode_trail(simplified)))
+        
+        conn.execute('DELETE FROM location_points WHERE employee_id = ? AND recorded_at < ?',
+                     (employee_id, before_ts))
+    
+    def compact_location_trails(self, before_ts=None):
+        """Сжатие буфера точек всех сотрудников (по умолчанию - до начала текущих суток)"""
+        if before_ts is None:
+            before_ts = trail_day_start(trail_day(time.time()))
+        
+        conn = self.get_connection()
+        employee_ids = [row[0] for row in conn.execute(
+            'SELECT DISTINCT employee_id FROM location_points WHERE recorded_at < ?', (before_ts,))]
+        for employee_id in employee_ids:
+            self._compact_trail(conn, employee_id, before_ts)
+        conn.commit()
+        conn.close()
+        return len(employee_ids)
+    
+    def get_trail(self, employee_id, start_ts, end_ts, tolerance_m=None):
+        """Маршрут сотрудника за интервал времени [(lat, lon, ts), ...]"""
+        conn = self.get_connection()
+        # Сутки с запасом в день: треки, сжатые до перехода на местные сутки, разбиты по UTC;
+        # точный отбор делают start_ts/end_ts
+        blobs = conn.execute('''
+            SELECT data FROM location_trails
+            WHERE employee_id = ? AND day BETWEEN ? AND ? AND end_ts >= ? AND start_ts <= ?
+            ORDER BY day
+        ''', (employee_id, trail_day(start_ts - 86400), trail_day(end_ts + 86400), start_ts, end_ts)).fetchall()
+        raw = conn.execute('''
+            SELECT latitude, longitude, recorded_at FROM location_points
+            WHERE employee_id = ? AND recorded_at BETWEEN ? AND ?
+            ORDER BY recorded_at
+        ''', (employee_id, start_ts, end_ts)).fetchall()
+        conn.close()
+        
+        points = []
+        for blob in blobs:
+            points.extend(p for p in decode_trail(blob['data']) if start_ts <= p[2] <= end_ts)
+        points.extend(tuple(row) for row in raw)
+        points.sort(key=lambda p: p[2])
+        
+        if tolerance_m:
+            points = douglas_peucker(points, tolerance_m)
+        return points
+    
+    def get_trail_storage_stats(self):
+        conn = self.get_connection()
+        row = conn.execute('''
+            SELECT COUNT(*), COALESCE(SUM(raw_count), 0), COALESCE(SUM(point_count), 0),
+                   COALESCE(SUM(LENGTH(data)), 0)
+            FROM location_trails
+        ''').fetchone()
+        buffered = conn.execute('SELECT COUNT(*) FROM location_points').fetchone()[0]
+        conn.close()
+        return {
+            'trails': row[0],
+            'raw_points': row[1],
+            'stored_points': row[2],
+            'stored_bytes': row[3],
+            'buffered_points': buffered
+        }
+
+    # ========== ФОНОВЫЕ ЗАДАНИЯ ==========
+    
+    def create_job(self, kind, params, user_id=None):
+        job_id = uuid.uuid4().hex
+        conn = self.get_connection()
+        conn.execute('''
+            INSERT INTO jobs (id, kind, params, created_by, heartbeat_at)
+            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ''', (job_id, kind, json.dumps(params or {}), user_id))
+        conn.commit()
+        conn.close()
+        return job_id
+    
+    def get_job(self, job_id):
+        conn = self.get_connection()
+        job = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        conn.close()
+        return job
+    
+    def get_jobs(self, user_id=None, limit=50):
+        conn = self.get_connection()
+        if user_id:
+            jobs = conn.execute('''
+                SELECT id, kind, status, progress, message, error, created_at, finished_at
+                FROM jobs WHERE created_by = ? ORDER BY created_at DESC LIMIT ?
+            ''', (user_id, limit)).fetchall()
+        else:
+            jobs = conn.execute('''
+                SELECT id, kind, status, progress, message, error, created_at, finished_at
+                FROM jobs ORDER BY created_at DESC LIMIT ?
+            ''', (limit,)).fetchall()
+        conn.close()
+        return jobs
+    
+    def count_active_jobs(self):
+        conn = self.get_connection()
+        count = conn.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')").fetchone()[0]
+        conn.close()
+        return count
+    
+    def start_job(self, job_id):
+        """Переводит задание в работу; False, если его успели отменить"""
+        conn = self.get_connection()
+        started = conn.execute('''
+            UPDATE jobs SET status = 'running', started_at = CURRENT_TIMESTAMP, heartbeat_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status = 'queued'
+        ''', (job_id,)).rowcount
+        conn.commit()
+        conn.close()
+        return started > 0
+    
+    def update_job_progress(self, job_id, progress, message=None):
+        """Сохраняет прогресс; возвращает True, если запрошена отмена"""
+        conn = self.get_connection()
+        conn.execute('''
+            UPDATE jobs SET progress = ?, message = COALESCE(?, message), heartbeat_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (progress, message, job_id))
+        row = conn.execute('SELECT cancel_requested FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        conn.commit()
+        conn.close()
+        return bool(row and row['cancel_requested'])
+    
+    def finish_job(self, job_id, status, result=None, error=None, ttl=3600):
+        conn = self.get_connection()
+        conn.execute('''
+            UPDATE jobs SET status = ?, result = ?, error = ?,
+                progress = CASE WHEN ? = 'completed' THEN 1 ELSE progress END,
+                finished_at = CURRENT_TIMESTAMP,
+                expires_at = datetime('now', ?)
+            WHERE id = ?
+        ''', (status, json.dumps(result) if result is not None else None, error,
+              status, f'+{int(ttl)} seconds', job_id))
+        conn.commit()
+        conn.close()
+    
+    def cancel_job(self, job_id):
+        """Отмена: задание в очереди отменяется сразу, выполняемое - при следующем отчете о прогрессе"""
+        conn = self.get_connection()
+        changed = conn.execute('''
+            UPDATE jobs SET
+                cancel_requested = 1,
+                status = CASE WHEN status = 'queued' THEN 'cancelled' ELSE status END,
+                finished_at = CASE WHEN status = 'queued' THEN CURRENT_TIMESTAMP ELSE finished_at END
+            WHERE id = ? AND status IN ('queued', 'running')
+        ''', (job_id,)).rowcount
+        conn.commit()
+        conn.close()
+        return changed > 0
+    
+    def purge_jobs(self, stale_seconds=900):
+        """Удаляет просроченные результаты и помечает зависшие задания
+        
+        Задание в очереди дольше stale_seconds тоже считается потерянным (например, воркер
+        завершился до его запуска): иначе оно навсегда занимало бы место в JOB_MAX_QUEUED.
+        Если оно все же дождется пула, start_job его не запустит.
+        """
+        conn = self.get_connection()
+        conn.execute('DELETE FROM jobs WHERE expires_at < CURRENT_TIMESTAMP')
+        conn.execute('''
+            UPDATE jobs SET status = 'failed', error = 'Задание прервано', finished_at = CURRENT_TIMESTAMP,
+                expires_at = datetime('now', '+1 day')
+            WHERE status = 'running' AND heartbeat_at < datetime('now', ?)
+        ''', (f'-{int(stale_seconds)} seconds',))
+        conn.execute('''
+            UPDATE jobs SET status = 'failed', error = 'Задание не было запущено', finished_at = CURRENT_TIMESTAMP,
+                expires_at = datetime('now', '+1 day')
+            WHERE status = 'queued' AND created_at < datetime('now', ?)
+        ''', (f'-{int(stale_seconds)} seconds',))
+        conn.commit()
+        conn.close()
+
+# ========== КОМПАНИИ ==========
+
+class TenantRouter:
+    """Выбор базы данных компании для текущего запроса или фонового задания
+    
+    Обращения к атрибутам передаются Database текущей компании: она берется из
+    use_tenant() в фоновых потоках или из g.tenant в запросе. Открытые базы
+    хранятся в LRU-кеше на TENANT_CACHE_SIZE компаний; миграции выполняются при
+    первом открытии базы, если ее user_version меньше SCHEMA_VERSION.
+    """
+    
+    def __init__(self):
+        self._databases = OrderedDict()
+        self._lock = threading.Lock()
+        self._tenant = contextvars.ContextVar('tenant', default=None)
+    
+    def tenant_path(self, tenant):
+        if tenant == app.config['TENANT_DEFAULT']:
+            return app.config['DATABASE']
+        return os.path.join(app.config['TENANT_DIR'], f'{tenant}.db')
+    
+    def tenant_exists(self, tenant):
+        if tenant == app.config['TENANT_DEFAULT']:
+            return True
+        return (app.config['TENANTS_ENABLED'] and bool(TENANT_RE.match(tenant or ''))
+                and make_storage(self.tenant_path(tenant)).exists())
+    
+    def list_tenants(self):
+        tenants = [app.config['TENANT_DEFAULT']]
+        if app.config['TENANTS_ENABLED']:
+            storage = STORAGE_ENGINES[app.config['STORAGE_ENGINE']]
+            for path in storage.list_databases(app.config['TENANT_DIR']):
+                tenant = os.path.splitext(os.path.basename(path))[0]
+                if TENANT_RE.match(tenant) and tenant not in tenants:
+                    tenants.append(tenant)
+        return tenants
+    
+    def get_database(self, tenant, create=False):
+        with self._lock:
+            database = self._databases.get(tenant)
+            if database is not None:
+                self._databases.move_to_end(tenant)
+                return database
+        if not create and not self.tenant_exists(tenant):
+            raise LookupError(f'Компания не найдена: {tenant}')
+        
+        # Открытие и миграция вне блокировки: они не должны задерживать другие компании
+        database = Database(self.tenant_path(tenant), seed=tenant == app.config['TENANT_DEFAULT'])
+        with self._lock:
+            database = self._databases.setdefault(tenant, database)
+            self._databases.move_to_end(tenant)
+            while len(self._databases) > app.config['TENANT_CACHE_SIZE']:
+                self._databases.popitem(last=False)
+        return database
+    
+    def peek_database(self, tenant):
+        """База компании для фонового обхода всех компаний
+        
+        Уже открытая база берется из кеша без продвижения в LRU, иначе создается отдельный
+        объект вне кеша: обход больше TENANT_CACHE_SIZE компаний не вытесняет рабочие базы
+        и их справочники.
+        """
+        with self._lock:
+            database = self._databases.get(tenant)
+        if database is not None:
+            return database
+        if not self.tenant_exists(tenant):
+            raise LookupError(f'Компания не найдена: {tenant}')
+        return Database(self.tenant_path(tenant), seed=tenant == app.config['TENANT_DEFAULT'])
+    
+    def create_tenant(self, tenant):
+        if not app.config['TENANTS_ENABLED']:
+            raise ValueError('Режим нескольких компаний выключен')
+        if not TENANT_RE.match(tenant or ''):
+            raise ValueError('Код компании: строчные латинские буквы, цифры, "-" и "_"')
+        if self.tenant_exists(tenant):
+            raise ValueError(f'Компания уже существует: {tenant}')
+        make_storage(self.tenant_path(tenant)).create()
+        return self.get_database(tenant, create=True)
+    
+    def after_fork(self):
+        """Открытые базы остаются (соединения создаются на каждый запрос), блокировки и справочники - новые"""
+        self._lock = threading.Lock()
+        for database in self._databases.values():
+            database.directory = EmployeeDirectory(database)
+    
+    def reset_storage(self):
+        """Закрывает открытые базы и хранилище лимитов; базы в памяти при этом удаляются (изоляция тестов)"""
+        with self._lock:
+            self._databases.clear()
+        rate_limiter.reset()
+        STORAGE_ENGINES[app.config['STORAGE_ENGINE']].clear()
+    
+    @property
+    def current_tenant(self):
+        tenant = self._tenant.get()
+        if tenant is None and has_request_context():
+            tenant = g.get('tenant')
+        return tenant or app.config['TENANT_DEFAULT']
+    
+    @contextlib.contextmanager
+    def use_tenant(self, tenant):
+        token = self._tenant.set(tenant)
+        try:
+            yield self.get_database(tenant)
+        finally:
+            self._tenant.reset(token)
+    
+    def for_each_tenant(self, f):
+        """Вызывает f(database) для каждой компании; результат - словарь по компаниям"""
+        results = {}
+        for tenant in self.list_tenants():
+            token = self._tenant.set(tenant)
+            try:
+                results[tenant] = f(self.peek_database(tenant))
+            finally:
+                self._tenant.reset(token)
+        return results
+    
+    def __getattr__(self, name):
+        return getattr(self.get_database(self.current_tenant), name)
+
+def tenant_from_host():
+    suffix = app.config['TENANT_HOST_SUFFIX']
+    host = request.host.split(':')[0].lower()
+    if suffix and host.endswith(suffix) and host != suffix.lstrip('.'):
+        return host[:-len(suffix)]
+    return None
+
+# ========== ФОНОВЫЕ ЗАДАНИЯ ==========
+
+class JobCancelled(Exception):
+    pass
+
+class JobContext:
+    """Передается обработчику задания для отчета о прогрессе и проверки отмены"""
+    
+    def __init__(self, database, job_id, interval=0.5):
+        self.database = database
+        self.job_id = job_id
+        self.interval = interval
+        self._last_report = 0.0
+    
+    def progress(self, done, total=None, message=None, force=False):
+        now = time.monotonic()
+        if not force and now - self._last_report < self.interval:
+            return
+        self._last_report = now
+        fraction = done / total if total else done
+        if self.database.update_job_progress(self.job_id, min(max(fraction, 0.0), 1.0), message):
+            raise JobCancelled()
+
+class JobRunner:
+    """Пул фоновых заданий процесса; состояние и результаты хранятся в таблице jobs"""
+    
+    def __init__(self, database):
+        self.database = database
+        self.handlers = {}
+        self._executor = None
+        self._lock = threading.Lock()
+    
+    def handler(self, kind):
+        def decorator(f):
+            self.handlers[kind] = f
+            return f
+        return decorator
+    
+    def after_fork(self):
+        self._executor = None
+        self._lock = threading.Lock()
+    
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=app.config['JOB_WORKERS'],
+                                                    thread_name_prefix='job')
+            return self._executor
+    
+    def submit(self, kind, params=None, user_id=None):
+        if kind not in self.handlers:
+            raise ValueError(f'Неизвестный тип задания: {kind}')
+        self.database.purge_jobs(app.config['JOB_STALE_S'])
+        if self.database.count_active_jobs() >= app.config['JOB_MAX_QUEUED']:
+            raise RuntimeError('Очередь заданий переполнена, повторите позже')
+        
+        job_id = self.database.create_job(kind, params, user_id)
+        self.executor.submit(self._run, self.database.current_tenant, job_id, kind, params or {})
+        return job_id
+    
+    def _run(self, tenant, job_id, kind, params):
+        with self.database.use_tenant(tenant):
+            if not self.database.start_job(job_id):
+                return
+            ttl = app.config['JOB_RESULT_TTL_S']
+            try:
+                result = self.handlers[kind](JobContext(self.database, job_id), **params)
+                self.database.finish_job(job_id, 'completed', result=result, ttl=ttl)
+            except JobCancelled:
+                self.database.finish_job(job_id, 'cancelled', ttl=ttl)
+            except Exception as e:
+                self.database.finish_job(job_id, 'failed', error=str(e), ttl=ttl)
+
+class OverdueScheduler:
+    """Поток процесса, который спит до ближайшего срока открытой задачи и эскалирует просроченные
+    
+    Вместо периодического просмотра всех задач читается только минимум частичного
+    индекса; новые сроки в этом процессе будят поток через wake(), сроки из других
+    процессов подхватываются не позже TASK_OVERDUE_MAX_SLEEP_S.
+    """
+    
+    def __init__(self, database):
+        self.database = database
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+    
+    def start(self):
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._loop, name='overdue-scheduler', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+    
+    def wake(self):
+        self._wakeup.set()
+    
+    def run_once(self, now=None, database=None):
+        """Эскалирует все задачи со сроком раньше now, пачками по TASK_OVERDUE_BATCH"""
+        database = database or self.database
+        now = (now or datetime.datetime.now()).strftime('%Y-%m-%d %H:%M:%S')
+        batch = app.config['TASK_OVERDUE_BATCH']
+        total = 0
+        while True:
+            escalated = database.escalate_overdue_tasks(now, batch)
+            total += escalated
+            if escalated < batch:
+                return total
+    
+    def _loop(self):
+        while True:
+            self._wakeup.clear()
+            delay = app.config['TASK_OVERDUE_MAX_SLEEP_S']
+            for tenant in self.database.list_tenants():
+                try:
+                    # Обход всех компаний не должен вытеснять базы из LRU маршрутизатора
+                    database = self.database.peek_database(tenant)
+                    self.run_once(database=database)
+                    deadline = database.get_next_task_deadline()
+                    if deadline:
+                        deadline = datetime.datetime.fromisoformat(deadline)
+                        delay = min(delay, max((deadline - datetime.datetime.now()).total_seconds() + 1, 0))
+                except Exception as e:
+                    print(f"Ошибка планировщика просроченных задач ({tenant}): {e}")
+            self._wakeup.wait(delay)
+
+# ========== ИНИЦИАЛИЗАЦИЯ БАЗЫ ДАННЫХ ==========
+
+# База открывается при первом обращении или в create_app(), а не при импорте модуля
+db = TenantRouter()
+
+THREADS_PER_PAGE = 20
+EMPLOYEE_SEARCH_PAGE_LIMIT = 200
+THREAD_MESSAGES_PER_PAGE = 50
+SENT_MESSAGES_PER_PAGE = 50
+
+jobs = JobRunner(db)
+overdue_scheduler = OverdueScheduler(db)
+
+def reset_after_fork():
+    """Сбрасывает в дочернем процессе пулы потоков и блокировки, унаследованные от родителя"""
+    passwords.after_fork()
+    jobs.after_fork()
+    db.after_fork()
+    MemoryStorage.after_fork()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_after_fork)
+
+_app_lock = threading.Lock()
+_app_initialized = False
+
+def create_app():
+    """Фабрика приложения: открывает и при необходимости мигрирует базу по умолчанию
+    
+    Выполняется один раз на процесс; одновременная миграция из нескольких воркеров
+    исключается файловой блокировкой базы. Время запуска сохраняется в STARTUP_MS.
+    """
+    global _app_initialized
+    with _app_lock:
+        if not _app_initialized:
+            started = time.perf_counter()
+            hops = app.config['PROXY_FIX_HOPS']
+            if hops:
+                app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops, x_host=hops)
+            # Задания, оставшиеся в очереди от завершившихся воркеров, не должны занимать ее место
+            db.get_database(app.config['TENANT_DEFAULT']).purge_jobs(app.config['JOB_STALE_S'])
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            app.config['STARTUP_MS'] = round(elapsed_ms, 1)
+            if elapsed_ms > app.config['STARTUP_BUDGET_MS']:
+                print(f"Инициализация заняла {elapsed_ms:.0f} мс (бюджет {app.config['STARTUP_BUDGET_MS']} мс)")
+            _app_initialized = True
+    return app
+
+@app.before_request
+def start_overdue_scheduler():
+    if app.config['TASK_OVERDUE_ENABLED']:
+        overdue_scheduler.start()
+
+@jobs.handler('analytics')
+def analytics_job(job):
+    """Сводная статистика по всем сотрудникам"""
+    employees = db.get_all_employees()
+    employee_stats = []
+    for i, emp in enumerate(employees):
+        job.progress(i, len(employees), f'Сотрудник {i + 1} из {len(employees)}')
+        employee_stats.append({
+            'id': emp['id'],
+            'name': emp['name'],
+            'position': emp['position'],
+            **db.get_employee_stats(emp['id'])
+        })
+    return {'stats': db.get_stats(), 'employee_stats': employee_stats}
+
+@jobs.handler('export_reports')
+def export_reports_job(job, employee_id=None, date_from=None, date_to=None):
+    """Выгрузка отчетов о работе в CSV"""
+    reports = db.get_work_reports(employee_id, date_from, date_to)
+    output = io.StringIO()
+    writer = csv.writer(output, delimiter=';')
+    writer.writerow(['Дата', 'Сотрудник', 'Часы', 'Задачи', 'Описание'])
+    for i, report in enumerate(reports):
+        job.progress(i, len(reports))
+        writer.writerow([report['date'], report['employee_name'], report['hours_worked'],
+                         report['tasks_completed'], report['description'] or ''])
+    return {'filename': 'work_reports.csv', 'content_type': 'text/csv', 'content': output.getvalue()}
+
+@jobs.handler('payroll')
+def payroll_job(job, date_from=None, date_to=None):
+    """Начисления за период: отработанные часы x ставка"""
+    total = db.get_work_reports_summary(date_from, date_to)['total_reports']
+    rates = {emp['id']: emp['hourly_rate'] or 0 for emp in db.get_all_employees()}
+    totals = {}
+    for i, report in enumerate(db.iter_work_reports(date_from=date_from, date_to=date_to)):
+        job.progress(i, total)
+        item = totals.setdefault(report['employee_id'], {
+            'employee_id': report['employee_id'],
+            'name': report['employee_name'],
+            'hours': 0,
+            'amount': 0
+        })
+        item['hours'] += report['hours_worked'] or 0
+        item['amount'] += (report['hours_worked'] or 0) * rates.get(report['employee_id'], 0)
+    return {'date_from': date_from, 'date_to': date_to,
+            'payroll': sorted(totals.values(), key=lambda item: item['name'])}
+
+@jobs.handler('archive')
+def archive_job(job, before=None):
+    """Перенос старых отчетов, прочитанных сообщений и завершенных задач в помесячные архивы"""
+    return {'moved': db.archive_old_data(before, progress=job.progress)}
+
+@jobs.handler('dashboards')
+def dashboards_job(job):
+    """Построение панелей сотрудников, сброшенных изменениями"""
+    return {'refreshed': db.refresh_employee_dashboards(progress=job.progress)}
+
+@jobs.handler('compact_trails')
+def compact_trails_job(job):
+    """Сжатие буфера точек местоположения в суточные треки"""
+    return {'employees': db.compact_location_trails()}
+
+# ========== ДЕКОРАТОРЫ ДОСТУПА ==========
+
+def login_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'user_id' not in session:
+            flash('Пожалуйста, войдите в систему', 'warning')
+            return redirect(url_for('login'))
+        return f(*args, **kwargs)
+    return decorated_function
+
+def admin_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'user_id' not in session:
+            flash('Пожалуйста, войдите в систему', 'warning')
+            return redirect(url_for('login'))
+        if session.get('role') != 'admin':
+            flash('Доступ запрещен. Требуются права администратора', 'danger')
+            return redirect(url_for('index'))
+        return f(*args, **kwargs)
+    return decorated_function
+
+def employee_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'user_id' not in session:
+            flash('Пожалуйста, войдите в систему', 'warning')
+            return redirect(url_for('login'))
+        if session.get('role') != 'employee':
+            flash('Доступ разрешен только сотрудникам', 'danger')
+            return redirect(url_for('index'))
+        return f(*args, **kwargs)
+    return decorated_function
+
+@app.context_processor
+def inject_unread_count():
+    if 'user_id' not in session:
+        return {}
+    return {'unread_count': db.get_unread_count(session['user_id'])}
+
+# ========== ОГРАНИЧЕНИЕ ЧАСТОТЫ ЗАПРОСОВ ==========
+
+class RateLimiter:
+    """Корзины токенов в отдельном файле SQLite, общие для всех воркеров gunicorn"""
+    
+    def __init__(self):
+        self._local = threading.local()
+        self._generation = 0
+    
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.generation != self._generation:
+            conn.close()
+            conn = None
+        if conn is None or self._local.pid != os.getpid():
+            # Тот же движок хранения, что и у баз компаний: с memory корзины тоже в памяти
+            conn = make_storage(app.config['RATE_LIMIT_DB']).connect()
+            conn.isolation_level = None
+            conn.execute('PRAGMA busy_timeout=200')
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS buckets (
+                    key TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                ) WITHOUT ROWID
+            ''')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+            self._local.generation = self._generation
+        return conn
+    
+    def reset(self):
+        """Закрывает соединение потока; остальные потоки переоткроют свои при следующем запросе"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+        self._generation += 1
+    
+    def consume(self, key, capacity, refill_per_s):
+        """Списывает токен; возвращает 0 при успехе или секунды до появления токена"""
+        now = time.time()
+        try:
+            conn = self._connection()
+            row = conn.execute('''
+                INSERT INTO buckets (key, tokens, updated_at) VALUES (?, ? - 1, ?)
+                ON CONFLICT (key) DO UPDATE SET
+                    tokens = MIN(?, tokens + (excluded.updated_at - updated_at) * ?) - 1,
+                    updated_at = excluded.updated_at
+                WHERE MIN(?, tokens + (excluded.updated_at - updated_at) * ?) >= 1
+                RETURNING tokens
+            ''', (key, capacity, now, capacity, refill_per_s, capacity, refill_per_s)).fetchone()
+            if row is not None:
+                if now % 1 < 0.001:
+                    # Примерно раз на тысячу запросов удаляем давно не использованные корзины
+                    conn.execute('DELETE FROM buckets WHERE updated_at < ?', (now - 3600,))
+                return 0
+            current = conn.execute('SELECT tokens, updated_at FROM buckets WHERE key = ?', (key,)).fetchone()
+        except sqlite3.Error:
+            # Хранилище недоступно - не блокируем запросы
+            return 0
+        tokens = min(capacity, current[0] + (now - current[1]) * refill_per_s)
+        return max((1 - tokens) / refill_per_s, 0.001)
+
+class LoadMonitor:
+    """Скользящее среднее задержки запросов в процессе
+    
+    Среднее затухает со временем (LOAD_SHED_DECAY_S): отброшенные запросы в него
+    не попадают, и без затухания перегрузка, однажды обнаруженная, не снималась бы.
+    """
+    
+    def __init__(self, alpha=0.1):
+        self.alpha = alpha
+        self._latency_ms = 0.0
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def _decayed(self, now):
+        return self._latency_ms * math.exp(-(now - self._updated_at) / app.config['LOAD_SHED_DECAY_S'])
+    
+    @property
+    def latency_ms(self):
+        with self._lock:
+            return self._decayed(time.monotonic())
+    
+    def record(self, latency_ms):
+        now = time.monotonic()
+        with self._lock:
+            current = self._decayed(now)
+            self._latency_ms = current + self.alpha * (latency_ms - current)
+            self._updated_at = now
+    
+    def overloaded(self):
+        return self.latency_ms > app.config['LOAD_SHED_LATENCY_MS']
+
+rate_limiter = RateLimiter()
+load_monitor = LoadMonitor()
+
+def too_many_requests(retry_after, message):
+    response = jsonify({'error': message, 'retry_after': math.ceil(retry_after)})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(math.ceil(retry_after))
+    return response
+
+def rate_limit(capacity, refill_per_s, priority='normal', methods=None, key=None):
+    """Корзина токенов на пользователя и маршрут; priority='low' - отбрасывается при перегрузке
+    
+    methods - ограничиваются только эти методы; key() - дополнительная часть ключа
+    корзины (например, имя входящего пользователя вместе с адресом клиента).
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if not app.config['RATE_LIMIT_ENABLED'] or (methods and request.method not in methods):
+                return f(*args, **kwargs)
+            if priority == 'low' and load_monitor.overloaded():
+                return too_many_requests(app.config['LOAD_SHED_RETRY_AFTER_S'],
+                                         'Сервер перегружен, повторите позже')
+            client = session.get('user_id') or request.remote_addr
+            if key is not None:
+                client = f'{key()}@{request.remote_addr}'
+            retry_after = rate_limiter.consume(f'{request.endpoint}:{db.current_tenant}:{client}',
+                                               capacity, refill_per_s)
+            if retry_after:
+                return too_many_requests(retry_after, 'Слишком много запросов')
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+@app.before_request
+def start_request_timer():
+    request.started_at = time.monotonic()
+
+@app.before_request
+def select_tenant():
+    """Компания запроса: из поддомена, иначе из сессии; чужая сессия сбрасывается"""
+    if request.endpoint == 'static' or not app.config['TENANTS_ENABLED']:
+        return
+    tenant = tenant_from_host()
+    if tenant is None:
+        tenant = session.get('tenant') or app.config['TENANT_DEFAULT']
+    elif 'user_id' in session and session.get('tenant', app.config['TENANT_DEFAULT']) != tenant:
+        session.clear()
+    if not db.tenant_exists(tenant):
+        abort(404)
+    g.tenant = tenant
+
+@app.after_request
+def record_request_latency(response):
+    started_at = getattr(request, 'started_at', None)
+    if started_at is not None and response.status_code != 429:
+        load_monitor.record((time.monotonic() - started_at) * 1000)
+    return response
+
+# ========== КЕШ ФРАГМЕНТОВ ШАБЛОНОВ ==========
+
+class FragmentCache:
+    """LRU-кеш отрисованных фрагментов с ограничением по объему
+    
+    Объем считается в байтах UTF-8 (кириллица занимает два байта на символ)
+    и хранится рядом со значением для учета при вытеснении.
+    """
+    
+    def __init__(self):
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+    
+    def set(self, key, value):
+        size = len(value.encode('utf-8')) if isinstance(value, str) else len(value)
+        max_bytes = app.config['FRAGMENT_CACHE_MAX_BYTES']
+        if size > max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+            self._items[key] = (value, size)
+            self._size += size
+            while self._size > max_bytes:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self._size -= evicted_size
+    
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+    
+    def stats(self):
+        with self._lock:
+            return {'items': len(self._items), 'bytes': self._size, 'hits': self.hits, 'misses': self.misses}
+
+class LazyValue:
+    """Откладывает загрузку данных для шаблона до первого обращения (промах кеша фрагмента)"""
+    
+    def __init__(self, loader):
+        self._loader = loader
+        self._loaded = False
+        self._value = None
+    
+    @property
+    def value(self):
+        if not self._loaded:
+            self._value = self._loader()
+            self._loaded = True
+        return self._value
+    
+    def __getattr__(self, name):
+        return getattr(self.value, name)
+    
+    def __getitem__(self, key):
+        return self.value[key]
+    
+    def __iter__(self):
+        return iter(self.value)
+    
+    def __len__(self):
+        return len(self.value)
+    
+    def __bool__(self):
+        return bool(self.value)
+
+fragment_cache = FragmentCache()
+
+def current_data_versions(names):
+    """Версии данных, запрошенные один раз за запрос"""
+    versions = g.setdefault('data_versions', {})
+    missing = [name for name in names if name not in versions]
+    if missing:
+        versions.update(db.get_data_versions(missing))
+    return tuple(versions[name] for name in names)
+
+@app.template_global()
+def cached_fragment(name, depends=(), key=None, caller=None):
+    """Кеширует содержимое блока {% call cached_fragment(...) %} по версиям данных и роли"""
+    if not app.config['FRAGMENT_CACHE_ENABLED']:
+        return caller()
+    cache_key = (db.current_tenant, name, session.get('role'), key, current_data_versions(depends))
+    html = fragment_cache.get(cache_key)
+    if html is None:
+        html = str(caller())
+        fragment_cache.set(cache_key, html)
+    return Markup(html)
+
+# ========== ПОТОКОВАЯ ОТРИСОВКА ==========
+
+def render_streamed(template_name, **context):
+    """Отдает страницу по частям по мере отрисовки шаблона"""
+    # Сессия сохраняется до отправки тела, поэтому флеш-сообщения забираем заранее
+    get_flashed_messages(with_categories=True)
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(**context)
+    stream.enable_buffering(app.config['STREAM_BUFFER_ITEMS'])
+    return app.response_class(stream_with_context(stream), mimetype='text/html')
+
+# ========== СЖАТИЕ ОТВЕТОВ И СТАТИКА ==========
+
+def compress_bytes(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=app.config['COMPRESS_BROTLI_QUALITY'])
+    compressor = zlib.compressobj(app.config['COMPRESS_LEVEL'], zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+def compress_stream(chunks, encoding):
+    """Сжатие потокового ответа с досылкой каждой порции клиенту"""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=app.config['COMPRESS_BROTLI_QUALITY'])
+        for chunk in chunks:
+            data = compressor.process(chunk) + compressor.flush()
+            if data:
+                yield data
+        yield compressor.finish()
+    else:
+        compressor = zlib.compressobj(app.config['COMPRESS_LEVEL'], zlib.DEFLATED, 31)
+        for chunk in chunks:
+            data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.flush()
+
+def negotiate_encoding():
+    offers = ['br', 'gzip'] if brotli is not None else ['gzip']
+    return request.accept_encodings.best_match(offers)
+
+@app.after_request
+def compress_response(response):
+    if (response.status_code < 200 or response.status_code in (204, 304)
+            or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in app.config['COMPRESS_MIMETYPES']):
+        return response
+    
+    encoding = negotiate_encoding()
+    if not encoding:
+        return response
+    
+    if response.is_streamed:
+        chunks = response.iter_encoded()
+        response.response = compress_stream(chunks, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < app.config['COMPRESS_MIN_SIZE']:
+            return response
+        response.set_data(compress_bytes(data, encoding))
+    
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    # Сжатое тело отличается побайтно: строгий тег ослабляем, для проверок If-None-Match он остается годным
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+class StaticAssets:
+    """Статические файлы с хешем содержимого в имени и заранее сжатыми вариантами"""
+    
+    def __init__(self, folder):
+        self.folder = folder
+        self._assets = {}
+        self._lock = threading.Lock()
+    
+    def _load(self, filename):
+        # Имя приходит из URL: пути вне каталога статики ("../app.py") не обслуживаются
+        path = safe_join(self.folder, filename)
+        if path is None or not os.path.isfile(path):
+            return None
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+        asset = self._assets.get(filename)
+        if asset is not None and asset['mtime'] == mtime:
+            return asset
         
-        stats = {
-            'total_tasks': conn.execute("SELECT COUNT(*) FROM tasks WHERE employee_id = ?", (employee_id,)).fetchone()[0],
-            'tasks_pending': conn.execute("SELECT COUNT(*) FROM tasks WHERE employee_id = ? AND status = 'pending'", (employee_id,)).fetchone()[0],
-            'tasks_completed': conn.execute("SELECT COUNT(*) FROM tasks WHERE employee_id = ? AND status = 'completed'", (employee_id,)).fetchone()[0],
-            'total_reports': conn.execute("SELECT COUNT(*) FROM work_reports WHERE employee_id = ?", (employee_id,)).fetchone()[0],
-            'total_hours': conn.execute("SELECT SUM(hours_worked) FROM work_reports WHERE employee_id = ?", (employee_id,)).fetchone()[0] or 0,
-            'avg_tasks_per_day': conn.execute("SELECT AVG(tasks_completed) FROM work_reports WHERE employee_id = ?", (employee_id,)).fetchone()[0] or 0
+        with open(path, 'rb') as f:
+            data = f.read()
+        asset = {
+            'mtime': mtime,
+            'digest': hashlib.sha256(data).hexdigest()[:12],
+            'mimetype': mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+            'data': data,
+            'variants': {}
         }
-        
-        conn.close()
-        return stats
-
-# ========== ИНИЦИАЛИЗАЦИЯ БАЗЫ ДАННЫХ ==========
-
-db = Database()
+        if len(data) <= app.config['STATIC_MAX_MEMORY_BYTES'] and asset['mimetype'] in app.config['COMPRESS_MIMETYPES']:
+            asset['variants']['gzip'] = compress_bytes(data, 'gzip')
+            if brotli is not None:
+                asset['variants']['br'] = brotli.compress(data, quality=11)
+        with self._lock:
+            self._assets[filename] = asset
+        return asset
+    
+    def hashed_name(self, filename):
+        """style.css -> style.<хеш>.css"""
+        asset = self._load(filename)
+        if asset is None:
+            return filename
+        root, ext = os.path.splitext(filename)
+        return f'{root}.{asset["digest"]}{ext}'
+    
+    def resolve(self, requested):
+        """Исходное имя файла и признак того, что запрошена версия с хешем"""
+        root, ext = os.path.splitext(requested)
+        base, _, digest = root.rpartition('.')
+        if base and len(digest) == 12:
+            asset = self._load(base + ext)
+            if asset is not None and asset['digest'] == digest:
+                return base + ext, asset, True
+        return requested, self._load(requested), False
 
-# ========== ДЕКОРАТОРЫ ДОСТУПА ==========
+static_assets = StaticAssets(app.static_folder)
 
-def login_required(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
-            flash('Пожалуйста, войдите в систему', 'warning')
-            return redirect(url_for('login'))
-        return f(*args, **kwargs)
-    return decorated_function
+@app.url_defaults
+def fingerprint_static_urls(endpoint, values):
+    if endpoint == 'static' and 'filename' in values:
+        values['filename'] = static_assets.hashed_name(values['filename'])
 
-def admin_required(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
-            flash('Пожалуйста, войдите в систему', 'warning')
-            return redirect(url_for('login'))
-        if session.get('role') != 'admin':
-            flash('Доступ запрещен. Требуются права администратора', 'danger')
-            return redirect(url_for('index'))
-        return f(*args, **kwargs)
-    return decorated_function
+def serve_static(filename):
+    if safe_join(app.static_folder, filename) is None:
+        abort(404)
+    name, asset, fingerprinted = static_assets.resolve(filename)
+    if asset is None or len(asset['data']) > app.config['STATIC_MAX_MEMORY_BYTES']:
+        return send_from_directory(app.static_folder, name)
+    
+    encoding = None
+    if asset['variants']:
+        offers = [enc for enc in ('br', 'gzip') if enc in asset['variants']]
+        encoding = request.accept_encodings.best_match(offers)
+    response = app.response_class(asset['variants'][encoding] if encoding else asset['data'],
+                                  mimetype=asset['mimetype'])
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.set_etag(f'{asset["digest"]}-{encoding or "identity"}')
+    if fingerprinted:
+        response.headers['Cache-Control'] = f'public, max-age={app.config["STATIC_MAX_AGE_S"]}, immutable'
+    else:
+        response.headers['Cache-Control'] = 'public, no-cache'
+    return response.make_conditional(request)
 
-def employee_required(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
-            flash('Пожалуйста, войдите в систему', 'warning')
-            return redirect(url_for('login'))
-        if session.get('role') != 'employee':
-            flash('Доступ разрешен только сотрудникам', 'danger')
-            return redirect(url_for('index'))
-        return f(*args, **kwargs)
-    return decorated_function
+app.view_functions['static'] = serve_static
 
 # ========== МАРШРУТЫ АУТЕНТИФИКАЦИИ ==========
 
 @app.route('/login', methods=['GET', 'POST'])
+@rate_limit(20, 0.2, methods=('POST',), key=lambda: request.form.get('username', '').strip().lower())
 def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
         
-        user = db.authenticate_user(username, password)
+        if app.config['TENANTS_ENABLED'] and tenant_from_host() is None:
+            tenant = request.form.get('company', '').strip().lower() or app.config['TENANT_DEFAULT']
+            if not db.tenant_exists(tenant):
+                flash('Неверная компания, имя пользователя или пароль', 'danger')
+                return render_template('login.html')
+            g.tenant = tenant
+        
+        try:
+            user = db.authenticate_user(username, password)
+        except PasswordQueueFull as e:
+            flash(str(e), 'warning')
+            return render_template('login.html'), 503
         
         if user:
+            session.clear()
+            session['tenant'] = db.current_tenant
             session['user_id'] = user['id']
             session['username'] = user['username']
             session['role'] = user['role']
@@ -704,7 +4387,11 @@ def register():
             flash('Пароли не совпадают', 'danger')
             return render_template('register.html')
         
-        user_id = db.register_user(username, password, email, 'employee')
+        try:
+            user_id = db.register_user(username, password, email, 'employee')
+        except PasswordQueueFull as e:
+            flash(str(e), 'warning')
+            return render_template('register.html'), 503
         
         if user_id:
             flash('Регистрация успешна! Теперь вы можете войти в систему', 'success')
@@ -731,9 +4418,9 @@ def index():
 @app.route('/admin/dashboard')
 @admin_required
 def admin_dashboard():
-    stats = db.get_stats()
-    recent_tasks = db.get_all_tasks()[:5]
-    employees = db.get_all_employees()
+    stats = LazyValue(db.get_stats)
+    recent_tasks = LazyValue(lambda: db.get_all_tasks()[:5])
+    employees = LazyValue(db.get_all_employees)
     
     return render_template('admin/dashboard.html', 
                          stats=stats, 
@@ -743,8 +4430,15 @@ def admin_dashboard():
 @app.route('/admin/employees')
 @admin_required
 def admin_employees():
-    employees = db.get_all_employees()
-    return render_template('admin/employees.html', employees=employees)
+    query = request.args.get('q', '').strip()
+    if query:
+        employees = LazyValue(lambda: db.directory.search(query, limit=EMPLOYEE_SEARCH_PAGE_LIMIT))
+        cache_table = True
+    else:
+        employees = LazyValue(db.get_all_employees)
+        cache_table = db.directory.count() <= app.config['STREAM_CACHE_MAX_ROWS']
+    return render_streamed('admin/employees.html', employees=employees, query=query,
+                           cache_table=cache_table)
 
 @app.route('/admin/add_employee', methods=['GET', 'POST'])
 @admin_required
@@ -763,8 +4457,10 @@ def admin_add_employee():
                 'hourly_rate': float(request.form.get('hourly_rate', 0))
             }
             
-            # Пароль из формы
+            # Пароль из формы; хеш вычисляется до создания сотрудника,
+            # чтобы перегрузка пула паролей не оставила сотрудника без учетной записи
             password = request.form['password']
+            password_hash = db.hash_password(password)
             
             # Добавляем сотрудника в БД
             employee_id = db.add_employee(employee_data)
@@ -776,7 +4472,8 @@ def admin_add_employee():
                 password, 
                 employee_data['email'], 
                 'employee', 
-                employee_id
+                employee_id,
+                password_hash=password_hash
             )
             
             if success:
@@ -787,6 +4484,9 @@ def admin_add_employee():
                 db.delete_employee(employee_id)
                 flash('Ошибка создания учетной записи. Возможно, email уже используется', 'danger')
                 
+        except PasswordQueueFull as e:
+            flash(str(e), 'warning')
+            return render_template('admin/add_employee.html'), 503
         except Exception as e:
             flash(f'Ошибка при добавлении сотрудника: {str(e)}', 'danger')
     
@@ -831,9 +4531,7 @@ def admin_delete_employee(id):
 @app.route('/admin/tasks')
 @admin_required
 def admin_tasks():
-    tasks = db.get_all_tasks()
-    employees = db.get_all_employees()
-    return render_template('admin/tasks.html', tasks=tasks, employees=employees)
+    return render_streamed('admin/tasks.html', tasks=db.iter_tasks())
 
 @app.route('/admin/add_task', methods=['POST'])
 @admin_required
@@ -848,6 +4546,7 @@ def admin_add_task():
         }
         
         db.add_task(data)
+        overdue_scheduler.wake()
         flash('Задача добавлена!', 'success')
     except Exception as e:
         flash(f'Ошибка: {str(e)}', 'danger')
@@ -857,48 +4556,44 @@ def admin_add_task():
 @app.route('/admin/reports')
 @admin_required
 def admin_reports():
-    reports = db.get_work_reports()
-    return render_template('admin/reports.html', reports=reports)
+    date_from = request.args.get('date_from') or None
+    date_to = request.args.get('date_to') or None
+    return render_streamed('admin/reports.html',
+                           reports=db.iter_work_reports(date_from=date_from, date_to=date_to),
+                           summary=db.get_work_reports_summary(date_from, date_to),
+                           date_from=date_from or '',
+                           date_to=date_to or '')
 
 @app.route('/admin/analytics')
 @admin_required
 def admin_analytics():
-    stats = db.get_stats()
-    employees = db.get_all_employees()
-    
-    employee_stats = []
-    for emp in employees:
-        emp_stats = db.get_employee_stats(emp['id'])
-        employee_stats.append({
-            'id': emp['id'],
-            'name': emp['name'],
-            'position': emp['position'],
-            **emp_stats
-        })
+    def load_employee_stats():
+        employee_stats = []
+        for emp in db.get_all_employees():
+            emp_stats = db.get_employee_stats(emp['id'])
+            employee_stats.append({
+                'id': emp['id'],
+                'name': emp['name'],
+                'position': emp['position'],
+                **emp_stats
+            })
+        return employee_stats
     
     return render_template('admin/analytics.html', 
-                         stats=stats, 
-                         employee_stats=employee_stats)
+                         stats=LazyValue(db.get_stats), 
+                         employee_stats=LazyValue(load_employee_stats))
 
 # ========== СОТРУДНИК ==========
 
 @app.route('/employee/dashboard')
 @employee_required
 def employee_dashboard():
-    employee = db.get_employee_by_user_id(session['user_id'])
-    if not employee:
+    dashboard = db.get_employee_dashboard(session['user_id'])
+    if not dashboard:
         flash('Профиль сотрудника не найден', 'danger')
         return redirect(url_for('logout'))
     
-    stats = db.get_employee_stats(employee['id'])
-    tasks = db.get_all_tasks(employee['id'])
-    recent_reports = db.get_work_reports(employee['id'])[:3]
-    
-    return render_template('employee/dashboard.html',
-                         employee=employee,
-                         stats=stats,
-                         tasks=tasks[:5],
-                         recent_reports=recent_reports)
+    return render_template('employee/dashboard.html', **dashboard)
 
 @app.route('/employee/tasks')
 @employee_required
@@ -918,8 +4613,11 @@ def employee_task_detail(task_id):
         return redirect(url_for('employee_tasks'))
     
     if request.method == 'POST':
-        status = request.form['status']
+        status = request.form.get('status')
         feedback = request.form.get('feedback', '')
+        if status not in TASK_STATUSES:
+            flash('Недопустимый статус задачи', 'danger')
+            return redirect(url_for('employee_task_detail', task_id=task_id))
         
         db.update_task_status(task_id, status, feedback)
         flash('Статус задачи обновлен!', 'success')
@@ -986,7 +4684,7 @@ def employee_change_password():
             return jsonify({'success': False, 'error': 'Пользователь не найден'}), 404
         
         # Проверяем старый пароль
-        if user['password'] != db.hash_password(old_password):
+        if not db.verify_password(old_password, user['password'], user['id']):
             return jsonify({'success': False, 'error': 'Неверный старый пароль'}), 400
         
         # Обновляем пароль
@@ -997,29 +4695,254 @@ def employee_change_password():
         conn.close()
         
         return jsonify({'success': True, 'message': 'Пароль успешно изменен'})
+    except PasswordQueueFull as e:
+        return jsonify({'success': False, 'error': str(e)}), 503
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/employee/messages')
 @employee_required
 def employee_messages():
-    messages = db.get_messages(session['user_id'], inbox=True)
-    sent_messages = db.get_messages(session['user_id'], inbox=False)
+    page = max(request.args.get('page', 1, type=int), 1)
+    threads = db.get_threads(session['user_id'], limit=THREADS_PER_PAGE + 1,
+                             offset=(page - 1) * THREADS_PER_PAGE)
+    sent_before = request.args.get('sent_before', type=int)
+    sent_messages = db.get_sent_messages(session['user_id'], sent_before, limit=SENT_MESSAGES_PER_PAGE + 1)
+    sent_next = sent_messages[SENT_MESSAGES_PER_PAGE - 1]['id'] if len(sent_messages) > SENT_MESSAGES_PER_PAGE else None
     return render_template('employee/messages.html', 
-                         messages=messages, 
-                         sent_messages=sent_messages)
+                         threads=threads[:THREADS_PER_PAGE], 
+                         page=page,
+                         has_next=len(threads) > THREADS_PER_PAGE,
+                         sent_messages=sent_messages[:SENT_MESSAGES_PER_PAGE],
+                         sent_before=sent_before,
+                         sent_next=sent_next)
+
+@app.route('/employee/messages/thread/<int:thread_id>')
+@employee_required
+def employee_thread(thread_id):
+    thread = db.get_thread(thread_id, session['user_id'])
+    if not thread:
+        flash('Диалог не найден', 'danger')
+        return redirect(url_for('employee_messages'))
+    
+    before_id = request.args.get('before_id', type=int)
+    messages = db.get_thread_messages(thread_id, before_id, limit=THREAD_MESSAGES_PER_PAGE + 1)
+    if thread['unread']:
+        db.mark_thread_as_read(thread_id, session['user_id'])
+    
+    page = messages[:THREAD_MESSAGES_PER_PAGE]
+    return render_template('employee/thread.html',
+                         thread=thread,
+                         messages=list(reversed(page)),
+                         older_id=page[-1]['id'] if len(messages) > THREAD_MESSAGES_PER_PAGE else None)
 
 @app.route('/employee/send_message', methods=['POST'])
 @employee_required
 def employee_send_message():
     receiver_id = request.form['receiver_id']
-    subject = request.form['subject']
+    subject = request.form.get('subject', '')
     content = request.form['content']
     
     db.send_message(session['user_id'], receiver_id, subject, content)
     flash('Сообщение отправлено!', 'success')
+    thread_id = request.form.get('thread_id', type=int)
+    if thread_id:
+        return redirect(url_for('employee_thread', thread_id=thread_id))
     return redirect(url_for('employee_messages'))
 
+@app.route('/api/messages/<int:message_id>/read', methods=['POST'])
+@login_required
+def mark_message_read_api(message_id):
+    changed = db.mark_message_as_read(message_id, session['user_id'])
+    return jsonify({'success': True, 'changed': changed,
+                    'unread': db.get_unread_count(session['user_id'])})
+
+@app.route('/api/messages/read', methods=['POST'])
+@login_required
+def mark_messages_read_api():
+    data = request.get_json(silent=True) or {}
+    changed = db.mark_messages_as_read(session['user_id'], data.get('message_ids'))
+    return jsonify({'success': True, 'changed': changed,
+                    'unread': db.get_unread_count(session['user_id'])})
+
+@app.route('/api/threads')
+@login_required
+@rate_limit(30, 2, priority='low')
+def threads_api():
+    limit = min(request.args.get('limit', THREADS_PER_PAGE, type=int), 100)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    threads = db.get_threads(session['user_id'], limit=limit, offset=offset)
+    return jsonify([dict(t) for t in threads])
+
+@app.route('/api/threads/<int:thread_id>/messages')
+@login_required
+def thread_messages_api(thread_id):
+    if not db.get_thread(thread_id, session['user_id']):
+        return jsonify({'error': 'Диалог не найден'}), 404
+    
+    limit = min(request.args.get('limit', THREAD_MESSAGES_PER_PAGE, type=int), 200)
+    messages = db.get_thread_messages(thread_id, request.args.get('before_id', type=int), limit)
+    return jsonify({
+        'messages': [dict(m) for m in messages],
+        'next_before_id': messages[-1]['id'] if len(messages) == limit else None
+    })
+
+@app.route('/api/threads/<int:thread_id>/read', methods=['POST'])
+@login_required
+def mark_thread_read_api(thread_id):
+    changed = db.mark_thread_as_read(thread_id, session['user_id'])
+    return jsonify({'success': True, 'changed': changed,
+                    'unread': db.get_unread_count(session['user_id'])})
+
+@app.route('/api/messages/unread_count')
+@login_required
+@rate_limit(10, 0.5, priority='low')
+def unread_count_api():
+    return jsonify({'unread': db.get_unread_count(session['user_id'])})
+
+@app.route('/api/messages/broadcast', methods=['POST'])
+@login_required
+def broadcast_message_api():
+    if session.get('role') != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+    
+    data = request.get_json() or {}
+    if not data.get('content'):
+        return jsonify({'error': 'Текст сообщения обязателен'}), 400
+    
+    try:
+        sent = db.send_broadcast(
+            session['user_id'],
+            data.get('subject', ''),
+            data['content'],
+            department=data.get('department'),
+            role=data.get('role'),
+            user_ids=data.get('user_ids')
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'success': True, 'sent': sent})
+
+# ========== КОМПАНИИ ==========
+
+def is_ops_admin():
+    """Межкомпанийные операции доступны администраторам компании по умолчанию"""
+    return (app.config['TENANTS_ENABLED'] and session.get('role') == 'admin'
+            and db.current_tenant == app.config['TENANT_DEFAULT'])
+
+@app.route('/api/tenants', methods=['GET', 'POST'])
+@login_required
+def tenants_api():
+    if not is_ops_admin():
+        return jsonify({'error': 'Доступ запрещен'}), 403
+    
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        if not data.get('username') or not data.get('password'):
+            return jsonify({'error': 'Не указан администратор компании'}), 400
+        # Хеш до создания базы: при перегрузке пула паролей компания не создается без администратора
+        try:
+            password_hash = db.hash_password(data['password'])
+        except PasswordQueueFull as e:
+            return jsonify({'error': str(e)}), 503
+        try:
+            database = db.create_tenant(data.get('tenant'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        database.register_user(data['username'], data['password'], data.get('email', ''), 'admin',
+                               password_hash=password_hash)
+        return jsonify({'success': True, 'tenant': data['tenant']}), 201
+    
+    return jsonify(db.list_tenants())
+
+@app.route('/api/tenants/stats')
+@login_required
+@rate_limit(5, 0.1)
+def tenants_stats_api():
+    """Статистика по каждой компании и сумма по всем"""
+    if not is_ops_admin():
+        return jsonify({'error': 'Доступ запрещен'}), 403
+    
+    stats = db.for_each_tenant(lambda database: database.get_stats())
+    totals = {}
+    for tenant_stats in stats.values():
+        for name, value in tenant_stats.items():
+            if isinstance(value, (int, float)) and name != 'efficiency':
+                totals[name] = totals.get(name, 0) + value
+    # Проценты компаний не складываются: эффективность считается по суммарным задачам и часам
+    total_hours = totals.get('total_hours', 0)
+    totals['efficiency'] = round(totals.get('total_tasks_completed', 0) / total_hours * 100, 2) if total_hours else 0
+    return jsonify({'tenants': stats, 'total': totals})
+
+# ========== ФОНОВЫЕ ЗАДАНИЯ ==========
+
+@app.route('/api/archive')
+@login_required
+def archive_files_api():
+    if session.get('role') != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+    return jsonify([dict(row) for row in db.get_archive_files()])
+
+@app.route('/api/jobs', methods=['GET', 'POST'])
+@login_required
+def jobs_api():
+    if session.get('role') != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+    
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        try:
+            job_id = jobs.submit(data.get('kind'), data.get('params'), session['user_id'])
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        except RuntimeError as e:
+            return jsonify({'error': str(e)}), 503
+        return jsonify({'job_id': job_id, 'status': 'queued'}), 202
+    
+    return jsonify([dict(job) for job in db.get_jobs()])
+
+@app.route('/api/jobs/<job_id>')
+@login_required
+@rate_limit(30, 2, priority='low')
+def job_status_api(job_id):
+    if session.get('role') != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+    
+    job = db.get_job(job_id)
+    if not job:
+        return jsonify({'error': 'Задание не найдено'}), 404
+    
+    result = dict(job)
+    result['params'] = json.loads(job['params']) if job['params'] else {}
+    result['result'] = json.loads(job['result']) if job['result'] else None
+    return jsonify(result)
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+@login_required
+def cancel_job_api(job_id):
+    if session.get('role') != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+    
+    return jsonify({'success': db.cancel_job(job_id)})
+
+@app.route('/api/jobs/<job_id>/download')
+@login_required
+def job_download_api(job_id):
+    if session.get('role') != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+    
+    job = db.get_job(job_id)
+    if not job or job['status'] != 'completed' or not job['result']:
+        return jsonify({'error': 'Результат недоступен'}), 404
+    
+    result = json.loads(job['result'])
+    if 'content' not in result:
+        return jsonify(result)
+    
+    response = app.response_class(result['content'], mimetype=result.get('content_type', 'text/plain'))
+    response.headers['Content-Disposition'] = f'attachment; filename="{result.get("filename", job_id)}"'
+    return response
+
 # ========== СТАРЫЕ МАРШРУТЫ ДЛЯ СОВМЕСТИМОСТИ ==========
 
 @app.route('/employees')
@@ -1055,7 +4978,11 @@ def add_task():
 @app.route('/update_task_status/<int:id>', methods=['POST'])
 @admin_required
 def update_task_status(id):
-    db.update_task_status(id, request.form['status'])
+    status = request.form.get('status')
+    if status not in TASK_STATUSES:
+        flash('Недопустимый статус задачи', 'danger')
+        return redirect(url_for('admin_tasks'))
+    db.update_task_status(id, status)
     flash('Статус задачи обновлен!', 'success')
     return redirect(url_for('admin_tasks'))
 
@@ -1068,33 +4995,153 @@ def delete_task(id):
 
 # ========== API МАРШРУТЫ ==========
 
+@app.route('/api/tasks/bulk', methods=['POST'])
+@login_required
+@rate_limit(10, 0.5)
+def bulk_add_tasks_api():
+    """Пакет задач: список tasks и/или шаблон template для employee_ids или отдела department"""
+    if session.get('role') != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+    
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Ожидается JSON-объект'}), 400
+    for key in ('tasks', 'employee_ids'):
+        if not isinstance(data.get(key) or [], list):
+            return jsonify({'error': f'Поле {key} должно быть списком'}), 400
+    if not isinstance(data.get('atomic', True), bool):
+        return jsonify({'error': 'Поле atomic должно быть true или false'}), 400
+    items = list(data.get('tasks') or [])
+    template = data.get('template')
+    if template and not isinstance(template, dict):
+        return jsonify({'error': 'Шаблон должен быть объектом'}), 400
+    if template:
+        employee_ids = list(data.get('employee_ids') or [])
+        if data.get('department'):
+            employee_ids += [emp.id for emp in db.directory.filter(department=data['department'], status='active')]
+        if not employee_ids:
+            return jsonify({'error': 'Для шаблона не указаны сотрудники'}), 400
+        items += [dict(template, employee_id=employee_id) for employee_id in employee_ids]
+    if not items:
+        return jsonify({'error': 'Пустой пакет'}), 400
+    if not all(isinstance(item, dict) for item in items):
+        return jsonify({'error': 'Элементы пакета должны быть объектами'}), 400
+    if len(items) > app.config['TASK_BATCH_MAX']:
+        return jsonify({'error': f'Не более {app.config["TASK_BATCH_MAX"]} задач за запрос'}), 400
+    
+    atomic = data.get('atomic', True)
+    results = db.add_tasks(items, manager_id=session['user_id'], atomic=atomic)
+    created = sum(1 for result in results if 'id' in result)
+    if created:
+        overdue_scheduler.wake()
+        # Панели назначенных сотрудников сброшены - строим их до того, как сотрудники их откроют
+        try:
+            jobs.submit('dashboards', user_id=session['user_id'])
+        except RuntimeError:
+            pass
+    return jsonify({'success': created > 0, 'created': created, 'results': results}), \
+        400 if atomic and not created else 200
+
+@app.route('/api/tasks/bulk_status', methods=['POST'])
+@login_required
+@rate_limit(10, 0.5)
+def bulk_update_task_status_api():
+    """Пакетная смена статусов: items [{id, status, feedback}] или ids + status"""
+    if session.get('role') != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+    
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Ожидается JSON-объект'}), 400
+    for key in ('items', 'ids'):
+        if not isinstance(data.get(key) or [], list):
+            return jsonify({'error': f'Поле {key} должно быть списком'}), 400
+    if not isinstance(data.get('atomic', True), bool):
+        return jsonify({'error': 'Поле atomic должно быть true или false'}), 400
+    items = list(data.get('items') or [])
+    if data.get('ids'):
+        items += [{'id': task_id, 'status': data.get('status'), 'feedback': data.get('feedback')}
+                  for task_id in data['ids']]
+    if not items:
+        return jsonify({'error': 'Пустой пакет'}), 400
+    if not all(isinstance(item, dict) for item in items):
+        return jsonify({'error': 'Элементы пакета должны быть объектами'}), 400
+    if len(items) > app.config['TASK_BATCH_MAX']:
+        return jsonify({'error': f'Не более {app.config["TASK_BATCH_MAX"]} задач за запрос'}), 400
+    
+    atomic = data.get('atomic', True)
+    results = db.update_tasks_status(items, atomic=atomic)
+    updated = sum(1 for result in results if result['success'])
+    failed = len(results) - updated
+    return jsonify({'success': updated > 0, 'updated': updated, 'results': results}), \
+        400 if atomic and failed else 200
+
+@app.route('/api/employees/search')
+@login_required
+@rate_limit(60, 10)
+def employee_search_api():
+    if session.get('role') != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+    
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 50)
+    results = db.directory.search(
+        request.args.get('q', ''),
+        department=request.args.get('department') or None,
+        status=request.args.get('status') or None,
+        limit=limit
+    )
+    return jsonify([{
+        'id': emp.id,
+        'name': emp.name,
+        'position': emp.position,
+        'department': emp.department,
+        'phone': emp.phone,
+        'email': emp.email,
+        'status': emp.status
+    } for emp in results])
+
 @app.route('/api/update_location/<int:id>', methods=['POST'])
 @login_required
+@rate_limit(30, 1)
 def update_location(id):
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Ожидается JSON-объект'}), 400
+    # Метка времени точки трека - секунды Unix; проверяем до открытия транзакции
+    timestamp = data.get('timestamp')
+    if timestamp is not None:
+        try:
+            if isinstance(timestamp, bool):
+                raise ValueError
+            timestamp = int(float(timestamp))
+            if timestamp <= 0:
+                raise ValueError
+        except (TypeError, ValueError, OverflowError):
+            return jsonify({'error': 'Некорректная метка времени'}), 400
+    for key in ('latitude', 'longitude'):
+        try:
+            if data.get(key) is not None and not math.isfinite(float(data[key])):
+                raise ValueError
+        except (TypeError, ValueError):
+            return jsonify({'error': f'Некорректное значение {key}'}), 400
+    
     try:
-        data = request.get_json()
-        
         # Проверяем права доступа
         if session.get('role') == 'employee':
             employee = db.get_employee_by_user_id(session['user_id'])
             if employee['id'] != id:
                 return jsonify({'error': 'Доступ запрещен'}), 403
         
-        conn = db.get_connection()
-        conn.execute('''
-            UPDATE employees 
-            SET latitude = ?, longitude = ?, location = ?
-            WHERE id = ?
-        ''', (data.get('latitude'), data.get('longitude'), data.get('location', ''), id))
-        conn.commit()
-        conn.close()
+        events = db.update_location(id, data.get('latitude'), data.get('longitude'),
+                                    data.get('location', ''), timestamp)
         
-        return jsonify({'message': 'Location updated'})
+        return jsonify({'message': 'Location updated', 'geofence_events': events})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/employee_locations')
 @login_required
+@rate_limit(10, 0.5, priority='low')
 def employee_locations():
     if session.get('role') != 'admin':
         return jsonify({'error': 'Доступ запрещен'}), 403
@@ -1119,6 +5166,128 @@ def employee_locations():
         })
     return jsonify(result)
 
+@app.route('/api/geofences', methods=['GET', 'POST'])
+@login_required
+def geofences_api():
+    if session.get('role') != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+    
+    if request.method == 'POST':
+        try:
+            geofence_id = db.add_geofence(request.get_json())
+            return jsonify({'id': geofence_id}), 201
+        except (KeyError, TypeError, ValueError) as e:
+            return jsonify({'error': f'Некорректные данные геозоны: {e}'}), 400
+    
+    result = []
+    for fence in db.get_geofences():
+        item = dict(fence)
+        item['polygon'] = json.loads(fence['polygon']) if fence['polygon'] else None
+        result.append(item)
+    return jsonify(result)
+
+@app.route('/api/geofences/<int:id>', methods=['DELETE'])
+@login_required
+def delete_geofence_api(id):
+    if session.get('role') != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+    
+    db.delete_geofence(id)
+    return jsonify({'message': 'Geofence deleted'})
+
+@app.route('/api/geofence_events')
+@login_required
+def geofence_events_api():
+    if session.get('role') != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+    
+    events = db.get_geofence_events(
+        employee_id=request.args.get('employee_id', type=int),
+        geofence_id=request.args.get('geofence_id', type=int),
+        limit=min(request.args.get('limit', 100, type=int), 1000)
+    )
+    return jsonify([dict(e) for e in events])
+
+def parse_timestamp(value, default):
+    """Разбор времени из параметра запроса: unix-время или ISO-строка (UTC)"""
+    if not value:
+        return default
+    try:
+        return int(float(value))
+    except ValueError:
+        parsed = datetime.datetime.fromisoformat(value)
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+        return int(parsed.timestamp())
+
+@app.route('/api/trail/<int:id>')
+@login_required
+@rate_limit(20, 1)
+def employee_trail_api(id):
+    if session.get('role') == 'employee':
+        employee = db.get_employee_by_user_id(session['user_id'])
+        if not employee or employee['id'] != id:
+            return jsonify({'error': 'Доступ запрещен'}), 403
+    
+    try:
+        now = int(time.time())
+        end_ts = parse_timestamp(request.args.get('end'), now)
+        start_ts = parse_timestamp(request.args.get('start'), end_ts - 86400)
+    except ValueError:
+        return jsonify({'error': 'Некорректный интервал времени'}), 400
+    
+    zoom = request.args.get('zoom', type=int)
+    tolerance_m = None
+    if zoom is not None:
+        employee = db.get_employee_by_id(id)
+        tolerance_m = zoom_tolerance_m(zoom, (employee['latitude'] if employee else None) or 0.0)
+    
+    points = db.get_trail(id, start_ts, end_ts, tolerance_m)
+    return jsonify({
+        'employee_id': id,
+        'start': start_ts,
+        'end': end_ts,
+        'points': [[lat, lon, ts] for lat, lon, ts in points]
+    })
+
+@app.route('/api/heatmap/<int:z>/<int:x>/<int:y>')
+@login_required
+@rate_limit(200, 20, priority='low')
+def heatmap_tile_api(z, x, y):
+    if session.get('role') != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+    
+    if z not in app.config['HEATMAP_ZOOMS'] or not (0 <= x < (1 << z) and 0 <= y < (1 << z)):
+        return jsonify({'error': 'Тайл вне диапазона'}), 404
+    
+    response = jsonify(db.get_heatmap_tile(z, x, y))
+    response.headers['Cache-Control'] = 'private, max-age=60'
+    return response
+
+@app.route('/api/password_metrics')
+@login_required
+def password_metrics_api():
+    if session.get('role') != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+    
+    return jsonify(passwords.metrics())
+
+@app.route('/api/fragment_cache')
+@login_required
+def fragment_cache_api():
+    if session.get('role') != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+    
+    return jsonify(fragment_cache.stats())
+
+@app.route('/api/trail_stats')
+@login_required
+def trail_stats_api():
+    if session.get('role') != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+    
+    return jsonify(db.get_trail_storage_stats())
+
 @app.route('/employee/update_profile', methods=['POST'])
 @employee_required
 def employee_update_profile():
@@ -1129,6 +5298,12 @@ def employee_update_profile():
         
         data = request.get_json()
         
+        # Хеш нового пароля вычисляется до начала транзакции записи
+        new_password = data.get('new_password')
+        hashed_password = None
+        if new_password and new_password.strip():
+            hashed_password = db.hash_password(new_password)
+        
         # Обновляем данные сотрудника
         conn = db.get_connection()
         conn.execute('''
@@ -1145,17 +5320,18 @@ def employee_update_profile():
             employee['id']
         ))
         
+        db.log_data_change(conn, 'employees', employee['id'])
+        
         # Если указан новый пароль, обновляем его
-        new_password = data.get('new_password')
-        if new_password and new_password.strip():
+        if hashed_password:
             # Получаем user_id
             user = conn.execute('SELECT id FROM users WHERE employee_id = ?', (employee['id'],)).fetchone()
             if user:
-                hashed_password = db.hash_password(new_password)
                 conn.execute('UPDATE users SET password = ? WHERE id = ?', (hashed_password, user['id']))
         
         conn.commit()
         conn.close()
+        db.directory.invalidate()
         
         # Обновляем имя в сессии
         session['employee_name'] = data.get('name')
@@ -1163,12 +5339,15 @@ def employee_update_profile():
         return jsonify({'success': True, 'message': 'Профиль обновлен'})
     except sqlite3.IntegrityError as e:
         return jsonify({'success': False, 'error': 'Email или телефон уже используются'}), 400
+    except PasswordQueueFull as e:
+        return jsonify({'success': False, 'error': str(e)}), 503
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
 @app.route('/api/stats')
 @login_required
+@rate_limit(10, 0.5, priority='low')
 def get_stats_api():
     if session.get('role') == 'admin':
         stats = db.get_stats()
@@ -1178,6 +5357,139 @@ def get_stats_api():
     
     return jsonify(stats)
 
+@app.route('/api/timeseries')
+@login_required
+@rate_limit(60, 2, priority='low')
+def timeseries_api():
+    """Ряд метрики по корзинам за период, прореженный до points точек"""
+    metric = request.args.get('metric', 'hours')
+    if metric not in TIMESERIES_METRICS:
+        return jsonify({'error': f'Метрика: {", ".join(TIMESERIES_METRICS)}'}), 400
+    
+    today = datetime.date.today()
+    try:
+        date_to = datetime.date.fromisoformat(request.args.get('date_to') or today.isoformat())
+        date_from = datetime.date.fromisoformat(request.args.get('date_from') or
+                                                (date_to - datetime.timedelta(days=365)).isoformat())
+    except ValueError:
+        return jsonify({'error': 'Даты в формате YYYY-MM-DD'}), 400
+    if date_from > date_to:
+        return jsonify({'error': 'Начало периода позже конца'}), 400
+    
+    span = (date_to - date_from).days
+    bucket = request.args.get('bucket') or ('day' if span <= 92 else 'week' if span <= 730 else 'month')
+    if bucket not in TIMESERIES_BUCKETS:
+        return jsonify({'error': f'Корзина: {", ".join(TIMESERIES_BUCKETS)}'}), 400
+    if bucket == 'day' and span >= app.config['TIMESERIES_MAX_BUCKETS']:
+        return jsonify({'error': 'Слишком длинный период для дневных корзин'}), 400
+    points = min(max(request.args.get('points', app.config['TIMESERIES_DEFAULT_POINTS'], type=int), 3),
+                 app.config['TIMESERIES_MAX_POINTS'])
+    
+    employee_id = request.args.get('employee_id', type=int)
+    department = request.args.get('department') or None
+    if session.get('role') != 'admin':
+        employee = db.get_employee_by_user_id(session['user_id'])
+        if not employee:
+            return jsonify({'error': 'Доступ запрещен'}), 403
+        employee_id, department = employee['id'], None
+    
+    # Ответ меняется с новыми отчетами и задачами, переводами сотрудников между отделами
+    # и со сменой дня, если период задан по умолчанию: в тег входят вычисленные даты
+    version = db.get_data_version(('work_reports', 'tasks', 'employees'))
+    etag = hashlib.sha1(f'{db.current_tenant}:{version}:{request.full_path}:{employee_id}:'
+                        f'{date_from.isoformat()}:{date_to.isoformat()}'.encode()).hexdigest()
+    # Слабое сравнение: после сжатия тег ответа слабый (W/"...")
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+    
+    totals = db.get_rollup_series(metric, bucket, date_from.isoformat(), date_to.isoformat(),
+                                  employee_id=employee_id, department=department)
+    series = [(i, start.isoformat(), totals.get(start.isoformat()) or 0)
+              for i, start in enumerate(bucket_starts(bucket, date_from, date_to))]
+    sampled = lttb([(i, value, start) for i, start, value in series], points)
+    
+    response = jsonify({
+        'metric': metric,
+        'bucket': bucket,
+        'date_from': date_from.isoformat(),
+        'date_to': date_to.isoformat(),
+        'buckets': len(series),
+        'downsampled': len(sampled) < len(series),
+        'points': [[start, round(value, 2)] for _, value, start in sampled]
+    })
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+SLA_DIMENSIONS = ('all', 'employee', 'department', 'priority')
+
+@app.route('/api/sla')
+@login_required
+@rate_limit(30, 1, priority='low')
+def sla_api():
+    """Время до начала и до завершения задач и доля выполненных в срок по сотрудникам, отделам, приоритетам"""
+    if session.get('role') != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+    dimension = request.args.get('dimension', 'all')
+    if dimension not in SLA_DIMENSIONS:
+        return jsonify({'error': f'Разрез: {", ".join(SLA_DIMENSIONS)}'}), 400
+    
+    def hours(seconds, count=1):
+        return round(seconds / count / 3600, 2) if count else None
+    
+    result = []
+    for row in db.get_sla_stats(dimension):
+        item = {
+            'key': row['key'],
+            'started': row['started'],
+            'avg_time_to_start_h': hours(row['start_s'], row['started']),
+            'max_time_to_start_h': hours(row['start_max_s']) if row['started'] else None,
+            'completed': row['completed'],
+            'avg_time_to_complete_h': hours(row['complete_s'], row['completed']),
+            'max_time_to_complete_h': hours(row['complete_max_s']) if row['completed'] else None,
+            'with_due_date': row['due'],
+            'on_time_rate': round(row['on_time'] / row['due'], 3) if row['due'] else None
+        }
+        if dimension == 'employee':
+            employee = db.directory.get(int(row['key']))
+            item['name'] = employee.name if employee else None
+        result.append(item)
+    return jsonify(result)
+
+@app.route('/api/tasks/<int:task_id>/transitions')
+@login_required
+def task_transitions_api(task_id):
+    if session.get('role') != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+    return jsonify([dict(row) for row in db.get_task_transitions(task_id)])
+
+@app.route('/api/analytics/workforce')
+@login_required
+@rate_limit(10, 0.2, priority='low')
+def workforce_analytics_api():
+    """Распределения часов и сроков выполнения, рейтинг отделов и недельная динамика за период"""
+    if session.get('role') != 'admin':
+        return jsonify({'error': 'Доступ запрещен'}), 403
+    if load_numpy() is None:
+        return jsonify({'error': 'Для аналитики требуется пакет numpy'}), 503
+    
+    today = datetime.date.today()
+    try:
+        date_from = datetime.date.fromisoformat(request.args.get('date_from') or
+                                                (today - datetime.timedelta(weeks=12)).isoformat())
+        date_to = datetime.date.fromisoformat(request.args.get('date_to') or today.isoformat())
+    except ValueError:
+        return jsonify({'error': 'Даты в формате YYYY-MM-DD'}), 400
+    
+    reports, tasks, departments = db.get_analytics_columns(date_from.isoformat(), date_to.isoformat())
+    return jsonify({
+        'date_from': date_from.isoformat(),
+        'date_to': date_to.isoformat(),
+        **compute_workforce_analytics(reports, tasks, departments)
+    })
+
 # ========== ЗАПУСК СЕРВЕРА ==========
 
 if __name__ == '__main__':
@@ -1202,4 +5514,4 @@ if __name__ == '__main__':
     os.makedirs('templates/admin', exist_ok=True)
     os.makedirs('templates/employee', exist_ok=True)
     
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    create_app().run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import app as app_module
+
+
+@pytest.fixture
+def fresh_app(tmp_path, monkeypatch):
+    """Приложение на пустой базе во временном каталоге; create_app() еще не вызывался"""
+    def configure(engine):
+        monkeypatch.setitem(app_module.app.config, 'STORAGE_ENGINE', engine)
+        monkeypatch.setitem(app_module.app.config, 'DATABASE', str(tmp_path / 'employees.db'))
+        monkeypatch.setitem(app_module.app.config, 'TENANT_DIR', str(tmp_path / 'tenants'))
+        monkeypatch.setitem(app_module.app.config, 'RATE_LIMIT_DB', str(tmp_path / 'ratelimit.db'))
+        monkeypatch.setattr(app_module, '_app_initialized', False)
+        app_module.db.reset_storage()
+        return app_module
+    yield configure
+    app_module.db.reset_storage()
@@ -0,0 +1,66 @@
+import pytest
+
+
+@pytest.fixture
+def reopened(fresh_app, monkeypatch):
+    """База, созданная одним экземпляром Database и открытая заново без миграции"""
+    module = fresh_app('sqlite')
+    monkeypatch.setitem(module.app.config, 'RATE_LIMIT_ENABLED', False)
+    monkeypatch.setitem(module.app.config, 'TASK_OVERDUE_ENABLED', False)
+    module.Database(module.app.config['DATABASE'])
+    module.db.reset_storage()
+    return module
+
+
+def test_reopened_database_detects_rtree(reopened):
+    first = reopened.db.get_database(reopened.app.config['TENANT_DEFAULT'])
+    second = reopened.Database(reopened.app.config['DATABASE'])
+    assert second.has_rtree == first.has_rtree
+    assert second.update_location(1, 55.75, 37.61) == []
+
+
+def test_location_ping_on_reopened_database(reopened):
+    client = reopened.app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+    response = client.post('/api/update_location/1', json={'latitude': 55.75, 'longitude': 37.61})
+    assert response.status_code == 200
+    assert response.get_json()['geofence_events'] == []
+
+
+def admin_client(module):
+    client = module.app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+    return client
+
+
+def test_circle_enter_and_exit_after_reopen(reopened):
+    client = admin_client(reopened)
+    response = client.post('/api/geofences', json={
+        'name': 'Склад', 'kind': 'circle', 'center_lat': 55.75, 'center_lon': 37.61, 'radius_m': 500,
+        'enter_status': 'on_site', 'exit_status': 'away'
+    })
+    assert response.status_code == 201
+    fence_id = response.get_json()['id']
+    reopened.db.reset_storage()
+
+    inside = client.post('/api/update_location/1', json={'latitude': 55.751, 'longitude': 37.611})
+    assert inside.get_json()['geofence_events'] == [{'geofence_id': fence_id, 'event': 'enter'}]
+    assert reopened.db.get_employee_by_id(1)['status'] == 'on_site'
+
+    still_inside = client.post('/api/update_location/1', json={'latitude': 55.7505, 'longitude': 37.6105})
+    assert still_inside.get_json()['geofence_events'] == []
+
+    outside = client.post('/api/update_location/1', json={'latitude': 55.80, 'longitude': 37.70})
+    assert outside.get_json()['geofence_events'] == [{'geofence_id': fence_id, 'event': 'exit'}]
+    assert reopened.db.get_employee_by_id(1)['status'] == 'away'
+
+
+def test_polygon_enter_after_reopen(reopened):
+    database = reopened.db.get_database(reopened.app.config['TENANT_DEFAULT'])
+    fence_id = database.add_geofence({
+        'name': 'Площадка', 'kind': 'polygon',
+        'polygon': [[55.0, 37.0], [55.0, 38.0], [56.0, 38.0], [56.0, 37.0]]
+    })
+    database = reopened.Database(reopened.app.config['DATABASE'])
+    assert database.update_location(3, 55.5, 37.5) == [{'geofence_id': fence_id, 'event': 'enter'}]
+    assert database.update_location(3, 57.0, 37.5) == [{'geofence_id': fence_id, 'event': 'exit'}]
@@ -0,0 +1,62 @@
+import os
+import sqlite3
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+from app import SCHEMA_VERSION
+from conftest import ROOT
+
+
+@pytest.mark.parametrize('engine', ['memory', 'sqlite'])
+def test_startup_within_budget(fresh_app, engine):
+    module = fresh_app(engine)
+    app = module.create_app()
+    assert app.config['STARTUP_MS'] < app.config['STARTUP_BUDGET_MS']
+    assert module.db.get_database(app.config['TENANT_DEFAULT']).get_schema_version() == SCHEMA_VERSION
+
+
+# Воркер: считает запуски миграции в журнал и задерживает ее, чтобы второй процесс
+# гарантированно пришел, пока первый держит блокировку
+WORKER = textwrap.dedent('''
+    import os, sys, time
+    sys.path.insert(0, {root!r})
+    import app as module
+
+    init_db = module.Database.init_db
+    def counted_init_db(self, *args, **kwargs):
+        with open({log!r}, 'a') as f:
+            f.write(f'{{os.getpid()}}\\n')
+        time.sleep(0.5)
+        return init_db(self, *args, **kwargs)
+    module.Database.init_db = counted_init_db
+
+    module.app.config['DATABASE'] = {database!r}
+    module.app.config['TENANT_DIR'] = {tenants!r}
+    module.app.config['RATE_LIMIT_DB'] = {ratelimit!r}
+    module.create_app()
+''')
+
+
+def test_concurrent_startup_migrates_once(tmp_path):
+    log = tmp_path / 'migrations.log'
+    database = tmp_path / 'employees.db'
+    script = WORKER.format(root=ROOT, log=str(log), database=str(database),
+                           tenants=str(tmp_path / 'tenants'), ratelimit=str(tmp_path / 'ratelimit.db'))
+    env = dict(os.environ, STORAGE_ENGINE='sqlite')
+    workers = [subprocess.Popen([sys.executable, '-c', script], cwd=tmp_path, env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE) for _ in range(2)]
+    for worker in workers:
+        _, stderr = worker.communicate(timeout=60)
+        assert worker.returncode == 0, stderr.decode()
+
+    assert len(log.read_text().split()) == 1
+
+    conn = sqlite3.connect(database)
+    try:
+        assert conn.execute('PRAGMA user_version').fetchone()[0] == SCHEMA_VERSION
+        assert conn.execute('SELECT COUNT(*) FROM users WHERE username = ?', ('admin',)).fetchone()[0] == 1
+    finally:
+        conn.close()
@@ -0,0 +1,56 @@
+import pytest
+
+
+@pytest.fixture(params=['sqlite', 'memory'])
+def tenants_app(request, fresh_app, monkeypatch):
+    module = fresh_app(request.param)
+    monkeypatch.setitem(module.app.config, 'TENANTS_ENABLED', True)
+    monkeypatch.setitem(module.app.config, 'RATE_LIMIT_ENABLED', False)
+    monkeypatch.setitem(module.app.config, 'TASK_OVERDUE_ENABLED', False)
+    module.create_app()
+    return module
+
+
+def login(module, username, password, company=''):
+    client = module.app.test_client()
+    response = client.post('/login', data={'username': username, 'password': password, 'company': company})
+    return client, response
+
+
+def test_create_tenant_and_log_in(tenants_app):
+    ops, _ = login(tenants_app, 'admin', 'admin123')
+    response = ops.post('/api/tenants', json={'tenant': 'acme', 'username': 'boss', 'password': 'secret1'})
+    assert response.status_code == 201
+    assert ops.get('/api/tenants').get_json() == ['default', 'acme']
+
+    # Вход в компанию после повторного открытия ее базы (без миграции); базы в памяти при сбросе удаляются
+    if tenants_app.app.config['STORAGE_ENGINE'] == 'sqlite':
+        tenants_app.db.reset_storage()
+    client, response = login(tenants_app, 'boss', 'secret1', company='acme')
+    assert response.status_code == 302
+    with client.session_transaction() as session:
+        assert session['tenant'] == 'acme'
+        assert session['role'] == 'admin'
+
+    # Администратор компании видит только свою базу и не управляет компаниями
+    assert client.get('/api/tenants').status_code == 403
+    assert client.get('/api/employees/search?q=').get_json() == []
+
+
+def test_tenant_users_are_isolated(tenants_app):
+    ops, _ = login(tenants_app, 'admin', 'admin123')
+    ops.post('/api/tenants', json={'tenant': 'acme', 'username': 'boss', 'password': 'secret1'})
+
+    _, response = login(tenants_app, 'admin', 'admin123', company='acme')
+    assert response.status_code == 200
+    _, response = login(tenants_app, 'boss', 'secret1')
+    assert response.status_code == 200
+    _, response = login(tenants_app, 'boss', 'secret1', company='missing')
+    assert response.status_code == 200
+
+
+def test_duplicate_tenant_is_rejected(tenants_app):
+    ops, _ = login(tenants_app, 'admin', 'admin123')
+    data = {'tenant': 'acme', 'username': 'boss', 'password': 'secret1'}
+    assert ops.post('/api/tenants', json=data).status_code == 201
+    assert ops.post('/api/tenants', json=data).status_code == 400